@@ -0,0 +1,162 @@
+"""A columnar table of building reports (one row per building), with vectorized group-by statistics.
+
+Numeric features are stored as float arrays (nan where a report lacks the feature);
+non-numeric ones (e.g., btype and naics) are stored as categorical codes plus their labels.
+"""
+import  numbers
+import  numpy as np
+
+class AggTable(object):
+    """An aggregate report, as columns.
+
+    Parameters:
+    bids -- The building ids (one per row).
+    columns -- A dictionary mapping numeric feature names to float arrays.
+    categoricals -- A dictionary mapping categorical column names to (codes, labels),
+                    where codes is an int array and labels[code] is the value of the row.
+    """
+    def __init__(self, bids, columns, categoricals):
+        self.bids         = np.asarray(bids)
+        self.columns      = columns
+        self.categoricals = categoricals
+        self.index        = dict((bid, i) for i, bid in enumerate(self.bids))
+
+    @classmethod
+    def from_reports(cls, bids, reports, extra = None, categorical = ("btype", "naics")):
+        """Build a table from a list of Building Reports.
+
+        Parameters:
+        bids -- The building ids, in the same order as reports.
+        reports -- A list of Building Reports (dictionaries mapping features to values).
+        extra -- An optional dictionary mapping column names to lists of values (e.g., {"btype": [...]}).
+        categorical -- The columns stored as categories even if their values are numbers.
+        """
+        rows  = [dict(r) for r in reports]
+        extra = extra or {}
+        for name, vals in extra.items():
+            for r, v in zip(rows, vals):
+                r[name] = v
+        names = []
+        for r in rows:
+            names.extend(k for k in r.keys() if k not in names)
+
+        columns      = {}
+        categoricals = {}
+        for name in names:
+            vals = [r.get(name) for r in rows]
+            vals = [None if v is np.ma.masked else v for v in vals]
+            if name not in categorical and all(v is None or _is_number(v) for v in vals):
+                columns[name] = np.array([np.nan if v is None else float(v) for v in vals])
+            else:
+                categoricals[name] = _encode(vals)
+        return cls(bids, columns, categoricals)
+
+    def __len__(self):
+        return len(self.bids)
+
+    def features(self):
+        """The names of the numeric columns."""
+        return sorted(self.columns.keys())
+
+    def __getitem__(self, name):
+        """The column name (for categorical columns, the values rather than the codes)."""
+        if name in self.columns:
+            return self.columns[name]
+        codes, labels = self.categoricals[name]
+        return np.array(labels, dtype = object)[codes]
+
+    def row(self, bid):
+        """The report of one building (as a dictionary)."""
+        i   = self.index[bid]
+        toR = dict((name, col[i]) for name, col in self.columns.items())
+        toR.update((name, labels[codes[i]]) for name, (codes, labels) in self.categoricals.items())
+        return toR
+
+    def select(self, mask):
+        """Return a table with the rows picked by mask (a boolean array or an array of row indices).
+        The columns of the new table are slices of this one; categorical labels are kept as they are."""
+        columns      = dict((name, col[mask]) for name, col in self.columns.items())
+        categoricals = dict((name, (codes[mask], labels)) for name, (codes, labels) in self.categoricals.items())
+        return AggTable(self.bids[mask], columns, categoricals)
+
+    def segment(self, by, label):
+        """The rows whose categorical column by has the value label."""
+        codes, labels = self.categoricals[by]
+        if label not in labels:
+            return self.select(np.zeros(len(self), dtype = bool))
+        return self.select(codes == labels.index(label))
+
+    def group_stats(self, feature, by = "btype"):
+        """Statistics of a feature in each group, computed for all groups at once (nans are ignored).
+
+        Returns a dictionary of arrays (one entry per group) with the group "labels", and
+        the "count", "mean", "std", "min", "median" and "max" of the feature.
+        """
+        codes, labels = self.categoricals[by]
+        vals    = self.columns[feature]
+        ok      = ~np.isnan(vals)
+        codes   = codes[ok]
+        vals    = vals[ok]
+        ngroups = len(labels)
+
+        count = np.bincount(codes, minlength = ngroups)
+        total = np.bincount(codes, weights = vals, minlength = ngroups)
+        sumsq = np.bincount(codes, weights = vals**2, minlength = ngroups)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            mean = total / count
+            std  = np.sqrt(np.maximum(sumsq / count - mean**2, 0))
+
+        #min, median and max from one sort by (group, value)
+        order  = np.lexsort((vals, codes))
+        svals  = vals[order]
+        first  = np.cumsum(count) - count
+        last   = first + count - 1
+        mins   = np.empty(ngroups)
+        maxs   = np.empty(ngroups)
+        meds   = np.empty(ngroups)
+        mins.fill(np.nan)
+        maxs.fill(np.nan)
+        meds.fill(np.nan)
+        has    = count > 0
+        mins[has] = svals[first[has]]
+        maxs[has] = svals[last[has]]
+        meds[has] = (svals[first[has] + (count[has] - 1) // 2] + svals[first[has] + count[has] // 2]) / 2.0
+        return {"labels": list(labels),
+                "count" : count,
+                "mean"  : mean,
+                "std"   : std,
+                "min"   : mins,
+                "median": meds,
+                "max"   : maxs}
+
+    def group_histograms(self, feature, by = "btype", bins = 100):
+        """Histograms of a feature for every group, with common bin edges.
+        Returns (labels, counts, edges), where counts has one row per group."""
+        codes, labels = self.categoricals[by]
+        vals  = self.columns[feature]
+        ok    = np.isfinite(vals)
+        edges = np.histogram(vals[ok], bins = bins)[1] if ok.any() else np.linspace(0, 1, bins + 1)
+        which = np.clip(np.searchsorted(edges, vals[ok], side = "right") - 1, 0, bins - 1)
+        counts = np.bincount(codes[ok] * bins + which, minlength = len(labels) * bins)
+        return list(labels), counts.reshape(len(labels), bins), edges
+
+    def to_dict(self):
+        """The table as an aggregate report of lists (each feature mapped to one value per building)."""
+        toR = dict((name, list(col)) for name, col in self.columns.items())
+        toR.update((name, list(self[name])) for name in self.categoricals)
+        return toR
+
+def _is_number(v):
+    return isinstance(v, (numbers.Number, np.number)) and not isinstance(v, bool)
+
+def _encode(vals):
+    """Return (codes, labels) for a list of values."""
+    labels = []
+    lookup = {}
+    codes  = np.empty(len(vals), dtype = np.int32)
+    for i, v in enumerate(vals):
+        if v not in lookup:
+            lookup[v] = len(labels)
+            labels.append(v)
+        codes[i] = lookup[v]
+    return codes, labels
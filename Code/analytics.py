@@ -0,0 +1,316 @@
+"""The numeric analytics used by the reports (periods, peaks, outliers, thresholds).
+This module only needs NumPy (and pytz, for local times), so it can be imported by workers that never draw a figure.
+"""
+import  numpy as np
+from    holiday import yfhol
+from    timeaxis import get_calendar
+
+def period_inds(d, nobs, first_pred, wrap_around = False):
+    """The indices (into d["times"]) of the periods of a building record, as a matrix with one period per row.
+    See get_periods for the parameters.
+
+    Periods follow the local clock: column j of a row is the j-th time step after the start of the period,
+    in local time. So on the day daylight saving time starts (a 23-hour day) one slot has no reading
+    (its index is -1), and on the day it ends (a 25-hour day) the repeated hour keeps its first reading.
+    Only complete periods are returned.
+    With wrap_around, periods are instead made of nobs consecutive readings (by position).
+    """
+    cal     = get_calendar(d)
+    num_obs = len(cal)
+    starts  = np.flatnonzero(first_pred(cal))
+    first   = starts[0] if len(starts) > 0 else 0
+    if wrap_around or num_obs - first < 2:
+        inds     = np.concatenate([np.arange(first, num_obs), np.arange(first)]) if wrap_around else np.arange(first, num_obs)
+        num_pers = len(inds) // nobs #trim off extra
+        return inds[:num_pers * nobs].reshape(num_pers, nobs)
+
+    #the slot of each reading: time steps (on the local clock) since the start of the first period
+    step   = max(int(np.median(np.diff(cal.epochs))), 1)
+    local  = cal.local[first:]
+    slots  = (local - local[0]) // step
+    uslots, firsts = np.unique(slots, return_index = True) #the first reading of each slot
+    num_pers = (uslots[-1] + 1) // nobs #trim off extra
+    keep   = np.logical_and(uslots >= 0, uslots < num_pers * nobs)
+    inds   = np.empty(num_pers * nobs, dtype = int)
+    inds.fill(-1)
+    inds[uslots[keep]] = first + firsts[keep]
+    return inds.reshape(num_pers, nobs)
+
+def get_periods(d, nobs, first_pred, which = "kwhs", skip_fun = None, wrap_around = False):
+    """Get a collection of periods (e.g., weeks) from a building record.
+    Periods follow the local clock (see period_inds), so days and weeks stay aligned across daylight saving time.
+
+    Parameters:
+    d -- The building record.
+    nobs -- The number (int) of observations for a single period (e.g., 168 for weeks).
+    first_pred -- A function which, given the Calendar of the record (see timeaxis), returns a boolean array
+                  which is True at the times which may start a period.
+                  For example, (lambda c: (c.weekday == 6) & (c.hour == 0)) for weeks starting Sunday at Midnight.
+    which -- A string representing which time series in the building record to use (defaults to "kwhs")
+    skip_fun -- A function which, given the Calendar of the record, returns a boolean array which is True
+                at the times that should be skipped (masked).
+                For example, (lambda c: c.weekday >= 5) masks weekends, to obtain only work weeks.
+    wrap_around -- If True, the beginning part of the time series is placed at the end.
+                   For example, if we're starting periods on Monday, but the first day in the time series 
+                   is Thursday, then the first part (from Thrusday to Monday) will be moved to the end.
+
+    Returns (pers, new_times):
+         pers -- The values (e.g., kwhs) of the periods (a masked array; a copy, so d is not changed).
+                 Slots with no reading (e.g., the hour skipped when daylight saving time starts) are masked.
+         new_times -- The times (datetime64, UTC) associated with the values (NaT for slots with no reading).
+    """
+    inds                   = period_inds(d, nobs, first_pred, wrap_around)
+    missing                = inds < 0
+    series, series_oriflag = d[which]
+    mask = ~np.asarray(series_oriflag, dtype = bool)
+    if skip_fun is not None:
+        mask = np.logical_or(mask, skip_fun(get_calendar(d)))
+    if missing.any(): #slots with no reading hold the reading before them (masked)
+        flat = inds.ravel()
+        inds = flat[np.maximum.accumulate(np.where(flat >= 0, np.arange(len(flat)), 0))].reshape(inds.shape)
+    pers      = np.ma.array(np.asarray(series)[inds], mask = np.logical_or(mask[inds], missing))
+    new_times = np.asarray(d["times"])[inds]
+    if missing.any():
+        new_times[missing] = None if new_times.dtype == object else np.datetime64("NaT")
+    return pers, new_times
+
+def gen_peaks(d, num_peaks = 3):
+    """A generatore that yields the index of the highest peaks (from the lowest to the highest of them).
+       
+    Parameters:
+    d -- The building record.
+    num_peaks -- The number of peaks to be yielded.
+    """
+    kwhs, kwhs_oriflag   = d["kwhs"]
+    
+    inds = top_k_inds(kwhs, num_peaks)[::-1]
+    for ind in inds:
+        yield ind
+
+
+def gen_holidays(d):
+    """A generator that yields federal holidays in the timeframe of the building record d (in chronological order)."""
+    cal   = get_calendar(d)
+    mymap = {}
+    for year in range(cal.year[0], cal.year[-1] + 1):
+        mymap.update((np.datetime64(date, "D"), name) for name, date in yfhol(year).items())
+
+    is_midnight = (lambda c: c.hour == 0)
+    days        = period_inds(d, 24, is_midnight)
+    starts      = cal.date[days[:, 0]]
+    for day in np.flatnonzero(np.in1d(starts, mymap.keys())):
+        yield (days[day, 0], days[day, -1]), mymap[starts[day]]
+
+def gen_strange_pers(d, num_pers = 3, period = "day"):
+    """A generator which yields the strangest period (day or week).
+
+    Parameters:
+    d -- The building record.
+    num_pers -- The number of periods to be yieled (one at a time).
+    period -- A string, either "day" or "week".
+    """
+    if period == "day":
+        first_pred = (lambda c: c.hour == 0)
+    elif period == "week":
+        first_pred = (lambda c: (c.weekday == 0) & (c.hour == 0))
+    else:
+        print "period must be 'day' or 'week'."
+        return
+    num_per_period = 24 if period == "day" else 168
+    pers, new_times = get_periods(d, num_per_period, first_pred, "kwhs")
+    inds_of_pers    = period_inds(d, num_per_period, first_pred)
+
+    avg_per         = np.average(pers, axis=0)
+    weirdness       = []
+    totals          = []
+    
+    standardize = True
+    if standardize:
+        avg_per = avg_per - np.min(avg_per)
+        avg_per = avg_per / np.max(avg_per)
+
+    for per in pers:
+        if standardize:
+            per = per - np.min(per)
+            per = per / np.max(per)
+
+        dist = np.average(np.abs(per - avg_per))        
+        weirdness.append(dist)
+    inds = top_k_inds(np.array(weirdness), num_pers)
+    for ind in inds:
+        yield inds_of_pers[ind, 0], inds_of_pers[ind, -1]
+
+def forward_fill(vals, oriflag):
+    """Replace non-original values with the last original one (like utils.interp), vectorized."""
+    inds = np.where(oriflag, np.arange(len(vals)), 0)
+    np.maximum.accumulate(inds, out = inds)
+    filled = vals[inds]
+    if not oriflag[0]:
+        first = np.argmax(oriflag) if oriflag.any() else 0
+        filled[:first] = vals[first]
+    return filled
+
+def find_runs(mask):
+    """Find the runs of True values in a boolean mask.
+
+    Parameters:
+    mask -- A 1-d boolean array, or a 2-d one (runs are found within each row).
+
+    Returns (starts, ends) for a 1-d mask, or (rows, starts, ends) for a 2-d mask,
+    where each run covers the indices starts[i] <= ind < ends[i].
+    """
+    mask = np.asarray(mask, dtype = bool)
+    if mask.ndim == 1:
+        rows, starts, ends = find_runs(mask[np.newaxis, :])
+        return starts, ends
+    pad    = np.zeros((mask.shape[0], 1), dtype = np.int8)
+    edges  = np.diff(np.hstack([pad, mask.astype(np.int8), pad]), axis = 1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends      = np.nonzero(edges == -1) #in the same (row-major) order, so they pair up with starts
+    return rows, starts, ends
+
+def get_excursions(vals, thresh):
+    """Find every excursion of vals above thresh.
+
+    Parameters:
+    vals -- A 1-d array of values (e.g., kwhs), or a 2-d array with one building per row.
+    thresh -- The threshold (a scalar, or one threshold per row).
+
+    Returns a dictionary of arrays, one entry per excursion:
+        row      -- The row of the excursion (only for 2-d vals).
+        start    -- The index of the first value above thresh.
+        end      -- One past the index of the last value above thresh.
+        duration -- The number of values above thresh (end - start).
+        peak     -- The highest value of the excursion.
+        peak_ind -- The index of the highest value.
+        energy   -- The sum of the values above thresh, minus thresh (i.e., the energy above the threshold).
+    """
+    vals   = np.asarray(vals, dtype = float)
+    one_d  = vals.ndim == 1
+    vals2  = vals[np.newaxis, :] if one_d else vals
+    thresh = np.asarray(thresh, dtype = float).reshape(-1, 1)
+    nrows, ncols = vals2.shape
+
+    above = vals2 > thresh
+    rows, starts, ends = find_runs(above)
+
+    #energy: a cumulative sum of the excess over the threshold, differenced at the run edges
+    excess  = np.where(above, vals2 - thresh, 0)
+    cumexc  = np.hstack([np.zeros((nrows, 1)), np.cumsum(excess, axis = 1)])
+    energy  = cumexc[rows, ends] - cumexc[rows, starts]
+
+    #peaks: gather the values of all runs (one after the other), and reduce over each run
+    durations = ends - starts
+    if len(starts):
+        flat      = vals2.ravel()
+        offsets   = np.cumsum(durations) - durations #where each run starts in the gathered values
+        elems     = np.arange(np.sum(durations)) - np.repeat(offsets, durations) \
+                    + np.repeat(rows * ncols + starts, durations)
+        peaks     = np.maximum.reduceat(flat[elems], offsets)
+        #index of the peak: the first value in the run reaching it
+        cands     = np.where(flat[elems] == np.repeat(peaks, durations), elems, len(flat))
+        peak_ind  = np.minimum.reduceat(cands, offsets) - rows * ncols
+    else:
+        peaks     = np.zeros(0)
+        peak_ind  = np.zeros(0, dtype = int)
+
+    toR = {"start"   : starts,
+           "end"     : ends,
+           "duration": durations,
+           "peak"    : peaks,
+           "peak_ind": peak_ind,
+           "energy"  : energy}
+    if not one_d:
+        toR["row"] = rows
+    return toR
+
+def gen_over_thresh(d, thresh):
+    """A generatore that yields the times where the energy usage was above some threshold.
+    
+    Parameters:
+    d -- The building record.
+    thresh -- The threshold.
+
+    Yields a pair of indices -- the times on either side of the point which crosses the threshold. 
+    (12 hours on either side).
+    """
+    kwhs, kwhs_oriflag   = d["kwhs"]
+    ex = get_excursions(kwhs, thresh)
+
+    for start, end in zip(ex["start"], ex["end"]):
+        ls = max(0, start - 1) #just before crossing the threshold
+        rs = end - 1           #the last time above the threshold
+        new_left_side  = max(0, ls - 12)
+        new_right_side = min(len(kwhs)-1, rs + 12)
+
+        yield new_left_side, new_right_side
+
+def masked_percentile(vals, mask, q, axis = -1):
+    """Return the q-th percentile of vals along axis, using only the values where mask is True.
+    Percentiles are linearly interpolated (as in np.percentile); they are nan where no value is used.
+
+    Parameters:
+    vals -- An array of values.
+    mask -- A boolean array (of the same shape as vals); True for the values to use.
+    q -- The percentile (between 0 and 100).
+    axis -- The axis along which the percentile is computed.
+    """
+    vals   = np.rollaxis(np.where(mask, vals, np.inf), axis, np.ndim(vals))
+    shape  = vals.shape[:-1]
+    srt    = np.sort(vals.reshape(-1, vals.shape[-1]), axis = 1)
+    counts = np.sum(np.isfinite(srt), axis = 1)
+    pos    = np.maximum(counts - 1, 0) * (q / 100.0)
+    lo     = np.floor(pos).astype(int)
+    hi     = np.minimum(lo + 1, np.maximum(counts - 1, 0))
+    rows   = np.arange(srt.shape[0])
+    alpha  = pos - lo
+    with np.errstate(invalid = "ignore"):
+        toR = (1 - alpha) * srt[rows, lo] + alpha * srt[rows, hi]
+    toR[counts == 0] = np.nan
+    return toR.reshape(shape)
+
+def scan_excursions(matrix, oriflags = None, q = 99, thresholds = None):
+    """Find every excursion above each building's threshold, for a whole portfolio at once.
+
+    Parameters:
+    matrix -- A buildings x hours array of kwhs.
+    oriflags -- An array of the same shape; True for original values (only these set the thresholds).
+    q -- The percentile used as the threshold of each building (e.g., 99 for its top 1%).
+    thresholds -- One threshold per building (overrides q).
+
+    Returns (excursions, thresholds), where excursions is as in get_excursions (with a row entry).
+    """
+    matrix = np.asarray(matrix, dtype = float)
+    if thresholds is None:
+        if oriflags is None:
+            oriflags = np.ones(matrix.shape, dtype = bool)
+        thresholds = masked_percentile(matrix, oriflags, q, axis = 1)
+    return get_excursions(matrix, thresholds), thresholds
+
+def get_times_of_highest_change(d, num_times, direction = "increase"):
+    """Returns the indices where the highest increase in electricity usage occured.
+    Note the indices returned are for just before the spikes occured (as opposed to just after).
+
+    Parameters:
+    d -- The building record.
+    num_times -- The number of times to be returned.
+    direction -- Either "increase" (default) or "decrease"
+    """
+    kwhs, kwhs_oriflag = d["kwhs"]
+    first_deriv = kwhs[1:] - kwhs[:-1]
+
+    if direction == "increase":
+        inds = top_k_inds(first_deriv, num_times)
+    else:
+        inds = top_k_inds(-first_deriv, num_times)
+
+    return inds
+
+def top_k_inds(vals, k):
+    """Returns the indices of the k largest values (largest first), without sorting all the values."""
+    vals = np.asarray(vals)
+    k    = min(k, len(vals))
+    if k <= 0:
+        return np.zeros(0, dtype = int)
+    inds = np.argpartition(vals, len(vals) - k)[len(vals) - k:]
+    return inds[np.argsort(vals[inds])[::-1]]
@@ -0,0 +1,239 @@
+"""A compressed, chunked archive of building records for cold storage, with partial reads by time range.
+
+Each building is one file. The time axis and the series (kwhs, temps and their oriflags) are cut into
+chunks of one local calendar month. Each chunk is compressed (zlib, bz2, or lzma when available)
+and checksummed (CRC-32 of the uncompressed bytes). The chunk index (with the other fields of the record)
+is at the end of the file, so reading a date range only decompresses the chunks that overlap it.
+Reading a whole record gives back exactly the record that was archived.
+
+File layout:
+    magic | chunk | chunk | ... | index (zlib-compressed pickle) | index offset, index CRC-32 | magic
+
+Example:
+    arc = Archive(data_loc + "archive")
+    arc.put(d)
+    q4  = arc.get(d["bid"], start = datetime(2012, 10, 1, tzinfo = pytz.utc), end = datetime(2013, 1, 1, tzinfo = pytz.utc))
+"""
+import  os
+import  bz2
+import  zlib
+import  struct
+import  tempfile
+import  cPickle as pickle
+import  numpy as np
+
+import  timeaxis as ta
+from    record_store import RecordStore
+try:
+    import  lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+magic   = "EWARC1\n"
+trailer = struct.Struct("<QI") #index offset, index CRC-32
+
+codecs = {"none": (lambda data, level: data, lambda data: data),
+          "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+          "bz2" : (lambda data, level: bz2.compress(data, level), bz2.decompress)}
+if lzma is not None:
+    codecs["lzma"] = (lambda data, level: lzma.compress(data, preset = level), lzma.decompress)
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def _is_series(v, num_obs):
+    return (isinstance(v, (tuple, list)) and len(v) == 2 and
+            all(isinstance(a, np.ndarray) and a.shape == (num_obs,) for a in v))
+
+def _encode(arrays):
+    """The bytes of a list of arrays, and their (dtype, shape, number of bytes). Object arrays are pickled.
+    The bytes of numeric arrays are shuffled (all first bytes, then all second bytes, ...), which makes
+    series of floats compress much better."""
+    parts = []
+    specs = []
+    for arr in arrays:
+        if arr.dtype == object:
+            data = pickle.dumps(arr, pickle.HIGHEST_PROTOCOL)
+        else:
+            arr  = np.ascontiguousarray(arr)
+            data = arr.view(np.uint8).reshape(-1, arr.dtype.itemsize).T.tostring()
+        parts.append(data)
+        specs.append((arr.dtype.str if arr.dtype != object else "object", arr.shape, len(data)))
+    return "".join(parts), specs
+
+def _decode(data, specs):
+    arrays = []
+    offset = 0
+    for dtype, shape, nbytes in specs:
+        part = data[offset:offset + nbytes]
+        if dtype == "object":
+            arrays.append(pickle.loads(part))
+        else:
+            dtype = np.dtype(dtype)
+            raw   = np.frombuffer(part, dtype = np.uint8).reshape(dtype.itemsize, -1).T
+            arrays.append(np.ascontiguousarray(raw).view(dtype).reshape(shape))
+        offset += nbytes
+    return arrays
+
+def month_bounds(d):
+    """The (start, stop) indices of the local calendar months of a building record."""
+    cal    = ta.get_calendar(d)
+    months = cal.year.astype(int) * 12 + cal.month
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(months)) + 1]) if len(months) else np.zeros(0, dtype = int)
+    stops  = np.concatenate([starts[1:], [len(months)]]) if len(months) else starts
+    return zip(starts, stops)
+
+def write_record(d, fname, codec = "zlib", level = 6):
+    """Write building record d to an archive file (see the module docstring).
+
+    Parameters:
+    d -- The building record.
+    fname -- The file name.
+    codec -- "zlib", "bz2", "lzma" (if the lzma module is available) or "none".
+    level -- The compression level (1 to 9).
+    """
+    if codec not in codecs:
+        raise ValueError("Unknown codec: %s (available: %s)" % (codec, ", ".join(sorted(codecs))))
+    compress = codecs[codec][0]
+    times    = np.asarray(d["times"])
+    num_obs  = len(times)
+    series   = sorted(k for k, v in d.items() if k != "times" and _is_series(v, num_obs))
+    meta     = dict((k, v) for k, v in d.items() if k != "times" and k not in series)
+    epochs   = ta.utc_epochs(d)
+    chunks   = []
+    with open(fname, "wb") as fout:
+        fout.write(magic)
+        for start, stop in month_bounds(d):
+            arrays = [times[start:stop]]
+            for k in series:
+                arrays.extend(a[start:stop] for a in d[k])
+            data, specs = _encode(arrays)
+            blob = compress(data, level)
+            chunks.append({"start": int(start), "stop": int(stop), "first": int(epochs[start]), "last": int(epochs[stop - 1]),
+                           "offset": fout.tell(), "length": len(blob), "crc": _crc(data), "specs": specs})
+            fout.write(blob)
+        index = {"meta": meta, "series": [(k, type(d[k])) for k in series], "num_obs": num_obs,
+                 "times_dtype": times.dtype.str if times.dtype != object else "object",
+                 "codec": codec, "chunks": chunks}
+        offset = fout.tell()
+        data   = zlib.compress(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+        fout.write(data)
+        fout.write(trailer.pack(offset, _crc(data)))
+        fout.write(magic)
+
+def read_index(fname):
+    """The chunk index of an archive file (IOError if the file is damaged)."""
+    with open(fname, "rb") as fin:
+        return _read_index(fin)
+
+def _read_index(fin):
+    if fin.read(len(magic)) != magic:
+        raise IOError("Not an archive file: %s" % fin.name)
+    fin.seek(-(trailer.size + len(magic)), os.SEEK_END)
+    end    = fin.tell()
+    offset, crc = trailer.unpack(fin.read(trailer.size))
+    if fin.read(len(magic)) != magic:
+        raise IOError("Truncated archive file: %s" % fin.name)
+    fin.seek(offset)
+    data = fin.read(end - offset)
+    if _crc(data) != crc:
+        raise IOError("Damaged archive index: %s" % fin.name)
+    return pickle.loads(zlib.decompress(data))
+
+def read_record(fname, start = None, end = None):
+    """Read a building record from an archive file, whole or only the times in [start, end).
+    start and end are datetimes (naive ones are taken to be UTC), datetime64s or seconds since the epoch.
+    Only the chunks overlapping the range are read and decompressed. IOError if a chunk's checksum fails."""
+    lo = None if start is None else ta.to_epoch(start)
+    hi = None if end is None else ta.to_epoch(end)
+    with open(fname, "rb") as fin:
+        index = _read_index(fin)
+        decompress = codecs[index["codec"]][1]
+        parts = []
+        for chunk in index["chunks"]:
+            if (lo is not None and chunk["last"] < lo) or (hi is not None and chunk["first"] >= hi):
+                continue
+            fin.seek(chunk["offset"])
+            try:
+                data = decompress(fin.read(chunk["length"]))
+            except Exception:
+                data = None
+            if data is None or _crc(data) != chunk["crc"]:
+                raise IOError("Damaged chunk at offset %d of %s" % (chunk["offset"], fname))
+            parts.append(_decode(data, chunk["specs"]))
+
+    d = dict(index["meta"])
+    if parts:
+        arrays = [np.concatenate([p[i] for p in parts]) for i in range(len(parts[0]))]
+    else:
+        times_dtype = object if index["times_dtype"] == "object" else index["times_dtype"]
+        arrays = [np.zeros(0, dtype = times_dtype)] + [None] * (2 * len(index["series"]))
+    d["times"] = arrays[0]
+    for i, (k, container) in enumerate(index["series"]):
+        vals, oriflag = arrays[1 + 2 * i], arrays[2 + 2 * i]
+        if vals is None:
+            vals, oriflag = np.zeros(0), np.zeros(0, dtype = bool)
+        d[k] = container((vals, oriflag))
+
+    if lo is not None or hi is not None: #trim the first and last chunks to the range
+        epochs = ta.utc_epochs(d)
+        keep   = np.ones(len(epochs), dtype = bool)
+        if lo is not None:
+            keep &= epochs >= lo
+        if hi is not None:
+            keep &= epochs < hi
+        if not keep.all():
+            d["times"] = d["times"][keep]
+            for k, container in index["series"]:
+                d[k] = container(a[keep] for a in d[k])
+    return d
+
+class Archive(RecordStore):
+    """A directory of archived building records, indexed by bid (a RecordStore of archive files).
+
+    Parameters:
+    path -- The directory (created if it does not exist).
+    codec, level -- The compression of the records put in the archive (see write_record).
+    """
+    ext = ".arc"
+
+    def __init__(self, path, codec = "zlib", level = 6):
+        RecordStore.__init__(self, path)
+        self.codec = codec
+        self.level = level
+
+    def put(self, d):
+        """Archive the building record d (replacing any record with the same bid)."""
+        fd, tmpn = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        os.close(fd)
+        try:
+            write_record(d, tmpn, self.codec, self.level)
+            os.rename(tmpn, self._fname(d["bid"]))
+        except:
+            os.remove(tmpn)
+            raise
+
+    def get(self, bid, start = None, end = None):
+        """Read the building record of bid (KeyError if there is none), whole or only the times in [start, end)."""
+        fname = self._fname(bid)
+        if not os.path.exists(fname):
+            raise KeyError(bid)
+        return read_record(fname, start, end)
+
+    def index(self, bid):
+        """The chunk index of the record of bid."""
+        return read_index(self._fname(bid))
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        print "Usage: python archive.py <record store dir> <archive dir> [zlib|bz2|lzma]"
+        exit()
+    store = RecordStore(sys.argv[1])
+    arc   = Archive(sys.argv[2], *sys.argv[3:4])
+    for d in store:
+        arc.put(d)
+    print "Archived", len(arc), "records into", arc.path
@@ -0,0 +1,250 @@
+"""Weather-normalized baselines: change-point models of daily energy use vs outdoor temperature.
+
+Models (T is the mean outdoor temperature of a day, x+ is max(x, 0)):
+    "3pc" -- 3-parameter cooling: energy = intercept + cooling_slope * (T - cooling_balance)+
+    "3ph" -- 3-parameter heating: energy = intercept + heating_slope * (heating_balance - T)+
+    "5p"  -- 5-parameter:         energy = intercept + heating_slope * (heating_balance - T)+
+                                                     + cooling_slope * (T - cooling_balance)+
+
+Balance points are found by grid search. Every candidate (pair) is fit at once for a whole batch of
+buildings, from weighted sums over a (buildings x days x candidates) array, and the best fit of each
+building is picked with an argmin. Only NumPy is needed.
+
+Example:
+    bids, energy, temps, weights = daily_matrices(brecs)
+    fits = fit_models(energy, temps, weights)
+    baselines = predict_best(fits, temps) #one row of daily baseline energy per building
+"""
+import  numpy as np
+import  analytics as an
+
+models                 = ["3pc", "3ph", "5p"]
+num_params             = {"3pc": 3, "3ph": 3, "5p": 5}
+default_balance_points = np.arange(40, 86, 1.0) #in F
+
+is_midnight = (lambda c: c.hour == 0)
+
+def daily_data(d, min_coverage = 0.75):
+    """The daily data of a building record.
+
+    Parameters:
+    d -- The building record (hourly).
+    min_coverage -- The fraction of original kwhs and temps a day needs to be used in fits.
+
+    Returns (energy, temps, weights): the energy use (kwh per day, from the original readings),
+    mean temperature and weight (1.0 for days with enough original readings, 0.0 otherwise) of each day.
+    """
+    days, _  = an.get_periods(d, 24, is_midnight)
+    temps, _ = an.get_periods(d, 24, is_midnight, which = "temps")
+    ok       = np.logical_and(1 - np.ma.getmaskarray(days).mean(axis = 1)  >= min_coverage,
+                              1 - np.ma.getmaskarray(temps).mean(axis = 1) >= min_coverage)
+    energy   = np.ma.average(days, axis = 1).filled(0) * 24
+    temps    = np.ma.average(temps, axis = 1).filled(0)
+    return np.where(ok, energy, 0), np.where(ok, temps, 0), ok.astype(float)
+
+def daily_matrices(brecs, min_coverage = 0.75):
+    """The daily data (see daily_data) of many buildings, as (buildings x days) matrices.
+    Shorter records are padded with days of weight 0. Returns (bids, energy, temps, weights)."""
+    bids  = []
+    rows  = []
+    for d in brecs:
+        bids.append(d["bid"])
+        rows.append(daily_data(d, min_coverage))
+    num_days = max(len(r[0]) for r in rows) if rows else 0
+    mats     = np.zeros((3, len(rows), num_days))
+    for i, row in enumerate(rows):
+        for m, vals in zip(mats, row):
+            m[i, :len(vals)] = vals
+    energy, temps, weights = mats
+    return bids, energy, temps, weights
+
+def _hinges(temps, balance_points, kind):
+    """(buildings x days x candidates) array of (T - b)+ for cooling, (b - T)+ for heating."""
+    if kind == "cooling":
+        return np.maximum(temps[:, :, np.newaxis] - balance_points, 0)
+    return np.maximum(balance_points - temps[:, :, np.newaxis], 0)
+
+def _prepare(energy, temps, weights):
+    energy  = np.atleast_2d(np.asarray(energy, dtype = float))
+    temps   = np.atleast_2d(np.asarray(temps, dtype = float))
+    if weights is None:
+        weights = np.isfinite(energy) & np.isfinite(temps)
+    weights = np.atleast_2d(np.asarray(weights, dtype = float))
+    weights = np.where(np.isfinite(energy) & np.isfinite(temps), weights, 0)
+    return np.where(weights > 0, energy, 0), np.where(weights > 0, temps, 0), weights
+
+def _quality(fit, sse, n, vyy, ymean, p):
+    """Add the fit-quality statistics (with nan where no model could be fit)."""
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        fit["sse"]    = sse
+        fit["n"]      = n
+        fit["r2"]     = 1 - sse / vyy
+        fit["cvrmse"] = np.sqrt(sse / (n - p)) / ymean #the coefficient of variation of the RMSE (ASHRAE Guideline 14)
+
+def fit_3p(energy, temps, weights = None, kind = "cooling", balance_points = None, min_days = 10, chunk = 256):
+    """Fit 3-parameter change-point models, for many buildings at once.
+
+    Parameters:
+    energy, temps -- (buildings x days) matrices of daily energy use and mean temperature
+                     (1-d arrays are taken to be one building).
+    weights -- A (buildings x days) matrix of weights (e.g., 0 for days which must be ignored);
+               by default every day with finite values has weight 1.
+    kind -- "cooling" (energy increases above the balance point) or "heating" (it increases below it).
+    balance_points -- The candidate balance points (defaults to 40F to 85F, by 1F).
+    min_days -- The minimum number of days beyond a balance point (for it to be a candidate).
+    chunk -- The number of buildings fit at a time (this bounds the memory used).
+
+    Returns a fit, a dictionary of arrays (one entry per building) with the "intercept", the slope
+    ("cooling_slope" or "heating_slope") and the balance point ("cooling_balance" or "heating_balance"),
+    plus "sse", "n" (number of days used), "r2" and "cvrmse". Buildings with no valid fit get nans.
+    """
+    energy, temps, weights = _prepare(energy, temps, weights)
+    bps     = default_balance_points if balance_points is None else np.asarray(balance_points, dtype = float)
+    num     = len(energy)
+    results = dict((name, np.empty(num)) for name in ["intercept", "slope", "balance", "sse", "n", "vyy", "ymean"])
+    for start in range(0, num, chunk):
+        y, t, w = energy[start:start + chunk], temps[start:start + chunk], weights[start:start + chunk]
+        sw      = w.sum(axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            ymean = (w * y).sum(axis = 1) / sw
+        yc      = np.where(w > 0, y - ymean[:, np.newaxis], 0) #centered, for accurate sums of squares
+        x       = _hinges(t, bps, kind)
+        wx      = w[:, :, np.newaxis] * x
+        sx      = wx.sum(axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            vxx = (wx * x).sum(axis = 1) - sx**2 / sw[:, np.newaxis]
+            vxy = (wx * yc[:, :, np.newaxis]).sum(axis = 1)
+            vyy = (w * yc**2).sum(axis = 1)
+            slope = vxy / vxx
+            sse   = vyy[:, np.newaxis] - slope * vxy
+            days_beyond = (w[:, :, np.newaxis] * (x > 0)).sum(axis = 1)
+            valid = (vxx > 1e-9) & (slope >= 0) & (days_beyond >= min_days)
+        sse   = np.where(valid, sse, np.inf)
+        best  = np.argmin(sse, axis = 1)
+        rows  = np.arange(len(y))
+        found = valid[rows, best]
+        sl    = np.where(found, slope[rows, best], np.nan)
+        res   = results
+        res["slope"][start:start + chunk]     = sl
+        res["balance"][start:start + chunk]   = np.where(found, bps[best], np.nan)
+        res["intercept"][start:start + chunk] = np.where(found, ymean - sl * sx[rows, best] / sw, np.nan)
+        res["sse"][start:start + chunk]       = np.where(found, sse[rows, best], np.nan)
+        res["n"][start:start + chunk]         = sw
+        res["vyy"][start:start + chunk]       = vyy
+        res["ymean"][start:start + chunk]     = ymean
+
+    fit = {"model"          : "3pc" if kind == "cooling" else "3ph",
+           "intercept"      : results["intercept"],
+           kind + "_slope"  : results["slope"],
+           kind + "_balance": results["balance"]}
+    _quality(fit, results["sse"], results["n"], results["vyy"], results["ymean"], num_params[fit["model"]])
+    return fit
+
+def fit_5p(energy, temps, weights = None, balance_points = None, min_days = 10, chunk = 128):
+    """Fit 5-parameter change-point models (heating and cooling slopes), for many buildings at once.
+    Every pair of candidate balance points (heating_balance <= cooling_balance) is tried.
+
+    Parameters: as in fit_3p.
+
+    Returns a fit, a dictionary of arrays (one entry per building) with the "intercept", "heating_slope",
+    "heating_balance", "cooling_slope", "cooling_balance", "sse", "n", "r2" and "cvrmse".
+    """
+    energy, temps, weights = _prepare(energy, temps, weights)
+    bps     = default_balance_points if balance_points is None else np.asarray(balance_points, dtype = float)
+    num     = len(energy)
+    k       = len(bps)
+    names   = ["intercept", "heating_slope", "heating_balance", "cooling_slope", "cooling_balance", "sse", "n", "vyy", "ymean"]
+    results = dict((name, np.empty(num)) for name in names)
+    ordered = bps[:, np.newaxis] <= bps[np.newaxis, :] #heating balance point (row) <= cooling balance point (column)
+    for start in range(0, num, chunk):
+        y, t, w = energy[start:start + chunk], temps[start:start + chunk], weights[start:start + chunk]
+        sw      = w.sum(axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            ymean = (w * y).sum(axis = 1) / sw
+        yc      = np.where(w > 0, y - ymean[:, np.newaxis], 0)
+        h       = _hinges(t, bps, "heating")
+        c       = _hinges(t, bps, "cooling")
+        wh      = w[:, :, np.newaxis] * h
+        wc      = w[:, :, np.newaxis] * c
+        sh, sc  = wh.sum(axis = 1), wc.sum(axis = 1)
+        swn     = sw[:, np.newaxis]
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            #(co)variances, so the intercept drops out and each candidate pair is a 2x2 system
+            vhh = (wh * h).sum(axis = 1) - sh**2 / swn
+            vcc = (wc * c).sum(axis = 1) - sc**2 / swn
+            vhy = (wh * yc[:, :, np.newaxis]).sum(axis = 1)
+            vcy = (wc * yc[:, :, np.newaxis]).sum(axis = 1)
+            vyy = (w * yc**2).sum(axis = 1)
+            vhc = np.matmul(wh.transpose(0, 2, 1), c) - sh[:, :, np.newaxis] * sc[:, np.newaxis, :] / swn[:, :, np.newaxis]
+            vhh, vhy = vhh[:, :, np.newaxis], vhy[:, :, np.newaxis]
+            vcc, vcy = vcc[:, np.newaxis, :], vcy[:, np.newaxis, :]
+            det  = vhh * vcc - vhc**2
+            hsl  = (vcc * vhy - vhc * vcy) / det
+            csl  = (vhh * vcy - vhc * vhy) / det
+            sse  = vyy[:, np.newaxis, np.newaxis] - hsl * vhy - csl * vcy
+            h_days = (w[:, :, np.newaxis] * (h > 0)).sum(axis = 1)
+            c_days = (w[:, :, np.newaxis] * (c > 0)).sum(axis = 1)
+            valid  = (ordered & (det > 1e-9 * np.maximum(vhh * vcc, 1)) & (hsl >= 0) & (csl >= 0) &
+                      (h_days[:, :, np.newaxis] >= min_days) & (c_days[:, np.newaxis, :] >= min_days))
+        sse    = np.where(valid, sse, np.inf).reshape(len(y), k * k)
+        best   = np.argmin(sse, axis = 1)
+        rows   = np.arange(len(y))
+        bh, bc = best // k, best % k
+        found  = valid[rows, bh, bc]
+        hs     = np.where(found, hsl[rows, bh, bc], np.nan)
+        cs     = np.where(found, csl[rows, bh, bc], np.nan)
+        res    = results
+        res["heating_slope"][start:start + chunk]   = hs
+        res["cooling_slope"][start:start + chunk]   = cs
+        res["heating_balance"][start:start + chunk] = np.where(found, bps[bh], np.nan)
+        res["cooling_balance"][start:start + chunk] = np.where(found, bps[bc], np.nan)
+        res["intercept"][start:start + chunk]       = ymean - (hs * sh[rows, bh] + cs * sc[rows, bc]) / sw
+        res["sse"][start:start + chunk]             = np.where(found, sse[rows, best], np.nan)
+        res["n"][start:start + chunk]               = sw
+        res["vyy"][start:start + chunk]             = vyy
+        res["ymean"][start:start + chunk]           = ymean
+
+    fit = dict((name, results[name]) for name in names[:5])
+    fit["model"] = "5p"
+    _quality(fit, results["sse"], results["n"], results["vyy"], results["ymean"], num_params["5p"])
+    return fit
+
+def fit_models(energy, temps, weights = None, balance_points = None, min_days = 10):
+    """Fit all the models (see fit_3p and fit_5p).
+    Returns a dictionary mapping each model name to its fit, plus "best": the name of the model
+    with the lowest CV(RMSE) for each building (None where no model could be fit)."""
+    fits = {"3pc": fit_3p(energy, temps, weights, "cooling", balance_points, min_days),
+            "3ph": fit_3p(energy, temps, weights, "heating", balance_points, min_days),
+            "5p" : fit_5p(energy, temps, weights, balance_points, min_days)}
+    cvs  = np.array([fits[m]["cvrmse"] for m in models])
+    cvs  = np.where(np.isnan(cvs), np.inf, cvs)
+    best = np.argmin(cvs, axis = 0)
+    fits["best"] = np.array([models[b] if np.isfinite(cvs[b, i]) else None for i, b in enumerate(best)], dtype = object)
+    return fits
+
+def predict(fit, temps):
+    """The baseline (predicted daily energy use) of a fit at the given temperatures.
+
+    Parameters:
+    fit -- A fit, as returned by fit_3p or fit_5p.
+    temps -- A (buildings x days) matrix of daily mean temperatures (or a 1-d array, for a fit of one building).
+    """
+    temps = np.atleast_2d(np.asarray(temps, dtype = float))
+    col   = (lambda name: fit[name][:, np.newaxis])
+    toR   = col("intercept") + np.zeros(temps.shape)
+    if "heating_slope" in fit:
+        toR = toR + col("heating_slope") * np.maximum(col("heating_balance") - temps, 0)
+    if "cooling_slope" in fit:
+        toR = toR + col("cooling_slope") * np.maximum(temps - col("cooling_balance"), 0)
+    return toR
+
+def predict_best(fits, temps):
+    """The baseline of each building, from its best model (see fit_models); nan where there is none."""
+    temps = np.atleast_2d(np.asarray(temps, dtype = float))
+    toR   = np.empty(temps.shape)
+    toR.fill(np.nan)
+    for m in models:
+        rows = fits["best"] == m
+        if rows.any():
+            toR[rows] = predict(fits[m], temps)[rows]
+    return toR
@@ -0,0 +1,124 @@
+"""Rolling baseload (phantom load): the lowest use of a building in a sliding window of days, and how it drifts.
+
+The baseload of a day is the minimum (or a low percentile, e.g. the 5th, which ignores a few odd readings)
+of the original kwhs of the window of days ending on it, so equipment left on shows up as the baseload
+stepping up, and a retrofit as it stepping down. The days are local days (see analytics.period_inds).
+
+Rolling minima use the van Herk / Gil-Werman algorithm: the series is cut into blocks as long as the window,
+and the minimum of a window is the smaller of a suffix minimum of one block and a prefix minimum of the next.
+Both are running minima (np.minimum.accumulate), so the cost is O(n) whatever the window, and it works along
+the last axis of any array (one building, or a buildings x days matrix). Rolling percentiles sort strided views
+of the windows (see stft.window_view), one window per day.
+
+Example:
+    dates, base = get_baseload(d, window_days = 14)
+    print baseload_features(dates, base)["baseload_trend"] #kwh per hour, per year
+"""
+import  numpy as np
+
+import  analytics as an
+import  timeaxis as ta
+from    stft import window_view
+
+default_window = 7 #days
+is_midnight    = (lambda c: c.hour == 0)
+
+def _counts(valid, window, hop):
+    """The number of valid values in each window (along the last axis)."""
+    c = np.cumsum(np.concatenate([np.zeros(valid.shape[:-1] + (1,), dtype = int), valid], axis = -1), axis = -1)
+    return (c[..., window:] - c[..., :-window])[..., ::hop]
+
+def rolling_min(vals, window, valid = None, hop = 1, min_count = 1):
+    """The minimum of each window of a series, or of each row of a matrix (along the last axis), in O(n).
+
+    Parameters:
+    vals -- The values.
+    window -- The length of the windows.
+    valid -- A boolean array of the same shape; False for values to leave out (e.g., imputed ones). Nans are left out.
+    hop -- The number of values between the starts of the windows.
+    min_count -- Windows with fewer valid values have a nan minimum.
+
+    Returns an array with one value per window along the last axis: window j covers vals[..., j * hop:j * hop + window].
+    """
+    vals  = np.asarray(vals, dtype = float)
+    valid = ~np.isnan(vals) if valid is None else np.logical_and(valid, ~np.isnan(vals))
+    n     = vals.shape[-1]
+    if window > n:
+        return np.zeros(vals.shape[:-1] + (0,))
+    lead  = vals.shape[:-1]
+    x     = np.where(valid, vals, np.inf)
+    x     = np.concatenate([x, np.zeros(lead + (-n % window,)) + np.inf], axis = -1)
+    blocks = x.reshape(lead + (-1, window))
+    prefix = np.minimum.accumulate(blocks, axis = -1).reshape(x.shape)
+    suffix = np.minimum.accumulate(blocks[..., ::-1], axis = -1)[..., ::-1].reshape(x.shape)
+    mins   = np.minimum(suffix[..., :n - window + 1:hop], prefix[..., window - 1:n:hop])
+    return np.where(_counts(valid, window, hop) >= max(min_count, 1), mins, np.nan)
+
+def rolling_percentile(vals, window, q, valid = None, hop = 1, min_count = 1):
+    """The q-th percentile of each window (see rolling_min for the parameters and the result).
+    It sorts each window, so it costs O(n window log window / hop): use a hop for long windows."""
+    vals  = np.asarray(vals, dtype = float)
+    valid = ~np.isnan(vals) if valid is None else np.logical_and(valid, ~np.isnan(vals))
+    if window > vals.shape[-1]:
+        return np.zeros(vals.shape[:-1] + (0,))
+    pcts  = an.masked_percentile(window_view(vals, window, hop), window_view(valid, window, hop), q)
+    return np.where(_counts(valid, window, hop) >= max(min_count, 1), pcts, np.nan)
+
+def daily_baseload(days, valid, window_days = default_window, q = None, min_hours = 24):
+    """The baseload of each day: the minimum (or q-th percentile) of the valid kwhs of the window of days ending on it.
+
+    Parameters:
+    days -- (..., days x hours) kwhs, e.g. the days of one building or a buildings x days x 24 array.
+    valid -- A boolean array of the same shape.
+    window_days -- The length of the window, in days.
+    q -- A percentile (e.g., 5) to use instead of the minimum.
+    min_hours -- Windows with fewer valid hours have a nan baseload.
+
+    Returns (..., days) baseloads (nan for the first window_days - 1 days).
+    """
+    days  = np.asarray(days, dtype = float)
+    valid = np.asarray(valid, dtype = bool)
+    lead, (num_days, hours) = days.shape[:-2], days.shape[-2:]
+    if q is None: #the minimum of the daily minima
+        day_min = np.min(np.where(valid, days, np.inf), axis = -1)
+        base    = rolling_min(day_min, window_days, np.any(valid, axis = -1))
+        base    = np.where(_counts(valid.reshape(lead + (-1,)), window_days * hours, hours) >= min_hours, base, np.nan)
+    else:
+        base    = rolling_percentile(days.reshape(lead + (-1,)), window_days * hours, q,
+                                     valid.reshape(lead + (-1,)), hours, min_hours)
+    pad = np.zeros(lead + (min(window_days - 1, num_days),)) + np.nan
+    return np.concatenate([pad, base], axis = -1)
+
+def get_baseload(d, window_days = default_window, q = None, min_hours = 24):
+    """The daily rolling baseload of building record d (see daily_baseload).
+    Returns (dates, baseload): the local dates (datetime64[D]) of the days, and the baseload of each."""
+    inds  = an.period_inds(d, 24, is_midnight)
+    kwhs, kwhs_oriflag = d["kwhs"]
+    cols  = np.maximum(inds, 0)
+    valid = np.logical_and(np.asarray(kwhs_oriflag, dtype = bool)[cols], inds >= 0)
+    dates = ta.get_calendar(d).date[inds[:, 0]] if len(inds) else np.zeros(0, dtype = "datetime64[D]")
+    return dates, daily_baseload(np.asarray(kwhs, dtype = float)[cols], valid, window_days, q, min_hours)
+
+def baseload_features(dates, base, avg = None):
+    """Summary features of a daily baseload series (nan when there are too few days).
+        baseload_mean  -- The average baseload.
+        baseload_trend -- The slope of a least-squares line through the baseload, per year.
+        baseload_drift -- The average baseload of the last 30 days minus that of the first 30 days.
+        baseload_frac  -- The average baseload over the average use avg (if given): the share of the load
+                          which never turns off.
+    """
+    base  = np.asarray(base, dtype = float)
+    ok    = np.isfinite(base)
+    days  = (np.asarray(dates, dtype = "datetime64[D]").astype(np.int64))[ok]
+    vals  = base[ok]
+    toR   = dict.fromkeys(["baseload_mean", "baseload_trend", "baseload_drift", "baseload_frac"], np.nan)
+    if len(vals) == 0:
+        return toR
+    toR["baseload_mean"] = np.mean(vals)
+    if len(vals) >= 2 and days[-1] > days[0]:
+        toR["baseload_trend"] = np.polyfit(days - days[0], vals, 1)[0] * 365
+    if len(vals) >= 60:
+        toR["baseload_drift"] = np.mean(vals[-30:]) - np.mean(vals[:30])
+    if avg is not None and avg > 0:
+        toR["baseload_frac"] = toR["baseload_mean"] / avg
+    return toR
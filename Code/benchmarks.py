@@ -0,0 +1,194 @@
+"""Performance benchmarks, run on synthetic building records.
+
+Usage:
+    python benchmarks.py [--sizes 1,100,10000] [--only get_report,page:raw] [--out results.json]
+                         [--baseline old_results.json] [--tolerance 0.25]
+
+Every target is timed (wall clock, summed over the buildings) and memory-profiled
+(growth of the peak resident set size while the target runs).
+If a baseline is given, the run fails (exit code 1) when a target is slower than the
+baseline by more than the tolerance.
+"""
+import  matplotlib
+matplotlib.use('Agg')
+import  os
+import  sys
+import  json
+import  time
+import  tempfile
+import  datetime
+import  numpy as np
+import  matplotlib.pyplot as plt
+from    matplotlib.backends.backend_pdf import PdfPages
+
+import  utils
+import  synthetic
+import  report_card
+import  timeaxis as ta
+import  plotter_new as pn
+
+default_sizes = [1, 100, 10000]
+
+class quiet(object):
+    """Context manager that swallows anything printed to stdout."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, "w")
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def _setup():
+    #getSun needs a state database; use a minimal one if none was loaded
+    if not hasattr(pn, "states"):
+        pn.states = {"IL": {"capital": "Springfield", "Springfield": ("39.78", "-89.65")}}
+
+#Each per-building target takes a building record. Its running time is summed over the records.
+def _bench_get_periods(d):
+    is_midnight = (lambda c: c.hour == 0)
+    pn.get_periods(d, 24, is_midnight)
+
+def _bench_get_report(d):
+    report_card.get_report(d)
+
+def _bench_fill_in(d):
+    times              = ta.local_datetimes(d)
+    kwhs, kwhs_oriflag = d["kwhs"]
+    ts = zip(times[kwhs_oriflag], kwhs[kwhs_oriflag])
+    utils.fill_in(ts, times)
+
+def _bench_dCorr(d):
+    is_midnight  = (lambda c: c.hour == 0)
+    days, _      = pn.get_periods(d, 24, is_midnight)
+    temps, _     = pn.get_periods(d, 24, is_midnight, which = "temps")
+    utils.dCorr(np.ma.sum(days, axis = 1), np.ma.average(temps, axis = 1))
+
+def _bench_getSun(d):
+    for t in ta.utc_datetimes(d, slice(168)): #one week of sun positions
+        pn.getSun("IL", t)
+
+def _make_page_bench(name):
+    def bench(d):
+        pdf = PdfPages(os.devnull)
+        try:
+            pn.add_fig(pdf, d, name, size = (8.5, 11), fontsize = 24)
+        finally:
+            plt.close("all")
+            pdf.close()
+    return bench
+
+per_building = [("get_periods", _bench_get_periods),
+                ("get_report",  _bench_get_report),
+                ("fill_in",     _bench_fill_in),
+                ("dCorr",       _bench_dCorr),
+                ("getSun",      _bench_getSun)]
+
+pages = ["general", "avg behavior", "behavior", "raw", "outliers", "outliers2", "overthresh",
+         "spikes", "extreme days", "clustering", "cami", "holidays", "box plots", "deriv day", "spectrogram",
+         "baseload"]
+per_building += [("page:" + p, _make_page_bench(p)) for p in pages]
+
+def run_per_building(fun, num_brecs, **kwargs):
+    """Time fun over num_brecs synthetic records (record generation is not timed)."""
+    elapsed  = 0.0
+    rss_from = utils.peak_rss()
+    for d in synthetic.gen_brecs(num_brecs, **kwargs):
+        start = time.time()
+        with quiet():
+            fun(d)
+        elapsed += time.time() - start
+    return elapsed, utils.peak_rss() - rss_from
+
+def run_agg_reports(num_brecs, **kwargs):
+    """Time agg_reports over num_brecs synthetic records (records are generated lazily)."""
+    elapsed  = 0.0
+    rss_from = utils.peak_rss()
+    start    = time.time()
+    with quiet():
+        report_card.agg_reports(synthetic.gen_brecs(num_brecs, **kwargs))
+    elapsed  = time.time() - start
+    return elapsed, utils.peak_rss() - rss_from
+
+def run_benchmarks(sizes = default_sizes, only = None, **kwargs):
+    """Run the benchmarks and return a list of results (dictionaries).
+
+    Parameters:
+    sizes -- The numbers of buildings to benchmark with.
+    only -- If not None, a list with the names of the targets to run.
+    kwargs -- Passed on to synthetic.gen_brec (e.g., num_days).
+    """
+    _setup()
+    targets = per_building + [("agg_reports", None)]
+    if only is not None:
+        targets = [(name, fun) for name, fun in targets if name in only]
+
+    results = []
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp()) #agg_reports writes errs.txt in the working directory
+    try:
+        for num_brecs in sizes:
+            for name, fun in targets:
+                result = {"target": name, "num_brecs": num_brecs}
+                try:
+                    if fun is None:
+                        secs, rss = run_agg_reports(num_brecs, **kwargs)
+                    else:
+                        secs, rss = run_per_building(fun, num_brecs, **kwargs)
+                    result.update({"seconds": secs, "per_brec": secs / num_brecs, "peak_rss_delta_mb": rss})
+                except Exception as inst:
+                    result["error"] = "%s: %s" % (type(inst).__name__, inst)
+                results.append(result)
+                print_result(result)
+    finally:
+        os.chdir(cwd)
+    return results
+
+def print_result(result):
+    name = ("%s [%d]" % (result["target"], result["num_brecs"])).ljust(30)
+    if "error" in result:
+        print name, "FAILED", result["error"]
+    else:
+        print name, ("%.4fs" % result["seconds"]).rjust(12), ("%.5fs/brec" % result["per_brec"]).rjust(16), \
+            ("%+.1fMB" % result["peak_rss_delta_mb"]).rjust(10)
+    sys.stdout.flush()
+
+def find_regressions(results, baseline, tolerance = 0.25):
+    """Return the results that are slower (per building) than the baseline by more than tolerance."""
+    old = dict(((r["target"], r["num_brecs"]), r) for r in baseline if "error" not in r)
+    toR = []
+    for r in results:
+        key = (r["target"], r["num_brecs"])
+        if "error" in r or key not in old:
+            continue
+        if r["per_brec"] > old[key]["per_brec"] * (1 + tolerance):
+            toR.append((r, old[key]))
+    return toR
+
+def main(args):
+    opts = {"--sizes": ",".join(str(s) for s in default_sizes), "--only": None, "--out": None,
+            "--baseline": None, "--tolerance": "0.25"}
+    for flag, val in zip(args[::2], args[1::2]):
+        if flag not in opts:
+            print __doc__
+            return 2
+        opts[flag] = val
+
+    sizes   = [int(s) for s in opts["--sizes"].split(",")]
+    only    = opts["--only"].split(",") if opts["--only"] else None
+    results = run_benchmarks(sizes, only)
+    if opts["--out"]:
+        with open(opts["--out"], "w") as fout:
+            json.dump({"date": datetime.datetime.now().isoformat(), "results": results}, fout, indent = 1)
+    if opts["--baseline"]:
+        with open(opts["--baseline"]) as fin:
+            baseline = json.load(fin)["results"]
+        regressions = find_regressions(results, baseline, float(opts["--tolerance"]))
+        for new, old in regressions:
+            print "REGRESSION: %s [%d] %.5fs/brec (was %.5fs/brec)" % \
+                (new["target"], new["num_brecs"], new["per_brec"], old["per_brec"])
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
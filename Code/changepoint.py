@@ -0,0 +1,341 @@
+"""Online change-point detection (two-sided CUSUM) over streaming readings, for many buildings at once.
+
+A ChangeDetector keeps a fixed amount of state per building: a reference level for each slot
+(e.g., one per weekday, or per hour of the week), the variance of the residuals, and the upward
+and downward CUSUM scores. Each batch of new readings (e.g., a day of readings of every building)
+is processed in one vectorized step. With the CUSUM recursion S_t = max(0, S_{t-1} + z_t) written as
+S_t = C_t - min(0, min_{s <= t} C_s), where C is the cumulative sum of the z, and the exponentially weighted
+reference levels and variance moving reading by reading within the batch written as weighted cumulative sums too
+(see _ew_path), there is no Python loop over readings or buildings.
+When a score crosses the threshold, a change event is emitted (with the time it was detected, the estimated
+time it started and its magnitude), and the building restarts: its levels move to their new values and warm up
+again from the following readings.
+While a slot warms up its level is the plain mean of its readings, and the variance is pooled from the deviations
+of the readings from those means, so a detector can start from a single batch (e.g., a first day of readings).
+As the levels and the variance move reading by reading, after the warm-up the alarms do not depend on how the
+readings are cut into batches, but for the clipping within a batch being found by a few fixed-point iterations.
+During the warm-up they do: a slot starts being scored once it has warmup readings, and only at the first batch
+after that, so with one reading per batch the variance of the first scored readings is pooled from fewer readings.
+batching_check (python changepoint.py) compares the alarms on stationary noise and on level shifts for several
+batch sizes: with its defaults (200 buildings, 120 days, 24 hour-of-day slots) there are 21, 23 and 24 false alarms
+with batches of 1, 24 and 168 readings, and every shifted building is detected; with one slot, 10 (8 in the first
+day), 1 and 1.
+The state is saved between runs with save / ChangeDetector.load.
+
+Example (daily baseload shifts):
+    det = ChangeDetector(bids, num_slots = 7)
+    for epochs, kwhs, oriflag in days: #(buildings x 24) arrays
+        base, valid = daily_features(kwhs, oriflag)["baseload"]
+        events = det.update(epochs[:1], base[:, np.newaxis], valid[:, np.newaxis], weekday_of_day)
+    det.save("baseload_state.npz")
+"""
+import  numpy as np
+
+class ChangeDetector(object):
+    """Two-sided CUSUM change detectors, one per building.
+
+    Parameters:
+    bids -- The building ids (one detector each, in this order).
+    num_slots -- The number of reference levels per building (readings are compared with the level of their slot).
+    k -- The allowance, in standard deviations of the residuals (shifts smaller than about 2k are ignored).
+    h -- The threshold of the scores, in standard deviations.
+    alpha -- The weight of a new reading in the (exponentially weighted) reference levels and variance.
+    warmup -- The number of readings a slot needs before its residuals are scored.
+    clip -- Residuals are clipped to this many standard deviations (in the scores and when updating the levels),
+            so a lone outlier cannot raise an alarm: it takes about h / (clip - k) unusual readings in a row.
+    """
+    state_fields = ["level", "count", "var", "var_num", "s_pos", "s_neg", "pos_start", "neg_start",
+                    "pos_sum", "neg_sum", "pos_num", "neg_num", "last"]
+
+    def __init__(self, bids, num_slots = 1, k = 0.5, h = 8.0, alpha = 0.05, warmup = 4, clip = 3.0):
+        self.params = {"num_slots": num_slots, "k": k, "h": h, "alpha": alpha, "warmup": warmup, "clip": clip}
+        self.bids   = np.array([], dtype = object)
+        self.index  = {}
+        self.level  = np.zeros((0, num_slots))          #reference level of each slot
+        self.count  = np.zeros((0, num_slots), dtype = int)
+        self.var    = np.zeros(0)                       #variance of the residuals
+        self.var_num = np.zeros(0, dtype = int)         #and its degrees of freedom so far
+        self.s_pos  = np.zeros(0)                       #upward CUSUM score
+        self.s_neg  = np.zeros(0)                       #downward CUSUM score
+        self.pos_start = np.zeros(0, dtype = np.int64)  #time of the first reading since the upward score was last zero
+        self.neg_start = np.zeros(0, dtype = np.int64)
+        self.pos_sum   = np.zeros(0)                    #sum of the residuals since then
+        self.neg_sum   = np.zeros(0)
+        self.pos_num   = np.zeros(0, dtype = int)       #and their number
+        self.neg_num   = np.zeros(0, dtype = int)
+        self.last   = np.zeros(0, dtype = np.int64)     #time of the last reading (seconds since the epoch)
+        self.add_buildings(bids)
+
+    def add_buildings(self, bids):
+        """Add detectors for new buildings (they start warming up)."""
+        bids = [b for b in bids if b not in self.index]
+        n, s = len(bids), self.params["num_slots"]
+        self.bids  = np.concatenate([self.bids, np.array(bids, dtype = object)])
+        self.index = dict((b, i) for i, b in enumerate(self.bids))
+        self.level = np.vstack([self.level, np.zeros((n, s))])
+        self.count = np.vstack([self.count, np.zeros((n, s), dtype = int)])
+        self.var   = np.concatenate([self.var, np.zeros(n)])
+        self.var_num = np.concatenate([self.var_num, np.zeros(n, dtype = int)])
+        self.s_pos = np.concatenate([self.s_pos, np.zeros(n)])
+        self.s_neg = np.concatenate([self.s_neg, np.zeros(n)])
+        self.pos_start = np.concatenate([self.pos_start, np.zeros(n, dtype = np.int64)])
+        self.neg_start = np.concatenate([self.neg_start, np.zeros(n, dtype = np.int64)])
+        self.pos_sum   = np.concatenate([self.pos_sum, np.zeros(n)])
+        self.neg_sum   = np.concatenate([self.neg_sum, np.zeros(n)])
+        self.pos_num   = np.concatenate([self.pos_num, np.zeros(n, dtype = int)])
+        self.neg_num   = np.concatenate([self.neg_num, np.zeros(n, dtype = int)])
+        self.last  = np.concatenate([self.last, np.zeros(n, dtype = np.int64)])
+
+    def __len__(self):
+        return len(self.bids)
+
+    def save(self, path):
+        """Save the state of the detectors (a .npz file)."""
+        np.savez(path, bids = self.bids, params = np.array([self.params], dtype = object),
+                 **dict((f, getattr(self, f)) for f in self.state_fields))
+
+    @classmethod
+    def load(cls, path):
+        """Load detectors saved with save."""
+        saved = np.load(path, allow_pickle = True) #the bids and params are object arrays
+        det   = cls([], **saved["params"][0])
+        det.bids  = saved["bids"]
+        det.index = dict((b, i) for i, b in enumerate(det.bids))
+        for f in cls.state_fields:
+            setattr(det, f, saved[f])
+        return det
+
+    def update(self, epochs, vals, valid = None, slots = None):
+        """Process a batch of new readings of every building.
+
+        Parameters:
+        epochs -- The times of the readings (seconds since the epoch, or datetime64), one per column.
+        vals -- A (buildings x readings) array, in the order of self.bids.
+        valid -- A boolean array of the same shape; False for missing (or imputed) readings, which are skipped.
+        slots -- The slot of each reading: an int array of the same shape as vals, or of one row (all buildings
+                 alike). Defaults to slot 0.
+
+        Returns the change events, a dictionary of arrays (one entry per event):
+            bid       -- The building.
+            time      -- The time of the reading at which the change was detected.
+            start     -- The estimated start of the change: the first reading after the score (of its direction)
+                         was last at zero, possibly in an earlier batch.
+            direction -- 1 for an increase, -1 for a decrease.
+            magnitude -- The average difference from the reference levels, from start to time.
+        """
+        p       = self.params
+        epochs  = np.asarray(epochs)
+        epochs  = epochs.astype("datetime64[s]").astype(np.int64) if epochs.dtype.kind == "M" else epochs.astype(np.int64)
+        vals    = np.asarray(vals, dtype = float)
+        n, t    = vals.shape
+        valid   = np.ones(vals.shape, dtype = bool) if valid is None else np.asarray(valid, dtype = bool)
+        valid   = valid & np.isfinite(vals)
+        slots   = np.zeros(vals.shape, dtype = int) if slots is None else np.broadcast_to(np.asarray(slots, dtype = int), vals.shape)
+        rows    = np.arange(n)[:, np.newaxis]
+        if t == 0:
+            return {"bid": self.bids[:0], "time": epochs.astype("datetime64[s]"), "start": epochs.astype("datetime64[s]"),
+                    "direction": np.zeros(0, dtype = int), "magnitude": np.zeros(0)}
+
+        #residuals from the reference levels, in standard deviations (0 while warming up). Within the batch, the
+        #levels of warmed up slots take a step towards each reading, clipped to clip sds around the level, and the
+        #variance a step towards its square, as they would with one reading per batch (see _ew_path). The clipping
+        #depends on the levels and the variance, so their paths are found by fixed-point iterations, starting from
+        #the state before the batch (each iteration gets one more reading of every slot exactly right)
+        level0  = self.level[rows, slots]
+        scored  = valid & (self.count[rows, slots] >= p["warmup"])
+        floor   = (1e-12 + (1e-3 * np.abs(self.level).mean(axis = 1)) ** 2)[:, np.newaxis]
+        var0    = self.var[:, np.newaxis]
+        before  = np.cumsum(scored, axis = 1) - scored #the number of scored readings before each in the batch
+        var_w   = np.maximum(p["alpha"], 1.0 / (self.var_num[:, np.newaxis] + before + 1)) #see _update_levels
+        one     = np.zeros(vals.shape, dtype = int)
+        level, var = level0, var0
+        for _ in range(min(t, 3)):
+            sd      = np.sqrt(np.maximum(var, floor))
+            clipped = np.where(scored, np.clip(vals - level, -p["clip"] * sd, p["clip"] * sd), 0)
+            path, moved = _ew_path(clipped, scored, slots, self.level.shape[1], p["alpha"])
+            var_path    = _ew_path(clipped ** 2 - var0, scored, one, 1, var_w)[0]
+            level, var  = level0 + path, var0 + var_path
+        sd      = np.sqrt(np.maximum(var, floor))
+        resid   = np.where(valid, vals - level, 0)
+        z       = np.where(scored, np.clip(resid / sd, -p["clip"], p["clip"]), 0)
+
+        #CUSUM scores of every reading, without a loop (see the module docstring)
+        s_pos   = _cusum(self.s_pos, np.where(scored, z - p["k"], 0))
+        s_neg   = _cusum(self.s_neg, np.where(scored, -z - p["k"], 0))
+        over    = (s_pos > p["h"]) | (s_neg > p["h"])
+        alarmed = over.any(axis = 1)
+        first   = np.argmax(over, axis = 1) #the reading of the alarm
+        up      = s_pos[np.arange(n), first] > p["h"]
+        resid   = np.where(scored, resid, 0)
+        pos_run = _since_zero(s_pos, self.s_pos, epochs, resid, scored, self.pos_start, self.pos_sum, self.pos_num)
+        neg_run = _since_zero(s_neg, self.s_neg, epochs, resid, scored, self.neg_start, self.neg_sum, self.neg_num)
+        at      = (np.arange(n), first)
+        start   = np.where(up, pos_run[0][at], neg_run[0][at])
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            magnitude = np.where(up, pos_run[1][at], neg_run[1][at]) / np.where(up, pos_run[2][at], neg_run[2][at])
+
+        events = {"bid"      : self.bids[alarmed],
+                  "time"     : epochs[first[alarmed]].astype("datetime64[s]"),
+                  "start"    : start[alarmed].astype("datetime64[s]"),
+                  "direction": np.where(up[alarmed], 1, -1),
+                  "magnitude": magnitude[alarmed]}
+
+        #update the state with the readings up to the alarms. An alarm restarts its building: the levels move to the
+        #levels before the batch plus the magnitude (not on top of the steps the run's own readings made), and warm up
+        #again from the readings after the alarm (so a false alarm, whose magnitude is mostly noise, is not followed
+        #by a reverse one)
+        after = alarmed[:, np.newaxis] & (np.arange(t) > first[:, np.newaxis])
+        old   = self.level.copy()
+        var_end = self.var + _ew_path((z * sd) ** 2 - var0, scored & ~after, one, 1, var_w)[1][:, 0]
+        self._update_levels(vals, valid & ~after, slots, moved, var_end, np.sum(scored & ~after, axis = 1))
+        shift = np.where(alarmed & np.isfinite(magnitude), magnitude, 0)
+        self.level = np.where(alarmed[:, np.newaxis], old + shift[:, np.newaxis], self.level)
+        self.count = np.where(alarmed[:, np.newaxis], 0, self.count)
+        self._update_levels(vals, valid & after, slots)
+        self.s_pos = np.where(alarmed, 0, s_pos[:, -1])
+        self.s_neg = np.where(alarmed, 0, s_neg[:, -1])
+        self.pos_start, self.pos_sum, self.pos_num = [a[:, -1] for a in pos_run]
+        self.neg_start, self.neg_sum, self.neg_num = [a[:, -1] for a in neg_run]
+        lastr      = t - 1 - np.argmax(valid[:, ::-1], axis = 1)
+        self.last  = np.where(valid.any(axis = 1), epochs[lastr], self.last)
+        return events
+
+    def _update_levels(self, vals, used, slots, moved = None, var = None, num_scored = None):
+        """Update the reference levels, the counts and the variance with the used readings of a batch.
+        Warmed up slots move by moved, and the variance becomes var after the num_scored readings of warmed up
+        slots (see update). Slots warming up take the plain mean of their readings as level, and their readings add
+        their squared deviation from it, plus the change of the mean for the earlier readings of the slot, so that
+        while warming up the variance is the exact pooled variance of the readings around their slot means."""
+        p       = self.params
+        n, s    = self.level.shape
+        rows    = np.arange(n)[:, np.newaxis]
+        warming = self.count < p["warmup"]
+        warm_r  = used & warming[rows, slots]
+        flat    = (rows * s + slots)[used]
+        m       = np.bincount(flat, minlength = n * s).reshape(n, s)
+        sums    = np.bincount(flat, weights = vals[used], minlength = n * s).reshape(n, s)
+        got     = m > 0
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            means = sums / m
+        old     = self.level.copy()
+        plain   = np.where(got, old + m * (means - old) / np.maximum(self.count + m, 1), old)
+        self.level = np.where(warming, plain, old if moved is None else old + moved)
+
+        #variance of the residuals: a simple average of the squared deviations for its first 1 / alpha degrees of
+        #freedom (one per reading, less one per slot), exponential weights after
+        if var is not None:
+            self.var     = var
+            self.var_num = self.var_num + num_scored
+        sq      = np.sum(np.where(warm_r, (vals - self.level[rows, slots]) ** 2, 0), axis = 1)
+        sq     += np.sum(np.where(warming & got, self.count * (old - self.level) ** 2, 0), axis = 1)
+        num     = np.sum(warm_r, axis = 1) - np.sum(got & (self.count == 0), axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            batch_var = sq / num
+        weight  = np.where(self.var_num < 1.0 / p["alpha"], num / np.maximum(self.var_num + num, 1).astype(float),
+                           1 - (1 - p["alpha"]) ** num)
+        self.var     = np.where(num > 0, self.var + weight * (batch_var - self.var), self.var)
+        self.var_num = self.var_num + num
+        self.count = self.count + m
+
+def _cusum(s0, z):
+    """The CUSUM scores S_t = max(0, S_{t-1} + z_t) of each row of z, starting from s0 (one per row)."""
+    c = s0[:, np.newaxis] + np.cumsum(z, axis = 1)
+    return c - np.minimum(np.minimum.accumulate(c, axis = 1), 0)
+
+def _ew_path(y, steps, slots, num_slots, alpha):
+    """The exponentially weighted paths o <- (1 - w) o + w y over the steps of each (row, slot), from 0, where the
+    weights w are alpha (a number, or an array of the shape of y: one per reading).
+    Returns the value of o before each step (0 elsewhere; the shape of y), and after the last step of each
+    (row, slot) (rows x num_slots).
+    The steps of each (row, slot) are laid out along a row of a matrix, where o before step i is P_i times the
+    cumulative sum of w_j y_j / P_(j + 1) over the earlier steps j (P_i is the product of the (1 - w) of the steps
+    before i), in blocks of columns short enough for 1 / P not to overflow."""
+    n, t   = y.shape
+    keys   = (np.arange(n)[:, np.newaxis] * num_slots + slots)[steps] #in time order within each row
+    order  = np.argsort(keys, kind = "mergesort")
+    skeys  = keys[order]
+    first  = np.concatenate([[True], skeys[1:] != skeys[:-1]]) if len(skeys) else np.zeros(0, dtype = bool)
+    gid    = np.cumsum(first) - 1
+    starts = np.flatnonzero(first)
+    rank   = np.arange(len(skeys)) - starts[gid]
+    dense  = np.zeros((len(starts), rank.max() + 1 if len(rank) else 0))
+    dense[gid, rank] = y[steps][order]
+    weight = np.zeros(dense.shape)
+    weight[gid, rank] = np.minimum(np.broadcast_to(alpha, y.shape)[steps][order], 1 - 1e-12)
+    logs   = np.log1p(-weight)
+    block  = max(1, int(460 / max(-logs.min() if logs.size else 0, 1e-9))) #1 / P <= e^460
+    before = np.zeros(dense.shape)
+    o      = np.zeros(len(starts))
+    for b in range(0, dense.shape[1], block):
+        d, w  = dense[:, b:b + block], weight[:, b:b + block]
+        p_in  = np.exp(np.cumsum(logs[:, b:b + block], axis = 1))
+        p_ex  = np.hstack([np.ones((len(starts), 1)), p_in[:, :-1]])
+        c     = np.cumsum(w * d / p_in, axis = 1)
+        before[:, b:b + block] = p_ex * (o[:, np.newaxis] + c - w * d / p_in)
+        o     = p_in[:, -1] * (o + c[:, -1])
+    after  = (1 - weight) * before + weight * dense
+    path   = np.zeros(y.shape)
+    vals   = np.zeros(len(skeys))
+    vals[order]  = before[gid, rank]
+    path[steps]  = vals
+    last   = np.zeros(n * num_slots)
+    last[skeys[first]] = after[np.arange(len(starts)), np.bincount(gid) - 1] if len(starts) else 0
+    return path, last.reshape(n, num_slots)
+
+def _since_zero(score, s0, epochs, resid, scored, start0, sum0, num0):
+    """The run of each reading since its score was last at zero: the time the run started, and the sum and number
+    of the (scored) residuals in it. Runs which started in earlier batches (s0 > 0) carry on from start0, sum0, num0."""
+    n, t  = score.shape
+    rows  = np.arange(n)[:, np.newaxis]
+    zeros = np.maximum.accumulate(np.where(score <= 0, np.arange(t), -1), axis = 1)
+    after = zeros >= 0
+    carry = ~after & (s0 > 0)[:, np.newaxis]
+    sums  = np.cumsum(resid, axis = 1)
+    nums  = np.cumsum(scored, axis = 1)
+    last  = np.maximum(zeros, 0)
+    start = np.where(after, epochs[np.minimum(zeros + 1, t - 1)], np.where(carry, start0[:, np.newaxis], epochs[0]))
+    sums  = np.where(after, sums - sums[rows, last], np.where(carry, sum0[:, np.newaxis] + sums, sums))
+    nums  = np.where(after, nums - nums[rows, last], np.where(carry, num0[:, np.newaxis] + nums, nums))
+    return start, sums, nums
+
+def daily_features(kwhs, oriflag = None):
+    """Daily signals to watch, from a (buildings x 24) day of readings: each is (values, valid).
+    baseload -- The lowest original reading (shifts mean, e.g., equipment left on).
+    peak     -- The highest original reading.
+    total    -- The sum of the readings (valid if at least 20 of them are original)."""
+    kwhs    = np.asarray(kwhs, dtype = float)
+    oriflag = np.ones(kwhs.shape, dtype = bool) if oriflag is None else np.asarray(oriflag, dtype = bool)
+    num     = np.sum(oriflag, axis = 1)
+    return {"baseload": (np.min(np.where(oriflag, kwhs, np.inf), axis = 1), num > 0),
+            "peak"    : (np.max(np.where(oriflag, kwhs, -np.inf), axis = 1), num > 0),
+            "total"   : (np.sum(kwhs, axis = 1), num >= 20)}
+
+def batching_check(num_buildings = 200, num_days = 120, num_slots = 24, batches = (1, 24, 168), shift = 2.0, seed = 0):
+    """Run detectors over simulated hourly readings (N(10, 1) noise; the second half of the buildings shift up by
+    shift standard deviations half way through), cut into batches of each size.
+    Returns a dictionary mapping each batch size to (false alarms, of which in the first day, shifted buildings
+    detected after their shift)."""
+    rs     = np.random.RandomState(seed)
+    epochs = np.arange(24 * num_days) * 3600
+    slots  = np.arange(24 * num_days) % 24 % num_slots
+    vals   = 10 + rs.randn(num_buildings, 24 * num_days)
+    half   = num_buildings // 2
+    vals[half:, 12 * num_days:] += shift
+    toR    = {}
+    for size in batches:
+        det   = ChangeDetector(range(num_buildings), num_slots = num_slots)
+        bids, times = [], []
+        for i in range(0, len(epochs), size):
+            events = det.update(epochs[i:i + size], vals[:, i:i + size], slots = slots[i:i + size])
+            bids.extend(events["bid"])
+            times.extend(events["time"].astype(np.int64))
+        bids, times = np.array(bids, dtype = int), np.array(times, dtype = np.int64)
+        real  = (bids >= half) & (times >= epochs[12 * num_days])
+        toR[size] = (int(np.sum(~real)), int(np.sum(~real & (times < 86400))), len(set(bids[real])))
+    return toR
+
+if __name__ == "__main__":
+    for num_slots in (24, 1):
+        print "%d slot(s): batch size -> (false alarms, of which in the first day, shifted buildings detected of 100)" % num_slots
+        for size, counts in sorted(batching_check(num_slots = num_slots).items()):
+            print "\t%4d -> %s" % (size, counts)
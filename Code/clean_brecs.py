@@ -1,29 +1,148 @@
 from utils import *
+from record_store import RecordStore
+from numpy.lib.stride_tricks import as_strided
+import analytics as an
+import timeaxis as ta
+import impute
+import os
 import sys
 
-def clean_rec(d):
-    kwhs, kwhs_oriflag   = d["kwhs"]
-    temps, temps_oriflag = d["temps"]
-    for i in range(len(temps_oriflag)):
-        t = temps[i]
-        if t < -60:
-            temps_oriflag[i] = False #Ain't no way that reading's real
-            temps[i] = 0
-    for i in range(len(kwhs_oriflag)):
-        k = kwhs[i]
-        if k < -5:
-            kwhs_oriflag[i] = False #Ain't no way that reading's real
-            kwhs[i] = 0
-    d["temps"] = (temps, temps_oriflag)
-    d["kwhs"] = (kwhs, kwhs_oriflag)
-      
+#A cleaning rule takes the values and oriflag of a series, and returns a boolean array
+#which is True for the values it rejects. Only original values can be rejected.
+
+def bounds_rule(lower = None, upper = None):
+    """Reject values below lower or above upper."""
+    def rule(vals, oriflag):
+        bad = np.zeros(len(vals), dtype = bool)
+        if lower is not None:
+            bad |= vals < lower
+        if upper is not None:
+            bad |= vals > upper
+        return bad
+    return rule
+
+def spike_rule(num_mads = 20, min_jump = 0):
+    """Reject isolated spikes: values which jump away from both of their neighbours (in opposite directions)
+    by more than num_mads times the median absolute change of the series (and more than min_jump).
+    When more than half of the changes are equal (coarse meters, idle buildings) the median absolute change is 0,
+    and the mean absolute change is used instead; a series which never changes has no spikes."""
+    def rule(vals, oriflag):
+        bad = np.zeros(len(vals), dtype = bool)
+        if len(vals) < 3:
+            return bad
+        deriv  = np.diff(vals)
+        ok     = np.logical_and(oriflag[1:], oriflag[:-1])
+        if not ok.any():
+            return bad
+        dev    = np.abs(deriv[ok] - np.median(deriv[ok]))
+        scale  = np.median(dev)
+        if scale == 0:
+            scale = np.mean(dev)
+        if scale == 0:
+            return bad
+        thresh = max(num_mads * scale, min_jump)
+        left   = deriv[:-1] #change into the value
+        right  = deriv[1:]  #change out of the value
+        bad[1:-1] = np.logical_and(np.minimum(np.abs(left), np.abs(right)) > thresh, left * right < 0)
+        return bad
+    return rule
+
+def flat_line_rule(window = 24, tol = 0.0):
+    """Reject flat lines (e.g., stuck meters): runs of at least window original values
+    that stay within tol of each other. Uses rolling windows (strided views, no copies)."""
+    def rule(vals, oriflag):
+        n   = len(vals)
+        bad = np.zeros(n, dtype = bool)
+        if n < window:
+            return bad
+        stride  = vals.strides[0]
+        windows = as_strided(vals, shape = (n - window + 1, window), strides = (stride, stride))
+        flat    = (windows.max(axis = 1) - windows.min(axis = 1)) <= tol
+        #only windows made entirely of original values count (imputed values are flat by construction)
+        num_ori = np.cumsum(np.concatenate([[0], oriflag.astype(int)]))
+        flat   &= (num_ori[window:] - num_ori[:-window]) == window
+        #flag every value covered by a flat window
+        starts  = np.flatnonzero(flat)
+        marks   = np.bincount(starts, minlength = n + 1) - np.bincount(starts + window, minlength = n + 1)
+        bad     = np.cumsum(marks)[:n] > 0
+        return bad
+    return rule
+
+#(series, rule name, rule) triples, applied in order
+default_rules = [("temps", "temp_too_low",  bounds_rule(lower = -60)),   #Ain't no way that reading's real
+                 ("temps", "temp_too_high", bounds_rule(upper = 135)),
+                 ("temps", "temp_spike",    spike_rule(num_mads = 20, min_jump = 15)),
+                 ("kwhs",  "kwh_too_low",   bounds_rule(lower = -5)),    #Ain't no way that reading's real
+                 ("kwhs",  "kwh_spike",     spike_rule(num_mads = 20, min_jump = 5)),
+                 ("kwhs",  "kwh_stuck",     flat_line_rule(window = 24))]
+
+def clean_rec(d, rules = None, fill = "profile"):
+    """Clean a building record in place.
+    Values rejected by a rule get oriflag = False. With fill "profile" (the default), every missing kwh (rejected,
+    or never read) is then filled from the building's hour-of-week profile (see impute), and other series are
+    forward-filled. With "ffill", rejected values are replaced with the last original value, and with a number,
+    by that number (the gaps of the record are left as they are).
+
+    Parameters:
+    d -- The building record.
+    rules -- A list of (series, rule name, rule) triples (defaults to default_rules).
+    fill -- "profile", "ffill" or the value rejected values are replaced with.
+
+    Returns a dictionary mapping each rule name to the number of values it rejected.
+    """
+    if rules is None:
+        rules = default_rules
+    counts = {}
+    for which, name, rule in rules:
+        vals, oriflag = d[which]
+        vals    = np.asarray(vals, dtype = float)
+        oriflag = np.asarray(oriflag, dtype = bool)
+        bad     = np.logical_and(rule(vals, oriflag), oriflag)
+        counts[name] = counts.get(name, 0) + int(np.count_nonzero(bad))
+        if bad.any():
+            oriflag = np.logical_and(oriflag, ~bad)
+            if fill in ("ffill", "profile"):
+                vals = an.forward_fill(vals, oriflag)
+            else:
+                vals = np.where(bad, fill, vals)
+        d[which] = (vals, oriflag)
+    if fill == "profile" and "kwhs" in d:
+        impute.impute_rec(d)
+    return counts
+
+def clean_brecs(brecs, rules = None, fill = "profile", store = None):
+    """Clean each of an iterable of building records, one at a time (see clean_rec).
+    If store (a RecordStore) is given, each cleaned record is saved to it.
+    Returns the total number of values rejected by each rule."""
+    totals = {}
+    for d in brecs:
+        for name, count in clean_rec(d, rules, fill).items():
+            totals[name] = totals.get(name, 0) + count
+        if store is not None:
+            store.put(d)
+    return totals
+
+def clean_store(store, rules = None, fill = "profile"):
+    """Clean every record of a RecordStore in place, one building at a time (so memory stays bounded).
+    Returns the total number of values rejected by each rule."""
+    return clean_brecs(store, rules, fill, store)
+
+def print_counts(counts):
+    for name in sorted(counts.keys()):
+        print name.ljust(20), str(counts[name]).rjust(10)
+
 if __name__ == "__main__":
     args = sys.argv
+    if len(args) > 1 and os.path.isdir(args[1]):
+        #a record store: cleaned in place, building by building
+        print_counts(clean_store(RecordStore(args[1])))
+        exit()
     if len(args) > 1:
         the_year = int(args[1])
-    
+
+    #the old single-pickle format: cleaned into a record store, so later runs can clean it in place
     brecs, desc = qload("state_b_records_" + str(the_year) + "_updated_with_temps.pkl")
-    for d in brecs:
-        clean_rec(d)
-    qdump((brecs, desc + "(Plus we cleaned out curiously low values (noise))"),
-          "state_b_records_" + str(the_year) + "_with_temps_cleaned.pkl")
+    store = RecordStore(data_loc + "state_b_records_" + str(the_year) + "_with_temps_cleaned")
+    counts = clean_brecs((ta.upgrade(d) for d in brecs), store = store) #stored with datetime64 time axes
+    print "Saved the cleaned records to", store.path, "(" + desc + ", plus we cleaned out curiously low values (noise))"
+    print_counts(counts)
@@ -0,0 +1,169 @@
+"""A portfolio-wide index of the most extreme events (spikes, drops and peaks) in energy usage.
+
+For each building, the index keeps only the top-k candidates of each kind in each time bucket
+(found with np.argpartition), so memory does not grow with the length of the records.
+Global rankings merge the (short, sorted) candidate lists of every building with heapq.
+
+Example:
+    index = EventIndex()
+    for d in brecs:
+        index.add_brec(d)
+    index.top(100, "spike", start = datetime(2012, 11, 1), end = datetime(2012, 12, 1))
+"""
+import  heapq
+import  itertools
+import  numpy as np
+from    timeaxis import to_epoch, epochs_of, utc_epochs
+
+kinds = ["spike", "drop", "peak"]
+
+def top_k_per_bucket(vals, buckets, k):
+    """Find the k largest values in each bucket.
+
+    Parameters:
+    vals -- A 1-d array of values (use -inf for values which must not be picked).
+    buckets -- A non-decreasing array of (integer) bucket ids, one per value.
+    k -- The number of values to keep per bucket.
+
+    Returns the indices (into vals) of the picked values.
+    """
+    if len(vals) == 0:
+        return np.zeros(0, dtype = int)
+    ubuckets, first = np.unique(buckets, return_index = True)
+    bucket_ind = np.searchsorted(ubuckets, buckets)
+    pos        = np.arange(len(vals)) - first[bucket_ind]
+    width      = np.max(pos) + 1
+    k          = min(k, width)
+
+    #one row per bucket, padded with -inf
+    grid = np.empty((len(ubuckets), width))
+    grid.fill(-np.inf)
+    grid[bucket_ind, pos] = vals
+    cols = np.argpartition(grid, width - k, axis = 1)[:, width - k:]
+    rows = np.repeat(np.arange(len(ubuckets)), k)
+    cols = cols.ravel()
+    keep = np.isfinite(grid[rows, cols])
+    return first[rows[keep]] + cols[keep]
+
+class EventIndex(object):
+    """Per-building top-k event candidates, bucketed in time, with global rankings.
+
+    Parameters:
+    k -- The number of candidates kept per building, kind and bucket. A global ranking of n events is exact
+         as long as no building has more than k of these events (of one kind) in a single bucket.
+    bucket_days -- The width of the time buckets, in days.
+    """
+    def __init__(self, k = 10, bucket_days = 7):
+        self.k           = k
+        self.bucket_secs = int(bucket_days * 86400)
+        self.cands       = {} #(bid, kind) -> {bucket: (values, epochs)}
+        self.last        = {} #bid -> (epoch, kwh, oriflag) of the latest reading, for the changes across updates
+
+    def add_brec(self, d):
+        """Index (or add to the index) the readings in the building record d."""
+        kwhs, kwhs_oriflag = d["kwhs"]
+        self.add(d["bid"], utc_epochs(d), kwhs, kwhs_oriflag)
+
+    def add(self, bid, times, kwhs, oriflag = None):
+        """Add new readings of a building to the index.
+        Readings must be in chronological order, and later than any readings added before for this building.
+
+        Parameters:
+        bid -- The building id.
+        times -- The times of the readings (datetimes, datetime64 or seconds since the epoch).
+        kwhs -- The readings.
+        oriflag -- True for original (not imputed) readings; only these can be events.
+        """
+        epochs = epochs_of(times)
+        kwhs   = np.asarray(kwhs, dtype = float)
+        if oriflag is None:
+            oriflag = np.ones(len(kwhs), dtype = bool)
+        oriflag = np.asarray(oriflag, dtype = bool)
+        if len(kwhs) == 0:
+            return
+
+        #prepend the latest reading we already have, so the change across the updates is not lost
+        if bid in self.last:
+            le, lk, lf = self.last[bid]
+            all_epochs = np.concatenate([[le], epochs])
+            all_kwhs   = np.concatenate([[lk], kwhs])
+            all_flags  = np.concatenate([[lf], oriflag])
+        else:
+            all_epochs, all_kwhs, all_flags = epochs, kwhs, oriflag
+        self.last[bid] = (epochs[-1], kwhs[-1], oriflag[-1])
+
+        #changes are attributed to the time just before them (as in get_times_of_highest_change)
+        deriv      = all_kwhs[1:] - all_kwhs[:-1]
+        deriv_ok   = np.logical_and(all_flags[1:], all_flags[:-1])
+        deriv_eps  = all_epochs[:-1]
+        candidates = {"spike": (np.where(deriv_ok, deriv, -np.inf),  deriv, deriv_eps),
+                      "drop" : (np.where(deriv_ok, -deriv, -np.inf), deriv, deriv_eps),
+                      "peak" : (np.where(oriflag, kwhs, -np.inf),    kwhs,  epochs)}
+
+        for kind, (scores, vals, eps) in candidates.items():
+            buckets = eps // self.bucket_secs
+            inds    = top_k_per_bucket(scores, buckets, self.k)
+            self._merge(bid, kind, scores[inds], eps[inds], buckets[inds])
+
+    def _merge(self, bid, kind, scores, epochs, buckets):
+        """Merge new candidates into the ones we have, keeping the top k of each bucket."""
+        mine = self.cands.setdefault((bid, kind), {})
+        for b in np.unique(buckets):
+            new = buckets == b
+            s, e = scores[new], epochs[new]
+            if b in mine:
+                s = np.concatenate([mine[b][0], s])
+                e = np.concatenate([mine[b][1], e])
+            if len(s) > self.k:
+                keep = np.argpartition(s, len(s) - self.k)[len(s) - self.k:]
+                s, e = s[keep], e[keep]
+            order   = np.argsort(s)[::-1] #at most 2k values
+            mine[b] = (s[order], e[order])
+
+    def remove(self, bid):
+        """Forget all the events of a building."""
+        for kind in kinds:
+            self.cands.pop((bid, kind), None)
+        self.last.pop(bid, None)
+
+    def _stream(self, bid, kind, start, end):
+        """Yield (-score, epoch, bid) for one building's candidates in [start, end), best first."""
+        buckets = self.cands.get((bid, kind), {})
+        lists   = []
+        for b, (s, e) in buckets.items():
+            if start is not None and (b + 1) * self.bucket_secs <= start:
+                continue
+            if end is not None and b * self.bucket_secs >= end:
+                continue
+            ok = np.ones(len(e), dtype = bool)
+            if start is not None:
+                ok &= e >= start
+            if end is not None:
+                ok &= e < end
+            lists.append(itertools.izip(-s[ok], e[ok], itertools.repeat(bid)))
+        return heapq.merge(*lists)
+
+    def top(self, n, kind = "spike", start = None, end = None, bids = None):
+        """Return the n most extreme events of the portfolio, most extreme first.
+
+        Parameters:
+        n -- The number of events.
+        kind -- "spike" (largest hourly increases), "drop" (largest hourly decreases) or "peak" (highest readings).
+        start, end -- Only events in [start, end) are returned (datetimes or seconds since the epoch).
+        bids -- If given, only the events of these buildings are returned.
+
+        Returns a list of dictionaries with the bid, kind, time (seconds since the epoch) and value
+        (the change in kwh for spikes and drops, the kwh for peaks).
+        """
+        if kind not in kinds:
+            raise ValueError("kind must be one of %s." % ", ".join(kinds))
+        start = None if start is None else to_epoch(start)
+        end   = None if end is None else to_epoch(end)
+        if bids is None:
+            bids = [bid for bid, k in self.cands.keys() if k == kind]
+        streams = [self._stream(bid, kind, start, end) for bid in bids]
+        toR = []
+        for neg_score, epoch, bid in itertools.islice(heapq.merge(*streams), n):
+            value = -neg_score if kind != "drop" else neg_score
+            toR.append({"bid": bid, "kind": kind, "time": int(epoch), "value": value})
+        return toR
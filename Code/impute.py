@@ -0,0 +1,147 @@
+"""Profile-based imputation of missing kwhs: gaps are filled from the building's own hour-of-week profile,
+scaled to the levels just before and after the gap, and optionally adjusted for outdoor temperature.
+
+For each building (one pass, vectorized over the readings, and over the rows of a buildings x hours matrix):
+ 1. The profile is the mean original kwh at each local hour of the week (Monday midnight is 0); hours of the
+    week without original readings use the mean of their hour of the day, then the overall mean.
+ 2. With temps, the differences from the profile are fit (least squares) to the heating and cooling degrees
+    ((55F - T)+ and (T - 65F)+ by default, each less its own hour-of-week mean), and the fit is added
+    to the profile.
+ 3. Each missing value is the expected value of step 1 (and 2) times a ratio: the original kwhs over the expected
+    ones in the context readings before the gap, blended linearly (by position in the gap) with the same ratio
+    after the gap. So a gap in a busy week is filled with a busy week.
+Imputed values keep oriflag = False; original values are never changed.
+
+Example:
+    impute_rec(d) #d["kwhs"] now has its gaps filled from its profile
+"""
+import  os
+import  sys
+import  numpy as np
+
+import  timeaxis as ta
+from    record_store import RecordStore
+
+default_balance = (55.0, 65.0) #heating and cooling balance points, in F
+
+def _slot_means(vals, valid, slots, num_slots):
+    """The mean of the valid values in each (row, slot), and their number: two (rows x num_slots) arrays."""
+    n    = vals.shape[0]
+    flat = (np.arange(n)[:, np.newaxis] * num_slots + slots)[valid]
+    num  = np.bincount(flat, minlength = n * num_slots).reshape(n, num_slots)
+    tot  = np.bincount(flat, weights = vals[valid], minlength = n * num_slots).reshape(n, num_slots)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        return tot / num, num
+
+def hour_of_week_profile(vals, valid, how):
+    """The mean of the valid values at each hour of the week, for each row: (rows x 168).
+    Empty hours of the week get the mean of their hour of the day, then the mean of the row (nan if it has none)."""
+    prof, num = _slot_means(vals, valid, how, 168)
+    by_day    = num.reshape(-1, 7, 24)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        hod = np.sum(np.where(by_day > 0, prof.reshape(-1, 7, 24) * by_day, 0), axis = 1) / np.sum(by_day, axis = 1)
+        avg = np.sum(np.where(num > 0, prof * num, 0), axis = 1) / np.sum(num, axis = 1)
+    hod  = np.where(np.isnan(hod), avg[:, np.newaxis], hod)
+    return np.where(num > 0, prof, np.tile(hod, 7))
+
+def _temp_adjustment(resid, valid, how, temps, temps_oriflag, balance):
+    """The fit (step 2 of the module docstring) of the residuals from the profile, at every reading."""
+    n      = resid.shape[0]
+    rows   = np.arange(n)[:, np.newaxis]
+    xs     = []
+    for x in (np.maximum(balance[0] - temps, 0), np.maximum(temps - balance[1], 0)):
+        xs.append(np.where(temps_oriflag, x - hour_of_week_profile(x, temps_oriflag, how)[rows, how], 0))
+    use    = valid & temps_oriflag
+    s11    = np.sum(np.where(use, xs[0] ** 2, 0), axis = 1)
+    s22    = np.sum(np.where(use, xs[1] ** 2, 0), axis = 1)
+    s12    = np.sum(np.where(use, xs[0] * xs[1], 0), axis = 1)
+    s1y    = np.sum(np.where(use, xs[0] * resid, 0), axis = 1)
+    s2y    = np.sum(np.where(use, xs[1] * resid, 0), axis = 1)
+    ridge  = 1e-6 * (s11 + s22) + 1e-12
+    det    = (s11 + ridge) * (s22 + ridge) - s12 ** 2
+    b1     = ((s22 + ridge) * s1y - s12 * s2y) / det
+    b2     = ((s11 + ridge) * s2y - s12 * s1y) / det
+    return b1[:, np.newaxis] * xs[0] + b2[:, np.newaxis] * xs[1]
+
+def profile_fill(kwhs, oriflag, how, temps = None, context = 24, balance = default_balance, max_ratio = 4.0):
+    """Fill the missing values of a series, or of each row of a matrix (see the module docstring).
+
+    Parameters:
+    kwhs, oriflag -- A 1-d series and its oriflag, or (buildings x times) arrays.
+    how -- The local hour of the week of each time (0 to 167; Calendar.hour_of_week), one row or one per building.
+    temps -- An optional (temps, temps_oriflag) pair of the same shape as kwhs, for the temperature adjustment.
+    context -- The number of readings before (and after) a gap whose level the fill is scaled to.
+    balance -- The heating and cooling balance points of the temperature adjustment.
+    max_ratio -- The scaling is clipped to [1 / max_ratio, max_ratio].
+
+    Returns (filled, oriflag): the original values with the missing ones filled, and the (unchanged) oriflag.
+    Rows without any original value are returned unchanged.
+    """
+    one_d   = np.ndim(kwhs) == 1
+    vals    = np.atleast_2d(np.asarray(kwhs, dtype = float))
+    ori     = np.atleast_2d(np.asarray(oriflag, dtype = bool)) & np.isfinite(vals)
+    n, t    = vals.shape
+    how     = np.broadcast_to(np.asarray(how, dtype = int), vals.shape)
+    rows    = np.arange(n)[:, np.newaxis]
+
+    expected = hour_of_week_profile(vals, ori, how)[rows, how]
+    if temps is not None:
+        tvals, tori = [np.atleast_2d(np.asarray(a)) for a in temps]
+        tvals    = tvals.astype(float)
+        tori     = tori.astype(bool) & np.isfinite(tvals)
+        tvals    = np.where(tori, tvals, 0)
+        expected = expected + _temp_adjustment(np.where(ori, vals - expected, 0), ori, how, tvals, tori, balance)
+
+    #the ratio of the original to the expected kwhs in the context readings on each side of each gap
+    pos     = np.arange(t)
+    left    = np.maximum.accumulate(np.where(ori, pos, -1), axis = 1)
+    right   = np.minimum.accumulate(np.where(ori, pos, t)[:, ::-1], axis = 1)[:, ::-1]
+    zero    = np.zeros((n, 1))
+    c_vals  = np.hstack([zero, np.cumsum(np.where(ori, vals, 0), axis = 1)])
+    c_exp   = np.hstack([zero, np.cumsum(np.where(ori, expected, 0), axis = 1)])
+    def ratio(lo, hi):
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            den = c_exp[rows, hi] - c_exp[rows, lo]
+            r   = (c_vals[rows, hi] - c_vals[rows, lo]) / den
+        return np.where(den > 0, np.clip(r, 1.0 / max_ratio, max_ratio), 1.0)
+    r_left  = ratio(np.maximum(left - context + 1, 0), left + 1)
+    r_right = ratio(np.minimum(right, t), np.minimum(right + context, t))
+    has_l   = left >= 0
+    has_r   = right < t
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        w   = np.where(has_l & has_r, (pos - left) / np.maximum(right - left, 1).astype(float), 0)
+    scale   = np.where(has_l, np.where(has_r, (1 - w) * r_left + w * r_right, r_left), np.where(has_r, r_right, 1.0))
+
+    lowest  = np.min(np.where(ori, vals, np.inf), axis = 1)[:, np.newaxis]
+    filled  = np.where(ori, vals, np.maximum(scale * expected, np.minimum(lowest, 0)))
+    filled  = np.where(ori.any(axis = 1)[:, np.newaxis], filled, vals)
+    oriflag = np.asarray(oriflag, dtype = bool)
+    return (filled[0] if one_d else filled), oriflag
+
+def impute_rec(d, use_temps = True, **kwargs):
+    """Fill the missing kwhs of building record d in place (see profile_fill; keyword arguments are passed on).
+    The temperature adjustment is used if use_temps and the record has temps.
+    Returns the number of values filled."""
+    kwhs, kwhs_oriflag = d["kwhs"]
+    temps  = d["temps"] if use_temps and "temps" in d else None
+    how    = ta.get_calendar(d).hour_of_week
+    filled, kwhs_oriflag = profile_fill(kwhs, kwhs_oriflag, how, temps, **kwargs)
+    d["kwhs"] = (filled, kwhs_oriflag)
+    return len(kwhs_oriflag) - int(np.count_nonzero(kwhs_oriflag))
+
+def impute_brecs(brecs, store = None, **kwargs):
+    """Fill the missing kwhs of each of an iterable of building records, one at a time (see impute_rec).
+    If store (a RecordStore) is given, each record is saved to it. Returns the total number of values filled."""
+    total = 0
+    for d in brecs:
+        total += impute_rec(d, **kwargs)
+        if store is not None:
+            store.put(d)
+    return total
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or not os.path.isdir(sys.argv[1]):
+        print "Usage: python impute.py <record store dir>"
+        exit()
+    store = RecordStore(sys.argv[1])
+    print "Filled", impute_brecs(store, store), "values of", len(store), "records"
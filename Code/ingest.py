@@ -0,0 +1,294 @@
+"""Streaming ingestion of raw smart-meter exports (CSV/TSV interval rows) into building records.
+
+Ingestion runs in two passes, so memory stays bounded no matter how big the exports are:
+ 1. Each file is read in chunks of rows (one worker process per file). The readings of each chunk are
+    grouped by meter/building id and appended to a spill file per id (binary epoch/value pairs).
+ 2. Each building's spill files are read back (one worker process per building), sorted by time,
+    de-duplicated (the reading read last wins), gridded onto the hourly time axis of the record
+    (oriflag = False where no reading was found), cleaned (missing kwhs are filled from the building's
+    hour-of-week profile, see impute), and written to a RecordStore.
+
+Naive ISO time stamps are local wall-clock times of the records' time zone (converted with its DST rules,
+see timeaxis.from_local), unless a fixed UTC offset is given; stamps ending in "Z" or an offset (e.g., "-05:00")
+are exact instants.
+
+Usage:
+    python ingest.py [--tz <time zone>] [--utc-offset <hours>] [--fill <profile|ffill>] <store dir>
+                     <start date (YYYY-mm-dd)> <num days> <id col> <time col> <kwh col> <file> [<file> ...]
+The records start at local midnight of the start date in the time zone (US/Central by default).
+--fill ffill keeps the forward-filled gaps of the gridding instead of the profile imputation.
+"""
+import  os
+import  sys
+import  csv
+import  shutil
+import  urllib
+import  datetime
+import  tempfile
+import  itertools
+import  multiprocessing
+import  numpy as np
+import  pytz
+
+import  analytics as an
+import  clean_brecs
+import  timeaxis as ta
+from    record_store import RecordStore
+
+tz_used     = pytz.timezone("US/Central")
+spill_dtype = np.dtype([("epoch", np.int64), ("val", np.float64), ("temp", np.float64)])
+_bad_time   = np.iinfo(np.int64).min #the parsed time of time stamps which cannot be read (also NaT's)
+
+def parse_times(strs, time_format = "iso", tz = None, utc_offset = None):
+    """Parse a list of time stamps into seconds since the epoch (UTC), vectorized.
+
+    Parameters:
+    strs -- The time stamps (strings).
+    time_format -- "epoch" (seconds since the epoch) or "iso" (e.g., "2012-01-31 13:00:00").
+    tz -- For naive "iso" time stamps, the time zone (or its name) of their wall-clock times (UTC if None).
+    utc_offset -- For naive "iso" time stamps, a fixed offset from UTC in seconds (e.g., -6 * 3600 for
+                  US Central standard time), used instead of tz.
+    "iso" time stamps ending in "Z" or an offset from UTC (e.g., "2012-01-31T13:00:00-06:00") are exact instants.
+    Time stamps which cannot be read get _bad_time (they are parsed one at a time only if some fail).
+    """
+    if time_format == "epoch":
+        try:
+            secs = np.array(strs, dtype = float)
+        except ValueError:
+            secs = np.array([_to_float(s) for s in strs], dtype = float)
+        ok = np.isfinite(secs)
+        return np.where(ok, np.where(ok, secs, 0).astype(np.int64), _bad_time)
+    elif time_format == "iso":
+        parts   = [_split_offset(s.strip().replace(" ", "T")) for s in strs]
+        try:
+            local = np.array([p[0] for p in parts], dtype = "datetime64[s]")
+        except ValueError:
+            local = np.array([_to_datetime64(p[0]) for p in parts], dtype = "datetime64[s]")
+        local   = local.astype(np.int64)
+        bad     = local == _bad_time
+        local   = np.where(bad, 0, local)
+        offsets = np.array([p[1] for p in parts], dtype = float)
+        if utc_offset is not None:
+            epochs = local - utc_offset
+        elif tz is not None:
+            epochs = ta.from_local(local, ta.get_tz(tz))
+        else:
+            epochs = local
+        aware   = ~np.isnan(offsets)
+        epochs  = np.where(aware, local - np.where(aware, offsets, 0).astype(np.int64), epochs)
+        return np.where(bad, _bad_time, epochs)
+    else:
+        raise ValueError("time_format must be 'epoch' or 'iso'.")
+
+def _to_datetime64(s):
+    try:
+        return np.datetime64(s, "s")
+    except ValueError:
+        return np.datetime64("NaT", "s")
+
+def _split_offset(stamp):
+    """Split an ISO time stamp into its naive part and its offset from UTC in seconds (nan if it has none)."""
+    if stamp.endswith("Z"):
+        return stamp[:-1], 0.0
+    tail = stamp[stamp.find("T") + 1:] if "T" in stamp else ""
+    for sign in "+-":
+        k = tail.rfind(sign)
+        if k >= 0:
+            hhmm = tail[k + 1:].replace(":", "")
+            if hhmm.isdigit() and len(hhmm) in (2, 4):
+                secs = int(hhmm[:2]) * 3600 + int(hhmm[2:] or 0) * 60
+                return stamp[:len(stamp) - len(tail) + k], float(secs if sign == "+" else -secs)
+    return stamp, np.nan
+
+def _delimiter(fname):
+    return "\t" if fname.endswith(".tsv") or fname.endswith(".tab") else ","
+
+def _col(header, col):
+    return col if isinstance(col, int) else header.index(col)
+
+def _spill_name(spill_dir, bid):
+    return os.path.join(spill_dir, urllib.quote(str(bid), safe = "") + ".bin")
+
+def spill_file(args):
+    """First pass over one file: read it in chunks, and append each id's readings to its spill file.
+    Rows whose time stamp cannot be read are dropped.
+    Returns the set of ids found (with readings), and a dictionary mapping ids to their number of dropped rows."""
+    fname, spill_dir, cols, time_format, tz, utc_offset, chunk_rows = args
+    id_col, time_col, val_col, temp_col = cols
+    if not os.path.isdir(spill_dir):
+        os.makedirs(spill_dir)
+    ids_found = set()
+    bad_times = {}
+    with open(fname, "rb") as fin:
+        reader = csv.reader(fin, delimiter = _delimiter(fname))
+        header = [h.strip() for h in reader.next()]
+        ic, tc, vc = _col(header, id_col), _col(header, time_col), _col(header, val_col)
+        pc = None if temp_col is None else _col(header, temp_col)
+        while True:
+            rows = list(itertools.islice(reader, chunk_rows))
+            if not rows:
+                break
+            rows   = [r for r in rows if len(r) > max(ic, tc, vc)]
+            chunk  = np.empty(len(rows), dtype = spill_dtype)
+            ids    = np.array([r[ic].strip() for r in rows])
+            chunk["epoch"] = parse_times([r[tc] for r in rows], time_format, tz, utc_offset)
+            chunk["val"]   = [_to_float(r[vc]) for r in rows]
+            chunk["temp"]  = [_to_float(r[pc]) if pc is not None and len(r) > pc else np.nan for r in rows]
+            bad    = chunk["epoch"] == _bad_time
+            if bad.any():
+                for bid in ids[bad]:
+                    bad_times[bid] = bad_times.get(bid, 0) + 1
+                ids, chunk = ids[~bad], chunk[~bad]
+
+            #group the chunk by id (one sort), then append each group to its spill file
+            order  = np.argsort(ids, kind = "mergesort") #stable, so the order of the readings is kept
+            ids    = ids[order]
+            chunk  = chunk[order]
+            uids, first = np.unique(ids, return_index = True)
+            bounds = list(first) + [len(ids)]
+            for i, bid in enumerate(uids):
+                with open(_spill_name(spill_dir, bid), "ab") as fout:
+                    chunk[bounds[i]:bounds[i + 1]].tofile(fout)
+            ids_found.update(uids)
+    return ids_found, bad_times
+
+def _to_float(s):
+    try:
+        return float(s)
+    except ValueError:
+        return np.nan
+
+def grid_readings(epochs, vals, start_epoch, num_obs, step = 3600, how = "sum"):
+    """Put readings onto a regular time axis.
+    Readings must be sorted by time; of several readings for the same time, the last one is used.
+
+    Parameters:
+    epochs, vals -- The times (seconds since the epoch) and values of the readings.
+    start_epoch, num_obs, step -- The time axis: num_obs times start_epoch, start_epoch + step, ...
+    how -- How readings within a step are combined: "sum" (e.g., four 15-minute kwhs make an hourly kwh)
+           or "mean" (e.g., temperatures).
+
+    Returns (values, oriflag). Times without a (valid) reading have oriflag = False and the last original value.
+    """
+    #de-duplicate: keep the last valid reading of each time stamp
+    ok     = np.isfinite(vals)
+    epochs, vals = epochs[ok], vals[ok]
+    last   = np.ones(len(epochs), dtype = bool)
+    last[:-1] = epochs[1:] != epochs[:-1]
+    epochs, vals = epochs[last], vals[last]
+
+    ok     = epochs >= start_epoch
+    inds   = (epochs[ok] - start_epoch) // step
+    keep   = inds < num_obs
+    inds   = inds[keep]
+    totals = np.bincount(inds, weights = vals[ok][keep], minlength = num_obs)
+    counts = np.bincount(inds, minlength = num_obs)
+    oriflag = counts > 0
+    if how == "mean":
+        totals = totals / np.maximum(counts, 1)
+    return an.forward_fill(totals, oriflag), oriflag
+
+def build_brec(args):
+    """Second pass for one building: gather its spill files, grid the readings, clean, and store the record."""
+    bid, spill_dirs, store_path, start, num_obs, meta, clean, fill = args
+    parts = []
+    for spill_dir in spill_dirs: #in the order the files were given
+        fname = _spill_name(spill_dir, bid)
+        if os.path.exists(fname):
+            parts.append(np.fromfile(fname, dtype = spill_dtype))
+    readings = np.concatenate(parts)
+    readings = readings[np.argsort(readings["epoch"], kind = "mergesort")] #stable: duplicates stay in file order
+
+    start_epoch = ta.to_epoch(start)
+    kwhs,  kwhs_oriflag  = grid_readings(readings["epoch"], readings["val"],  start_epoch, num_obs)
+    temps, temps_oriflag = grid_readings(readings["epoch"], readings["temp"], start_epoch, num_obs, how = "mean")
+
+    d = {"bid"  : bid,
+         "naics": meta.get("naics"),
+         "btype": meta.get("btype"),
+         "times": ta.make_times(start_epoch, num_obs),
+         "tz"   : ta.tz_name(start.tzinfo),
+         "kwhs" : (kwhs, kwhs_oriflag),
+         "temps": (temps, temps_oriflag)}
+    counts = clean_brecs.clean_rec(d, fill = fill) if clean else {}
+    RecordStore(store_path).put(d)
+    return bid, int(np.count_nonzero(kwhs_oriflag)), counts
+
+def ingest(fnames, store, id_col, time_col, val_col, start, num_days = 365, temp_col = None,
+           time_format = "iso", tz = None, utc_offset = None, chunk_rows = 500000, workers = None, meta = None,
+           clean = True, fill = "profile", spill_root = None):
+    """Ingest meter exports into a RecordStore.
+
+    Parameters:
+    fnames -- The CSV/TSV files (".tsv" files are tab separated). The first row of each must be a header.
+    store -- The RecordStore the building records are written to.
+    id_col, time_col, val_col -- The columns (names or indices) of the meter/building id, time stamp and kwh.
+    start -- The first time of the records (a tz-aware datetime, whose time zone becomes the records' one;
+             the records are hourly).
+    num_days -- The length of the records, in days.
+    temp_col -- The column of the outdoor temperature, if the exports have one.
+    time_format, tz, utc_offset -- How to parse the time stamps (see parse_times). Naive ISO time stamps are
+                                   wall-clock times of tz, which defaults to the time zone of start.
+    chunk_rows -- The number of rows read at a time (this bounds the memory used per worker).
+    workers -- The number of worker processes (defaults to the number of CPUs).
+    meta -- A dictionary mapping ids to dictionaries with their "naics" and "btype".
+    clean -- If True, each record is cleaned (clean_brecs.clean_rec) before it is stored.
+    fill -- How the cleaning fills missing values (see clean_brecs.clean_rec): "profile" (the default) imputes the
+            missing kwhs from the building's hour-of-week profile; "ffill" keeps the forward-filled gaps of the
+            gridding (as does clean = False).
+    spill_root -- A directory for the spill files (a temporary one by default; removed when done).
+
+    Returns a dictionary mapping each id to (number of hours with a reading, counts of rejected values).
+    The counts include "bad_time", the number of rows dropped because their time stamp could not be read
+    (ids with no other rows get no record).
+    """
+    meta      = meta or {}
+    own_spill = spill_root is None
+    if own_spill:
+        spill_root = tempfile.mkdtemp(prefix = "ingest_")
+    spill_dirs = [os.path.join(spill_root, "f%d" % i) for i in range(len(fnames))]
+    cols       = (id_col, time_col, val_col, temp_col)
+    tz         = ta.tz_name(tz or start.tzinfo)
+    pool       = multiprocessing.Pool(workers)
+    try:
+        found = pool.map(spill_file, [(f, s, cols, time_format, tz, utc_offset, chunk_rows)
+                                      for f, s in zip(fnames, spill_dirs)])
+        bids  = sorted(set().union(*[ids for ids, _ in found])) if found else []
+        bad   = {}
+        for _, bad_times in found:
+            for bid, num in bad_times.items():
+                bad[bid] = bad.get(bid, 0) + num
+        jobs  = [(bid, spill_dirs, store.path, start, num_days * 24, meta.get(bid, {}), clean, fill) for bid in bids]
+        toR   = dict((bid, (0, {"bad_time": num})) for bid, num in bad.items())
+        for bid, num_ori, counts in pool.imap_unordered(build_brec, jobs):
+            counts["bad_time"] = bad.get(bid, 0)
+            toR[bid] = (num_ori, counts)
+        return toR
+    finally:
+        pool.close()
+        pool.join()
+        if own_spill:
+            shutil.rmtree(spill_root, ignore_errors = True)
+
+if __name__ == "__main__":
+    args = sys.argv[:]
+    tz, utc_offset, fill = tz_used, None, "profile"
+    while len(args) > 2 and args[1] in ("--tz", "--utc-offset", "--fill"):
+        if args[1] == "--tz":
+            tz = pytz.timezone(args[2])
+        elif args[1] == "--fill":
+            fill = args[2]
+        else:
+            utc_offset = int(round(float(args[2]) * 3600))
+        args = args[:1] + args[3:]
+    if len(args) < 8:
+        print __doc__
+        exit()
+    store = RecordStore(args[1])
+    start = tz.localize(datetime.datetime.strptime(args[2], "%Y-%m-%d"))
+    results = ingest(args[7:], store, args[4], args[5], args[6], start, num_days = int(args[3]),
+                     utc_offset = utc_offset, fill = fill)
+    print "Ingested", len(results), "buildings into", store.path
+    num_bad = sum(counts.get("bad_time", 0) for _, counts in results.values())
+    if num_bad:
+        print "Dropped", num_bad, "rows with unreadable time stamps"
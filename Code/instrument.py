@@ -0,0 +1,177 @@
+"""Timing and memory instrumentation for report pages (add_fig) and figure functions (make_*).
+
+Example:
+    rec = Recorder(fout = open("profile.jsonl", "w"))
+    for d in brecs:
+        plotter_new.multi_plot(d, recorder = rec)
+    rec.print_summary()
+"""
+import  os
+import  sys
+import  json
+import  time
+import  functools
+from    utils import peak_rss
+
+class Recorder(object):
+    """Collects one measurement per page (or figure function) and building.
+
+    A measurement is a dictionary with:
+        kind     -- "page" (an add_fig page) or "make" (a make_* function).
+        name     -- The page or function name.
+        bid      -- The building id.
+        page     -- The page being drawn when a make_* function was called (None for pages).
+        wall     -- Wall-clock time, in seconds.
+        cpu      -- CPU time of the process, in seconds.
+        rss_peak_delta -- Growth of the peak resident set size, in MB.
+        artists  -- The number of matplotlib artists added.
+
+    Parameters:
+    callback -- If given, called with each measurement as soon as it is made.
+    fout -- If given, a file each measurement is written to (as a JSON line).
+    keep -- If True (default), measurements are kept in memory (in self.records) for summary().
+    """
+    def __init__(self, callback = None, fout = None, keep = True):
+        self.callback = callback
+        self.fout     = fout
+        self.keep     = keep
+        self.records  = []
+        self.pages    = [] #stack of the pages being drawn
+
+    def measure(self, kind, name, bid, axes = None):
+        """Return a context manager measuring the code it wraps.
+        axes -- The axes drawn on (if None, artists are counted over the figures created)."""
+        return _Measurement(self, kind, name, bid, axes)
+
+    def emit(self, record):
+        if self.keep:
+            self.records.append(record)
+        if self.fout is not None:
+            self.fout.write(json.dumps(record) + "\n")
+            self.fout.flush()
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self, kind = None):
+        """Aggregate the measurements (across buildings) by kind and name.
+        Returns a list of rows (dictionaries), slowest first."""
+        groups = {}
+        for r in self.records:
+            if kind is not None and r["kind"] != kind:
+                continue
+            groups.setdefault((r["kind"], r["name"]), []).append(r)
+        toR = []
+        for (k, name), rs in groups.items():
+            walls = [r["wall"] for r in rs]
+            toR.append({"kind"          : k,
+                        "name"          : name,
+                        "count"         : len(rs),
+                        "num_brecs"     : len(set(r["bid"] for r in rs)),
+                        "total_wall"    : sum(walls),
+                        "mean_wall"     : sum(walls) / len(walls),
+                        "max_wall"      : max(walls),
+                        "total_cpu"     : sum(r["cpu"] for r in rs),
+                        "max_rss_delta" : max(r["rss_peak_delta"] for r in rs),
+                        "mean_artists"  : sum(r["artists"] for r in rs) / float(len(rs))})
+        toR.sort(key = (lambda row: row["total_wall"]), reverse = True)
+        return toR
+
+    def print_summary(self, kind = None, fout = sys.stdout):
+        """Print the summary as a table."""
+        rows   = self.summary(kind)
+        header = ["kind", "name", "count", "total_wall", "mean_wall", "max_wall", "total_cpu", "max_rss_delta", "mean_artists"]
+        fout.write("kind".ljust(6) + "name".ljust(30) + "".join(h.rjust(14) for h in header[2:]) + "\n")
+        for row in rows:
+            cells = [row["kind"].ljust(6), row["name"].ljust(30)]
+            for h in header[2:]:
+                val = row[h]
+                cells.append(("%.3f" % val if isinstance(val, float) else str(val)).rjust(14))
+            fout.write("".join(cells) + "\n")
+
+class _Measurement(object):
+    def __init__(self, recorder, kind, name, bid, axes):
+        self.recorder = recorder
+        self.kind     = kind
+        self.name     = name
+        self.bid      = bid
+        self.axes     = axes
+
+    def __enter__(self):
+        self.page = self.recorder.pages[-1] if self.recorder.pages else None
+        if self.kind == "page":
+            self.recorder.pages.append(self.name)
+        self.artists = _count_artists(self.axes)
+        self.figs    = _fignums()
+        self.rss     = peak_rss()
+        self.cpu     = _cpu_time()
+        self.wall    = time.time()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.time() - self.wall
+        cpu  = _cpu_time() - self.cpu
+        rss  = peak_rss() - self.rss
+        if self.axes is None:
+            artists = _count_artists(new_figs = _fignums() - self.figs)
+        else:
+            artists = _count_artists(self.axes) - self.artists
+        if self.kind == "page":
+            self.recorder.pages.pop()
+        self.recorder.emit({"kind"          : self.kind,
+                            "name"          : self.name,
+                            "bid"           : self.bid,
+                            "page"          : self.page,
+                            "wall"          : wall,
+                            "cpu"           : cpu,
+                            "rss_peak_delta": rss,
+                            "artists"       : artists})
+        return False
+
+def _cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+def _fignums():
+    plt = sys.modules.get("matplotlib.pyplot") #only look if matplotlib is already in use
+    if plt is None:
+        return set()
+    return set(plt.get_fignums())
+
+def _count_artists(axes = None, new_figs = ()):
+    if axes is not None:
+        return sum(len(ax.findobj()) for ax in axes)
+    if not new_figs:
+        return 0
+    from matplotlib._pylab_helpers import Gcf #plt.figure(num) would change the current figure
+    managers = [Gcf.figs.get(num) for num in new_figs]
+    return sum(len(m.canvas.figure.findobj()) for m in managers if m is not None)
+
+def instrument_makers(module, recorder):
+    """Wrap every make_* function of module so each call is measured by recorder.
+    The building record must be the first argument of the function; axes passed as
+    arguments are used to count artists.
+
+    Returns a function which undoes the wrapping.
+    """
+    originals = {}
+    for name, fun in vars(module).items():
+        if name.startswith("make_") and callable(fun) and not hasattr(fun, "_instrumented"):
+            originals[name] = fun
+            setattr(module, name, _wrap_maker(name, fun, recorder))
+
+    def undo():
+        for name, fun in originals.items():
+            setattr(module, name, fun)
+    return undo
+
+def _wrap_maker(name, fun, recorder):
+    @functools.wraps(fun)
+    def wrapped(*args, **kwargs):
+        bid  = None
+        if args and isinstance(args[0], dict):
+            bid = args[0].get("bid")
+        axes = [a for a in list(args[1:]) + kwargs.values() if hasattr(a, "findobj") and hasattr(a, "get_figure")]
+        with recorder.measure("make", name, bid, axes):
+            return fun(*args, **kwargs)
+    wrapped._instrumented = True
+    return wrapped
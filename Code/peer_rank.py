@@ -0,0 +1,207 @@
+"""Peer percentile ranks of Building Report features: "your weekend baseload is higher than 80% of similar buildings".
+
+A PeerIndex keeps, for every feature and every peer group (all buildings, and each btype and naics),
+the sorted array of the values of the buildings in the group. The percentile of any value is then two
+np.searchsorted calls (O(log n)): the share of the group with a lower value, counting ties as half.
+When a building's report changes, its old values are taken out of the arrays of its groups and the new ones
+put in at their sorted positions, so the index is never rebuilt from scratch.
+
+Example:
+    index = PeerIndex.from_table(ReportDB(data_loc + "reports.sqlite").agg_table())
+    print index.rank(report_card.get_report(d), {"btype": d["btype"], "naics": d["naics"]})["avg"]
+    bids, ranks = index.rank_all("btype") #every feature of every building, against its btype
+"""
+import  sys
+import  cPickle as pickle
+import  numpy as np
+
+from    agg_table import _encode
+
+default_by = ("btype", "naics")
+
+def percentiles(sorted_vals, vals):
+    """The percentiles of vals among sorted_vals: 100 times the share of sorted_vals lower than each value
+    (values equal to it count as half). nan for nan values, or if sorted_vals is empty."""
+    vals = np.asarray(vals, dtype = float)
+    if len(sorted_vals) == 0:
+        return vals * np.nan
+    lo = np.searchsorted(sorted_vals, vals, side = "left")
+    hi = np.searchsorted(sorted_vals, vals, side = "right")
+    return np.where(np.isnan(vals), np.nan, 100.0 * (lo + 0.5 * (hi - lo)) / len(sorted_vals))
+
+class PeerIndex(object):
+    """Sorted feature values per peer group (see the module docstring).
+
+    Parameters:
+    by -- The categories defining peer groups (besides "all", every building).
+    """
+    def __init__(self, by = default_by):
+        self.by      = list(by)
+        self.groups  = {} #(category, label) -> {feature: sorted array}; ("all", None) for every building
+        self.members = {} #bid -> (labels of its groups, {feature: value})
+
+    @classmethod
+    def from_table(cls, agg, by = default_by, features = None):
+        """Build an index from an AggTable (e.g., report_card.agg_reports or ReportDB.agg_table),
+        with one sort per feature and category."""
+        index    = cls([b for b in by if b in agg.categoricals])
+        features = agg.features() if features is None else list(features)
+        labels   = zip(*[agg[b] for b in index.by]) if index.by else [()] * len(agg)
+        cols     = [(f, np.where(np.isfinite(agg.columns[f]), agg.columns[f], np.nan).tolist()) for f in features]
+        for i, bid in enumerate(agg.bids):
+            index.members[bid] = (tuple(labels[i]), dict((f, c[i]) for f, c in cols if c[i] == c[i])) #nan != nan
+        cats = [("all", np.zeros(len(agg), dtype = int), [None])]
+        cats.extend((b, agg.categoricals[b][0], agg.categoricals[b][1]) for b in index.by)
+        for name, codes, group_labels in cats:
+            for f in features:
+                vals  = agg.columns[f]
+                ok    = np.isfinite(vals)
+                order = np.lexsort((vals[ok], codes[ok])) #by group, then by value
+                svals = vals[ok][order]
+                count = np.bincount(codes[ok], minlength = len(group_labels))
+                ends  = np.cumsum(count)
+                for g, label in enumerate(group_labels):
+                    index.groups.setdefault((name, label), {})[f] = svals[ends[g] - count[g]:ends[g]]
+        return index
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, bid):
+        return bid in self.members
+
+    def _keys(self, labels):
+        """The peer groups of a building with the given labels (one per category of self.by)."""
+        return [("all", None)] + zip(self.by, labels)
+
+    def remove(self, bid):
+        """Take the values of a building out of the index (KeyError if it is not in it)."""
+        labels, vals = self.members.pop(bid)
+        for key in self._keys(labels):
+            group = self.groups[key]
+            for f, v in vals.items():
+                arr      = group[f]
+                group[f] = np.delete(arr, np.searchsorted(arr, v))
+
+    def update(self, bid, report, labels):
+        """Put (or replace) the report of a building in the index.
+
+        Parameters:
+        bid -- The building id.
+        report -- Its Building Report (non-numeric and nan values are left out).
+        labels -- Its categories, a dictionary (e.g., {"btype": ..., "naics": ...}).
+        """
+        if bid in self.members:
+            self.remove(bid)
+        labels = tuple(labels.get(b) for b in self.by)
+        vals   = {}
+        for f, v in report.items():
+            v = _number(v)
+            if np.isfinite(v):
+                vals[f] = v
+        self.members[bid] = (labels, vals)
+        for key in self._keys(labels):
+            group = self.groups.setdefault(key, {})
+            for f, v in vals.items():
+                arr      = group.get(f, np.zeros(0))
+                group[f] = np.insert(arr, np.searchsorted(arr, v), v)
+
+    def update_table(self, agg):
+        """Put (or replace) the reports of every building of an AggTable in the index."""
+        labels = dict((b, agg[b]) for b in self.by if b in agg.categoricals)
+        for i, bid in enumerate(agg.bids):
+            self.update(bid, dict((f, col[i]) for f, col in agg.columns.items()),
+                        dict((b, l[i]) for b, l in labels.items()))
+
+    def percentile(self, feature, value, category = "all", label = None):
+        """The percentile of a value of a feature among a peer group (nan if the group has no values)."""
+        arr = self.groups.get((category, label), {}).get(feature, np.zeros(0))
+        return float(percentiles(arr, [value])[0])
+
+    def rank(self, report, labels = None):
+        """The percentiles of the values of a report (e.g., from get_report, for a building in the index or not).
+        Returns a dictionary mapping each numeric feature to a dictionary of percentiles, one per peer group
+        ("all", and each category of self.by given in labels)."""
+        labels = labels or {}
+        toR    = {}
+        for f, v in report.items():
+            v = _number(v)
+            if np.isnan(v):
+                continue
+            toR[f] = {"all": self.percentile(f, v)}
+            for b in self.by:
+                if b in labels:
+                    toR[f][b] = self.percentile(f, v, b, labels[b])
+        return toR
+
+    def rank_all(self, category = "all", features = None):
+        """The percentile of every feature of every building in the index, among its peer group of a category.
+        Returns (bids, ranks): the bids, and a dictionary mapping each feature to an array of percentiles."""
+        bids   = list(self.members)
+        pos    = 0 if category == "all" else self.by.index(category) + 1
+        labels = [(None,) + self.members[b][0] for b in bids]
+        codes, group_labels = _encode([l[pos] for l in labels])
+        if features is None:
+            features = sorted(set(f for key in self.groups for f in self.groups[key]))
+        ranks  = {}
+        order  = np.argsort(codes, kind = "mergesort")
+        count  = np.bincount(codes, minlength = len(group_labels))
+        ends   = np.cumsum(count)
+        for f in features:
+            vals = np.array([self.members[b][1].get(f, np.nan) for b in bids])
+            pct  = np.zeros(len(bids)) + np.nan
+            for g, label in enumerate(group_labels):
+                rows = order[ends[g] - count[g]:ends[g]]
+                arr  = self.groups.get((category, label), {}).get(f, np.zeros(0))
+                pct[rows] = percentiles(arr, vals[rows])
+            ranks[f] = pct
+        return np.array(bids, dtype = object), ranks
+
+    def extremes(self, bid, category = "btype", num = 5):
+        """The features of a building in the index which are the most unusual among its peers (of a category):
+        a list of (feature, percentile), the percentiles farthest from 50 first."""
+        labels, vals = self.members[bid]
+        label = None if category == "all" else labels[self.by.index(category)]
+        pcts  = [(f, self.percentile(f, v, category, label)) for f, v in vals.items()]
+        pcts  = [(f, p) for f, p in pcts if np.isfinite(p)]
+        return sorted(pcts, key = lambda fp: -abs(fp[1] - 50))[:num]
+
+    def save(self, fname):
+        with open(fname, "wb") as fout:
+            pickle.dump(self, fout, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, "rb") as fin:
+            return pickle.load(fin)
+
+def _number(v):
+    """A report value as a float (nan for masked, missing and non-numeric values)."""
+    if v is None or v is np.ma.masked or isinstance(v, (basestring, bool)):
+        return np.nan
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+def describe(feature, pct, peers = "similar buildings"):
+    """A sentence for a percentile, e.g. "avg_weekend_min is higher than 80% of similar buildings"."""
+    if pct >= 50:
+        return "%s is higher than %d%% of %s" % (feature, int(pct), peers)
+    return "%s is lower than %d%% of %s" % (feature, int(100 - pct), peers)
+
+if __name__ == "__main__":
+    from report_db import ReportDB
+    if len(sys.argv) < 3:
+        print "Usage: python peer_rank.py <reports database> <bid> [btype|naics|all]"
+        exit()
+    db       = ReportDB(sys.argv[1])
+    index    = PeerIndex.from_table(db.agg_table())
+    bid      = sys.argv[2]
+    if bid not in index:
+        bid = int(bid) #bids are often numbers
+    category = sys.argv[3] if len(sys.argv) > 3 else "btype"
+    labels   = index.members[bid][0]
+    peers    = "buildings" if category == "all" else "%s buildings" % labels[index.by.index(category)]
+    for f, pct in index.extremes(bid, category, num = 10):
+        print describe(f, pct, peers)
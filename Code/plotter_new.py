@@ -1,9 +1,17 @@
 from    utils import *
+from    analytics import get_periods, period_inds, gen_peaks, gen_holidays, gen_strange_pers, gen_over_thresh, get_times_of_highest_change
 import  report_card
+import  spectral
+import  stft
+import  baseload
+import  savings
+import  timeaxis as ta
+import  instrument
+import  os
+from    record_store import RecordStore
 import  matplotlib
 #matplotlib.use('Agg')
 from    matplotlib.backends.backend_pdf import PdfPages
-import  ephem
 import  copy
 import  math
 import  sys
@@ -13,17 +21,14 @@ from    datetime import datetime
 import  time as itime
 import  matplotlib.pyplot as plt
 from    matplotlib.colors import LogNorm
+import  matplotlib.dates as mdates
 import  cPickle as pickle
 import  pytz
 import  heapq
-from    sklearn.cluster import KMeans
-from    sklearn import mixture
 from    holiday import yfhol
 import  warnings
 
 utc_tz  = pytz.utc
-tz_used = pytz.timezone("US/Central")
-#tz_used = pytz.timezone("America/Chicago")
 
 
 def getSun(stateID, currentTime, city = None):
@@ -31,16 +36,20 @@ def getSun(stateID, currentTime, city = None):
     
     Parameters:
     stateID  -- A string abbreviation of the state name, ie "IL","AZ",etc..
-    currentTime -- Local time with tzinfo = state time zone.
+    currentTime -- Local time with tzinfo = state time zone (or a naive UTC time, see timeaxis.utc_datetimes).
     city (optional) -- The City  (defaults to state capital if missing or not found in database).
     
     Returns:
     sin(altitude) (representing how much sunlight hits an area)
     """
         #Note:  altitude,azimuth are given in radians
+    import ephem #imported here, as only the sunlight figures need it
     o = ephem.Observer()    
     stateID.capitalize()
-    dateStamp=currentTime.astimezone(pytz.utc)
+    if currentTime.tzinfo is None:
+        dateStamp=currentTime
+    else:
+        dateStamp=currentTime.astimezone(pytz.utc)
     if city is None:
         city=states[stateID]['capital']        
     else:
@@ -62,55 +71,6 @@ def getSun(stateID, currentTime, city = None):
 
     return math.sin(alt)
 
-def get_periods(di, nobs, first_pred, which = "kwhs", skip_fun = (lambda x: False), wrap_around = False):
-    """Get a collection of periods (e.g., weeks) from a building record.
-
-    Parameters:
-    di -- The building record.
-    nobs -- The number (int) of observations for a single period (e.g., 168 for weeks).
-    first_pred -- A function which, given a datetime object, returns True if it is the start of the period.
-                  For example, first_pred returns True only when the argument is Sunday at Midnight.
-    which -- A string representing which time series in the building record to use (defaults to "kwhs")
-    skip_fun -- A function which takes a datetime object and returns True if that time should be skipped.
-                For example, skip_fun may return True on weekends, to obtain only work weeks.
-    wrap_around -- If True, the beginning part of the time series is placed at the end.
-                   For example, if we're starting periods on Monday, but the first day in the time series 
-                   is Thursday, then the first part (from Thrusday to Monday) will be moved to the end.
-
-    Returns (pers, new_times):
-         pers -- The values (e.g., kwhs) of the periods.
-         new_times -- The times (datetime objects) associated with the values.
-    """
-    d = copy.deepcopy(di) #used so that we don't change di at all
-    times                  = d["times"]
-    series, series_oriflag = d[which]
-    
-    additional_mask = np.array([skip_fun(t) for t in times])
-    new_mask = np.logical_or((~series_oriflag), additional_mask)
-    masked_series = np.ma.array(series, mask = new_mask)
-    
-    first = 0
-    for ind, t in enumerate(times):
-        if first_pred(t):
-            first = ind
-            break
-    if wrap_around:
-        pers      = np.ma.concatenate([masked_series[first:], masked_series[:first]])
-        new_times = np.ma.concatenate([times[first:], times[:first]])
-    else:
-        pers      = masked_series[first:]
-        new_times = times[first:]
-
-    residue = len(pers) % nobs
-    if residue != 0:
-        pers      = pers[:-residue]#trim off extra
-        new_times = new_times[:-residue]
-
-    pers      = pers.reshape(-1, nobs)
-    new_times = new_times.reshape(-1, nobs)
-    return pers, new_times
-
-
 def make_text_fig(d, textfig):
     """Show the static information from the building record in a given axis.
 
@@ -124,7 +84,7 @@ def make_text_fig(d, textfig):
     times                = d["times"]
     kwhs, kwhs_oriflag   = d["kwhs"]
     temps, temps_oriflag = d["temps"]
-    naics_map, desc = qload("NAICS.pkl")
+    naics_map, desc = qload_cached("NAICS.pkl")
     if naics in naics_map:
         naics_str = naics_map[naics]
         naics_str = " (" + naics_str.lstrip().rstrip() + ")"
@@ -159,7 +119,7 @@ def make_prison_text_fig(d, textfig):
     kwhs, kwhs_oriflag   = d["kwhs"]
     temps, temps_oriflag = d["temps"]
     
-    feature_map, desc = qload("prison_features_map.pkl")
+    feature_map, desc = qload_cached("prison_features_map.pkl")
     if isinstance(bid, str) and "q" in bid:
         features = feature_map[int(bid[:-2])]
     else:
@@ -201,7 +161,7 @@ def make_temp_vs_time_fig(d, tvt):
     d -- The building record.
     tvt -- The axis to hold the figure.
     """
-    times                = d["times"]
+    times                = ta.local_datetimes(d)
     temps, temps_oriflag = d["temps"]
     
     tvt.plot(   times[temps_oriflag] , temps[temps_oriflag] , c = "blue")
@@ -223,7 +183,7 @@ def make_kwhs_vs_time_fig(d, tvk):
     d -- The building record.
     tvk -- The axis to hold the figure.
     """
-    times                = d["times"]
+    times                = ta.local_datetimes(d)
     kwhs, kwhs_oriflag   = d["kwhs"]
 
     tvk.plot(times[kwhs_oriflag], kwhs[kwhs_oriflag], c = "blue", label = "Energy Usage")
@@ -244,30 +204,16 @@ def make_kwhs_vs_time_fig(d, tvk):
 
 def make_freqs_fig(d, freqs):
     """Show kwhs in the frequency domain (via the DFT).
-       Note: This function requires data from (all of) the_year.
 
     Parameters:
     d -- The building record.
     freqs -- The axis to hold the figure.
     """
-    times                = d["times"]
-    kwhs, kwhs_oriflag   = d["kwhs"]
-    temps, temps_oriflag = d["temps"]
-
-    start_time  = "01/01/%d 00:00:00" %the_year
-    end_time    = "01/01/%d 00:00:00" %(the_year + 1)
-    start_ts    = int(itime.mktime(datetime.strptime(start_time, "%m/%d/%Y %H:%M:%S").timetuple()))
-    end_ts      = int(itime.mktime(datetime.strptime(end_time, "%m/%d/%Y %H:%M:%S").timetuple()))
-    
-    all_times = range(start_ts, end_ts, 3600)
-    num_times = len(all_times)
-    
-    a     = np.fft.fft(kwhs)
-    half  = int(num_times + 1)/2
-    a     = a[0:half +1]
-    a[0]  = 0 #drop constant part of signal
-    reals = [x.real for x in a]
-    imags = [x.imag for x in a]
+    spec      = spectral.get_spectrum(d)
+    num_times = spec["num_times"]
+    a         = spec["coefs"]
+    reals     = a.real
+    imags     = a.imag
     freqs.set_xlabel("Period (h)")
     freqs.set_ylabel("Magnitude")
     freqs.plot(reals, label = "Real", alpha = 0.9)
@@ -286,6 +232,72 @@ def make_freqs_fig(d, freqs):
         label.set_rotation(30) 
 
 
+def make_spectrogram_fig(d, ax, rhythm_ax = None):
+    """Show how kwhs in the frequency domain change over the year (a DFT over sliding 4-week windows, see stft).
+
+    Parameters:
+    d -- The building record.
+    ax -- The axis to hold the spectrogram (the power at each period, window by window).
+    rhythm_ax -- An optional axis to hold the proportion of the power at the 24h and 168h periods,
+                 window by window, with the largest change of the daily rhythm marked.
+    """
+    st    = stft.record_stft(d)
+    times = ta.local_datetimes(d, st["starts"])
+    if len(times) < 2:
+        ax.set_title("Not enough data for a spectrogram")
+        return
+    spectra = st["spectra"][:, 1:] #the constant part is dropped
+    nbins   = spectra.shape[1]
+    x       = mdates.date2num(times)
+    ax.imshow(np.maximum(spectra.T, spectra[spectra > 0].min() if (spectra > 0).any() else 1),
+              aspect = "auto", origin = "lower", extent = [x[0], x[-1], 1, nbins], norm = LogNorm())
+    ax.xaxis_date()
+    highlighted_periods = np.array([3, 6, 12, 24, 168])
+    ax.set_yticks(float(stft.default_window) / highlighted_periods)
+    ax.set_yticklabels([str(p) for p in highlighted_periods])
+    ax.set_ylabel("Period (h)")
+    ax.set_title("Energy usage in the frequency domain, over time")
+    for label in ax.get_xticklabels():
+        label.set_rotation(30)
+
+    if rhythm_ax is not None:
+        for i, p in enumerate(st["periods"]):
+            rhythm_ax.plot(times, st["prop"][:, i], label = str(p) + "h")
+        ind, shift = stft.largest_shift(st["prop"][:, 0])
+        if ind >= 0:
+            rhythm_ax.axvline(times[ind], ls = "dotted", color = "black", label = "Largest change (24h)")
+        rhythm_ax.set_ylabel("Proportion of power")
+        rhythm_ax.legend()
+
+def make_baseload_fig(d, ax, window_days = baseload.default_window):
+    """Show the baseload over the year: the lowest use of each day, and the rolling baseload
+    (the minimum over the window_days days ending on each day, see baseload), with its trend.
+       Note: imputed values are ignored.
+
+    Parameters:
+    d -- The building record.
+    ax -- The axis to hold the figure.
+    window_days -- The length of the rolling window, in days.
+    """
+    dates, day_min = baseload.get_baseload(d, 1)
+    dates, base    = baseload.get_baseload(d, window_days)
+    feats          = baseload.baseload_features(dates, base)
+    x              = dates.astype(datetime)
+    ax.plot(x, day_min, c = "gray", alpha = .4, label = "Daily minimum")
+    ax.plot(x, base, c = "black", drawstyle = "steps-post", label = "Baseload (%d-day minimum)" % window_days)
+    if np.isfinite(feats["baseload_trend"]):
+        ok   = np.isfinite(base)
+        days = dates.astype(np.int64)
+        fit  = np.polyfit(days[ok], base[ok], 1)
+        ax.plot(x[ok], np.polyval(fit, days[ok]), c = "red", ls = "dashed",
+                label = "Trend (%+.2f kwh per year)" % feats["baseload_trend"])
+    ax.set_title("Baseload")
+    ax.set_ylabel("Energy Usage (kwh)")
+    ax.grid(True)
+    ax.legend()
+    for label in ax.get_xticklabels():
+        label.set_rotation(30)
+
 def make_temp_vs_kwh_fig(d, tmpsvk, agg_to_day = False):
     """Show a 2d-histogram of temperatures vs kwhs in a given axis.
     
@@ -298,8 +310,8 @@ def make_temp_vs_kwh_fig(d, tmpsvk, agg_to_day = False):
 
     both_ori = np.logical_and(temps_oriflag, kwhs_oriflag)
     if agg_to_day:
-        #is_sunday_start = (lambda x: x.weekday() == 6 and x.hour == 0)
-        is_midnight      = (lambda x: x.hour == 0)
+        #is_sunday_start = (lambda c: (c.weekday == 6) & (c.hour == 0))
+        is_midnight      = (lambda c: c.hour == 0)
         days, new_times  = get_periods(d, 24, is_midnight)
         day_avgs        = np.ma.average(days, axis = 1)
         temps, new_times = get_periods(d, 24, is_midnight, which = "temps")
@@ -325,13 +337,13 @@ def make_avg_day_fig(d, avgday):
     avgday -- The axis to hold the figure.
     """
 
-    is_midnight     = (lambda x: x.hour == 0)
+    is_midnight     = (lambda c: c.hour == 0)
     days, new_times = get_periods(d, 24, is_midnight, "kwhs")
 
-    skip_weekdays   = (lambda x: x.weekday() < 5)
+    skip_weekdays   = (lambda c: c.weekday < 5)
     weekends, _     = get_periods(d, 24, is_midnight, "kwhs", skip_weekdays)
 
-    skip_weekend    = (lambda x: x.weekday() >= 5)
+    skip_weekend    = (lambda c: c.weekday >= 5)
     weekdays, _     = get_periods(d, 24, is_midnight, "kwhs", skip_weekend)
 
     avg_weekend     = np.ma.average(weekends, axis = 0)
@@ -367,7 +379,7 @@ def make_avg_week_fig(d, avgweek):
     avgweek -- The axis to hold the figure.
     """
 
-    is_sunday_start  = (lambda x: x.weekday() == 6 and x.hour == 0)
+    is_sunday_start  = (lambda c: (c.weekday == 6) & (c.hour == 0))
     weeks, new_times = get_periods(d, 168, is_sunday_start, "kwhs")
 
     avg_week  = np.ma.average(weeks, axis = 0)
@@ -403,20 +415,6 @@ def make_hist_fig(d, hist):
     hist.set_xlabel("kwhs")
     hist.set_ylabel("Number of hours")
 
-def gen_peaks(d, num_peaks = 3):
-    """A generatore that yields the index of the highest peaks.
-       
-    Parameters:
-    d -- The building record.
-    num_peaks -- The number of peaks to be yielded.
-    """
-    kwhs, kwhs_oriflag   = d["kwhs"]
-    
-    inds = np.argsort(kwhs)[-num_peaks:]
-    for ind in inds:
-        yield ind
-
-
 def make_peak_fig(d, ax, ind):
     """Show the 24-hour period around the time at index ind.
 
@@ -446,13 +444,12 @@ def make_kwh_vs_sun_fig(d, ax, agg_days = False):
     bid                  = d["bid"]
     naics                = d["naics"]
     btype                = d["btype"]
-    times                = d["times"]
     kwhs, kwhs_oriflag   = d["kwhs"]
     temps, temps_oriflag = d["temps"]
 
-    sun_pos = np.array([max(-100, getSun("IL", t)) for t in times])
+    sun_pos = np.array([max(-100, getSun("IL", t)) for t in ta.utc_datetimes(d)])
     if agg_days:
-        is_midnight = (lambda x: x.hour == 0)
+        is_midnight = (lambda c: c.hour == 0)
         d["sun_pos"] = (sun_pos, np.array([True for x in sun_pos]))
         days, new_times = get_periods(d, 24, is_midnight)
         suns, new_times = get_periods(d, 24, is_midnight, which = "sun_pos")
@@ -481,15 +478,15 @@ def make_monthly_usage_fig(d, ax):
     d -- The building record.
     ax-- The axis to hold the figure.
     """
-    times                = d["times"]
+    cal                  = ta.get_calendar(d)
     kwhs, kwhs_oriflag   = d["kwhs"]
 
-    month_breaks = [ind for ind, t in enumerate(times) if t.day == 1 and t.hour == 0]
+    month_breaks = list(np.flatnonzero(np.logical_and(cal.day == 1, cal.hour == 0)))
 
-    zeroed_kwhs  = [k if flg else 0 for k, flg in zip(kwhs, kwhs_oriflag)] 
+    zeroed_kwhs  = np.where(kwhs_oriflag, kwhs, 0)
     month_totals = [np.sum(zeroed_kwhs[s:e]) for s, e in zip(month_breaks, month_breaks[1:] + [-1])]
     
-    ax.bar([times[i] for i in month_breaks], month_totals, width = 10)
+    ax.bar(ta.local_datetimes(d, month_breaks), month_totals, width = 10)
     labels = ax.get_xticklabels() 
     for label in labels: 
         label.set_rotation(30) 
@@ -498,15 +495,13 @@ def make_monthly_usage_fig(d, ax):
     ax.grid(True)
 
 def make_boxplot_all_days_fig(d, ax):
-    times = d['times']
+    cal = ta.get_calendar(d)
     hr_start = 8
     hr_stop = 16
     kwhs, kwhs_oriflag = d["kwhs"]
-    in_schedule = (lambda x: hr_start <= x.hour <= hr_stop)
-    out_schedule = (lambda x: x.hour < hr_start or x.hour > hr_stop)
     
-    out_flag = [out_schedule(t) for t in times]
-    in_flag  = [in_schedule(t) for t in times]
+    in_flag  = np.logical_and(hr_start <= cal.hour, cal.hour <= hr_stop)
+    out_flag = ~in_flag
 
     kwhs_in  = kwhs[np.logical_and(kwhs_oriflag, in_flag)]
     kwhs_out = kwhs[np.logical_and(kwhs_oriflag, out_flag)]
@@ -520,19 +515,15 @@ def make_boxplot_all_days_fig(d, ax):
     ax.set_title("All days")
 
 def make_boxplot_weekday_vs_end_fig(d, ax):
-    times = d['times']
+    cal = ta.get_calendar(d)
     hr_start = 6
     hr_stop = 17
     kwhs, kwhs_oriflag = d["kwhs"]
-    in_schedule = (lambda x: hr_start <= x.hour <= hr_stop)
-    out_schedule = (lambda x: x.hour < hr_start or x.hour > hr_stop)
-    is_weekday = (lambda x: x.weekday() < 5)
-    is_weekend = (lambda x: x.weekday() >= 5)
-
-    out_flag = [out_schedule(t) for t in times]
-    in_flag  = [in_schedule(t) for t in times]
-    weekday_flag = [is_weekday(t) for t in times]
-    weekend_flag = [is_weekend(t) for t in times]
+
+    in_flag  = np.logical_and(hr_start <= cal.hour, cal.hour <= hr_stop)
+    out_flag = ~in_flag
+    weekday_flag = cal.weekday < 5
+    weekend_flag = ~weekday_flag
     
     weekday_kwhs_in  = kwhs[np.logical_and(kwhs_oriflag, np.logical_and(in_flag, weekday_flag))]
     weekday_kwhs_out = kwhs[np.logical_and(kwhs_oriflag, np.logical_and(out_flag, weekday_flag))]
@@ -547,68 +538,6 @@ def make_boxplot_weekday_vs_end_fig(d, ax):
     ax.boxplot([weekday_kwhs_in, weekend_kwhs_in, weekday_kwhs_out, weekend_kwhs_out], positions = [1, 2, 4, 5])
     ax.set_title("Weekday vs Weekend")
 
-def gen_holidays(d):
-    """A generator that yields federal holidays in the timeframe of the building record d (in chronological order)."""
-    times = d["times"]
-    holidays = yfhol(the_year)
-    holidays = holidays.items()
-    holinames, holidates = zip(*holidays)
-    mymap = dict(zip(holidates, holinames))
-
-    is_midnight     = (lambda x: x.hour == 0)
-    days, new_times = get_periods(d, 24, is_midnight, "kwhs")
-    for t in new_times:
-        date = t[0].date()
-        if date in holidates:
-            left_side  = np.argmax(times == t[0])
-            right_side = np.argmax(times == t[-1])
-            
-            yield (left_side, right_side), mymap[date]
-
-def gen_strange_pers(d, num_pers = 3, period = "day"):
-    """A generator which yields the strangest period (day or week).
-
-    Parameters:
-    d -- The building record.
-    num_pers -- The number of periods to be yieled (one at a time).
-    period -- A string, either "day" or "week".
-    """
-    kwhs, kwhs_oriflag = d["kwhs"]
-    times = d["times"]
-    if period == "day":
-        first_pred = (lambda x: x.hour == 0)
-    elif period == "week":
-        first_pred = (lambda x: x.weekday() == 0 and x.hour == 0)
-    else:
-        print "period must be 'day' or 'week'."
-        return
-    num_per_period = 24 if period == "day" else 168
-    pers, new_times = get_periods(d, num_per_period, first_pred, "kwhs")
-    temp_pers, _ = get_periods(d, num_per_period, first_pred, which = "temps")
-
-    avg_per         = np.average(pers, axis=0)
-    weirdness       = []
-    totals          = []
-    
-    standardize = True
-    if standardize:
-        avg_per = avg_per - np.min(avg_per)
-        avg_per = avg_per / np.max(avg_per)
-
-    for per in pers:
-        if standardize:
-            per = per - np.min(per)
-            per = per / np.max(per)
-
-        dist = np.average(np.abs(per - avg_per))        
-        weirdness.append(dist)
-    inds = np.argsort(weirdness)[-num_pers:][::-1]
-    for ind in inds:
-        left_side  = np.argmax(times == new_times[ind][0])#hackish, but oh well
-        right_side = np.argmax(times == new_times[ind][-1])#hackish, but oh well
- 
-        yield left_side, right_side
-
 def make_strange_per_fig(d, ax, per, c = 'blue'):
     """Creates a plot of the period yieled from get_strange_pers.
 
@@ -619,7 +548,7 @@ def make_strange_per_fig(d, ax, per, c = 'blue'):
     """
     start, end = per
     make_interval_plot(d, ax, start, end, c = c)
-    ax.set_title(d["times"][start].strftime("%m/%d/%Y %H:%M:%S") + "--" + d["times"][end].strftime("%m/%d/%Y %H:%M:%S"))
+    ax.set_title(ta.local_datetimes(d, start).strftime("%m/%d/%Y %H:%M:%S") + "--" + ta.local_datetimes(d, end).strftime("%m/%d/%Y %H:%M:%S"))
 
 def make_extreme_days_figs(d, axhigh, axlow):
     """Show the extreme high and extreme low days (in terms of electricity usage).
@@ -629,12 +558,12 @@ def make_extreme_days_figs(d, axhigh, axlow):
     axhigh -- The axis to hold the extreme-high figure.
     axlow -- The axis to hold the extreme-low figure.
     """
-    is_midnight     = (lambda x: x.hour == 0)
+    is_midnight     = (lambda c: c.hour == 0)
     days, new_times = get_periods(d, 24, is_midnight, "kwhs")
+    day_inds        = period_inds(d, 24, is_midnight)
     avg_day         = np.average(days, axis=0)
     weirdness       = []
     totals          = []
-    times           = d["times"]
 
     for day in days:
         total = np.sum(day)
@@ -642,80 +571,19 @@ def make_extreme_days_figs(d, axhigh, axlow):
         dist = np.average(np.abs(day - avg_day))
         weirdness.append(dist)
     ind = np.argmax(totals)
-    highest_day = new_times[ind][0]
-   
-    left_side  = np.argmax(times == new_times[ind][0])#hackish, but oh well
-    right_side = np.argmax(times == new_times[ind][-1])#hackish, but oh well
+    left_side, right_side = day_inds[ind, 0], day_inds[ind, -1]
+    highest_day = ta.local_datetimes(d, left_side)
     make_interval_plot(d, axhigh, left_side, right_side)
     axhigh.set_title("Highest Day\n" + highest_day.strftime("%m/%d/%Y"))
    
     ind = np.argmin(totals)
-    lowest_day = new_times[ind][0]
-    left_side  = np.argmax(times == new_times[ind][0])#hackish, but oh well
-    right_side = np.argmax(times == new_times[ind][-1])#hackish, but oh well
+    left_side, right_side = day_inds[ind, 0], day_inds[ind, -1]
+    lowest_day = ta.local_datetimes(d, left_side)
     make_interval_plot(d, axlow, left_side, right_side)
 
     axlow.set_title("Lowest Day\n" + lowest_day.strftime("%m/%d/%Y"))
 
 
-def gen_over_thresh(d, thresh):
-    """A generatore that yields the times where the energy usage was above some threshold.
-    
-    Parameters:
-    d -- The building record.
-    thresh -- The threshold.
-
-    Yields a pair of indices -- the times on either side of the point which crosses the threshold. 
-    (12 hours on either side).
-    """
-    times                = d["times"]
-    kwhs, kwhs_oriflag   = d["kwhs"]
-    temps, temps_oriflag = d["temps"]
-
-    #Right now, just assume you start and end below thresh
-    left_sides   = [ind for ind in range(len(kwhs)-1) if kwhs[ind] <= thresh and kwhs[ind+1] > thresh]
-    right_sides  = [ind for ind in range(len(kwhs)-1) if kwhs[ind] > thresh and kwhs[ind+1] <= thresh]
-    #Now account for the fact that you may start/end above thresh
-    if kwhs[0] >= thresh:
-        left_sides = [0] + left_sides
-    if kwhs[-1] >= thresh:
-        right_sides += [len(kwhs)-1]
-
-    periods = zip(left_sides, right_sides)
-
-    for ls, rs in periods:
-        new_left_side  = max(0, ls - 12)
-        new_right_side = min(len(kwhs)-1, rs + 12)
-
-        kvals  =  kwhs[new_left_side:new_right_side]
-        ptimes = times[new_left_side:new_right_side]
-        tvals  = temps[new_left_side:new_right_side]
-
-        yield new_left_side, new_right_side
-
-def get_times_of_highest_change(d, num_times, direction = "increase"):
-    """Returns the indices where the highest increase in electricity usage occured.
-    Note the indices returned are for just before the spikes occured (as opposed to just after).
-
-    Parameters:
-    d -- The building record.
-    num_times -- The number of times to be returned.
-    direction -- Either "increase" (default) or "decrease"
-    """
-    kwhs, kwhs_oriflag = d["kwhs"]
-    times = d["times"]
-    first_deriv = kwhs[1:] - kwhs[:-1]
-
-    inds = np.argsort(first_deriv)
-
-    if direction == "increase":
-        inds = inds[-num_times:][::-1]
-    else:
-        inds = inds[:num_times]
-
-    return inds
-
-
 def make_interval_plot(d, ax, start, end, show_temps = True, show_sun = True, c = 'blue'):
     """
     Given a building record, an axis, and a start/end, plot the interval between the start and end.
@@ -730,7 +598,6 @@ def make_interval_plot(d, ax, start, end, show_temps = True, show_sun = True, c
     show_sun [True] -- If True, sunlight is shown in dashed grey.
     c ['blue'] -- The color of the kwhs line. 
     """
-    times                = d["times"]
     kwhs, kwhs_oriflag   = d["kwhs"]
     temps, temps_oriflag = d["temps"]    
 
@@ -738,12 +605,12 @@ def make_interval_plot(d, ax, start, end, show_temps = True, show_sun = True, c
     kwhs_oriflag  = kwhs_oriflag[start:end]
     temps         = temps[start:end]
     temps_oriflag = temps_oriflag[start:end]
-    times         = times[start:end]
+    times         = ta.local_datetimes(d, slice(start, end))
 
     lns1 = ax.plot(times, kwhs, label = "kwhs", c = c)
     ax.set_ylabel("kwh")
 
-    suns = np.array([max(0, getSun("IL", x.replace(tzinfo = tz_used))) for x in times])
+    suns = np.array([max(0, getSun("IL", t)) for t in ta.utc_datetimes(d, slice(start, end))])
     
     sun_ax = ax.twinx()
     lns2 = sun_ax.plot(times, suns, label = "Sunlight", c = "purple", alpha = 0.3, ls = "dashed")
@@ -770,30 +637,16 @@ def make_cami_fig(d, ax):
     """
     Given a building record and an axis, add Cami's favorite plot to the axis.
     Cami's favorite plot provides a detailed illustration of how much money can be saved.
-    This figure shows a variety of retrofitting options, and the predicted savings induced by each (as well as confidence intervals).
+    For each hour of the day, it shows the average use, and the excess of the days above the 95th percentile
+    (see savings.estimate_savings, which also prices it).
     """
-    num_hours = 24
-    kwhs, kwhs_oriflag = d["kwhs"]
-    times              = d["times"]
-    is_sunday_start    = (lambda x: x.weekday() == 6 and x.hour == 0)
-    weeks, new_times   = get_periods(d, num_hours, is_sunday_start)
+    est = savings.estimate_savings(d)
+    ax.set_title("Cami could have saved you:\n%.2f dollars" % est["savings"])
 
-    thresh   = np.percentile(weeks, 95, axis = 0)
-    avg_week = np.average(weeks, axis = 0)
+    hours = range(savings.num_hours)
+    ax.stackplot(hours, est["avg"], est["excess"], colors = ["white", "red"])
+    ax.plot(hours, est["thresh"], ls = "dotted", color = "black")
 
-    high_avgs = []
-    for col in range(num_hours):
-        inds = weeks[:, col] >thresh[col]
-        high_avgs.append(np.average(weeks[:, col][inds]))
-
-    high_avgs = np.array(high_avgs)
-    sum_avg = np.sum(avg_week)
-    sum_high = np.sum(high_avgs)
-    ax.set_title("Cami could have saved you:\n%.2f dollars" % ((sum_high - sum_avg) *.05))
-
-    ax.stackplot(range(num_hours), avg_week, high_avgs-avg_week, colors = ["white", "red"])
-    ax.plot(range(num_hours), thresh, ls = "dotted", color = "black")
-  
 def make_cluster_fig(d, types_ax, times_ax):
     """
     Given a building record and two axes, this function populates the axes.
@@ -801,16 +654,18 @@ def make_cluster_fig(d, types_ax, times_ax):
     The second axis (times_ax) is populated with the original signal over the full year, where each day is colored based on its found cluster.
     """
     kwhs, kwhs_oriflag = d["kwhs"]
-    times              = d["times"]
+    times              = ta.local_datetimes(d)
 
-    is_midnight     = (lambda x: x.hour == 0)
+    is_midnight     = (lambda c: c.hour == 0)
     days, new_times = get_periods(d, 24, is_midnight)
+    day_inds        = period_inds(d, 24, is_midnight)
     oridays = copy.copy(days)
 
     times_ax.plot(times, kwhs, lw=0.5, c="black")
     for day in days:
         day -= np.average(day)#center each day
 
+    from sklearn.cluster import KMeans #imported here, as only this figure needs it
     num_clusters = 3
     clusterer = KMeans(init='k-means++', n_clusters=num_clusters, n_init=10)
     #clusterer = mixture.GMM(n_components=3, covariance_type='full')
@@ -836,22 +691,21 @@ def make_cluster_fig(d, types_ax, times_ax):
     types_ax.set_yticks([])
     types_ax.set_ylabel("Relative energy usage")
     for i, d in enumerate(oridays):
-        times_ax.plot(new_times[i], d, c = cmap[preds[i]])
+        ok = day_inds[i] >= 0 #the hour skipped when daylight saving time starts has no reading
+        times_ax.plot(times[day_inds[i][ok]], d[ok], c = cmap[preds[i]])
     times_ax.set_ylabel("kwhs")
 
 def make_deriv_day_fig(d, ax):
-    is_midnight        = (lambda x: x.hour == 0)
-    times              = d["times"]
     kwhs, kwhs_oriflag = d["kwhs"]
     deriv = kwhs[1:] - kwhs[:-1]
-    hods = np.array([t.hour for t in times[:-1]])
+    hods = ta.get_calendar(d).hour[:-1]
     trim = True
     if trim:
         #remove 1% of data (extreme values)
         upper = np.percentile(deriv, 99.5)
         lower = np.percentile(deriv, 0.5)
 
-        flag = np.array([lower < x and x < upper for x in deriv])
+        flag = np.logical_and(lower < deriv, deriv < upper)
         deriv = deriv[flag]
         hods = hods[flag]
     ax.hist2d(hods, deriv, bins = (23*3, 100), norm = LogNorm())
@@ -860,7 +714,14 @@ def make_deriv_day_fig(d, ax):
     ax.set_xlabel("Hours after midnight")
     ax.set_ylabel("Change in kwh")
     
-def multi_plot(d, foutn = None):
+def multi_plot(d, foutn = None, recorder = None):
+    """Make the full pdf report for building record d.
+
+    Parameters:
+    d -- The building record.
+    foutn -- The name of the pdf file (defaults to one in fig_loc, named after the building).
+    recorder -- An instrument.Recorder; if given, each page and each make_* function is timed and memory-profiled.
+    """
     fontsize = 24
     if foutn == None:
         foutn = fig_loc + 'fin_' + str(d["bid"]) + '_' + str(the_year) + '.pdf'
@@ -880,13 +741,21 @@ def multi_plot(d, foutn = None):
                 "holidays",
                 "overthresh",
                 "extreme days", 
+                "spectrogram",
+                "baseload",
                 "raw"]
                 
-    bmax = len(all_figs)
-    for i, f in enumerate(all_figs):
-        add_fig(pdf, d, f, size = size, fontsize = fontsize)
-        progress_bar(i+1, bmax)
-    print "\n",
+    if recorder is not None:
+        undo = instrument.instrument_makers(sys.modules[__name__], recorder)
+    try:
+        bmax = len(all_figs)
+        for i, f in enumerate(all_figs):
+            add_fig(pdf, d, f, size = size, fontsize = fontsize, recorder = recorder)
+            progress_bar(i+1, bmax)
+        print "\n",
+    finally:
+        if recorder is not None:
+            undo()
     pdf.close()
 
 def _add_fig_box_plots(pdf, d, size, fontsize):
@@ -897,7 +766,7 @@ def _add_fig_box_plots(pdf, d, size, fontsize):
     make_boxplot_all_days_fig(d, ax_alldays)
     make_boxplot_weekday_vs_end_fig(d, ax_split)
     b_fig.suptitle("Effect of Schedule", fontsize = fontsize)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_general(pdf, d, size, fontsize):
     #General/global figure
@@ -912,7 +781,7 @@ def _add_fig_general(pdf, d, size, fontsize):
 
     bid = d["bid"]
     try:
-        feature_map, desc = qload("prison_features_map.pkl")
+        feature_map, desc = qload_cached("prison_features_map.pkl")
         if isinstance(bid, str) and "q" in bid:
             features = feature_map[int(bid[:-2])]
         else:
@@ -922,7 +791,7 @@ def _add_fig_general(pdf, d, size, fontsize):
     except:
         g_fig.suptitle(str(bid), fontsize = fontsize)
         make_text_fig(d, g_text)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_avg_behavior(pdf, d, size, fontsize):
     #Avg behavior figure    
@@ -935,7 +804,7 @@ def _add_fig_avg_behavior(pdf, d, size, fontsize):
     
     n_fig.suptitle("Average Behavior", fontsize = fontsize)
     extract_legend(n_fig)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_behavior(pdf, d, size, fontsize):
     #Behavior fig
@@ -952,7 +821,7 @@ def _add_fig_behavior(pdf, d, size, fontsize):
     
     b_fig.suptitle("Average Behavior", fontsize = fontsize)
     extract_legend(b_fig)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_raw(pdf, d, size, fontsize):
     #Raw data figure
@@ -966,14 +835,14 @@ def _add_fig_raw(pdf, d, size, fontsize):
     make_freqs_fig(d, a_freqs)
     a_fig.suptitle("Raw Data", fontsize = fontsize)
     extract_legend(a_fig)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_outliers(pdf, d, size, fontsize):    
     #outliers 
     o_fig = plt.figure(figsize = size)
     avg_day = o_fig.add_subplot(5, 2, 1)
     make_avg_day_fig(d, avg_day)
-    times = d["times"]
+    times = ta.local_datetimes(d)
     
     days = gen_strange_pers(d, 3, period = "day")
     for i, p in enumerate(days):
@@ -993,11 +862,11 @@ def _add_fig_outliers(pdf, d, size, fontsize):
     o_fig.suptitle("Outliers", fontsize = fontsize)
     extract_legend(o_fig)
     plt.subplots_adjust(hspace = .55)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_outliers2(pdf, d, size, fontsize):
     #outliers, 2 page
-    times = d["times"]
+    times = ta.local_datetimes(d)
 
     days = gen_strange_pers(d, 6, period = "day")        
     weeks = gen_strange_pers(d, 6, period = "week")
@@ -1033,7 +902,7 @@ def _add_fig_outliers2(pdf, d, size, fontsize):
         plt.subplots_adjust(wspace = .35)
         plt.subplots_adjust(hspace = .55)
         extract_legend(o_fig)
-        plt.savefig(pdf, format = 'pdf')
+        pdf.savefig()
 
 def _add_fig_overthresh(pdf, d, size, fontsize):
     #overthresh
@@ -1050,11 +919,11 @@ def _add_fig_overthresh(pdf, d, size, fontsize):
     ot_fig.suptitle("Times in the top 1%%\n (>%.2fkwhs)" % thresh, fontsize = 24)
     extract_legend(ot_fig)
     plt.subplots_adjust(hspace = .35, wspace = .5)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_spikes(pdf, d, size, fontsize):
     #spikes
-    times     = d["times"]
+    times     = ta.local_datetimes(d)
     num_times = 6 
     inds      = get_times_of_highest_change(d, num_times, direction = "increase")
     s_fig     = plt.figure(figsize = size)
@@ -1071,7 +940,7 @@ def _add_fig_spikes(pdf, d, size, fontsize):
     s_fig.subplots_adjust(wspace = .35)
     s_fig.subplots_adjust(hspace = .25)
     extract_legend(s_fig)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_extreme_days(pdf, d, size, fontsize):
     #extreme days
@@ -1084,7 +953,7 @@ def _add_fig_extreme_days(pdf, d, size, fontsize):
     
     ex_fig.suptitle("Extreme days", fontsize = fontsize)
     extract_legend(ex_fig)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_clustering(pdf, d, size, fontsize):
     #clustering fig
@@ -1093,7 +962,7 @@ def _add_fig_clustering(pdf, d, size, fontsize):
     times_ax   = c_fig.add_subplot(2, 1, 2)
     make_cluster_fig(d, types_ax, times_ax)
     c_fig.suptitle("Types of days", fontsize = fontsize)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
 
 def _add_fig_cami(pdf, d, size, fontsize):
     #Cami fig
@@ -1101,12 +970,27 @@ def _add_fig_cami(pdf, d, size, fontsize):
     ax = cami_fig.add_subplot(1, 1, 1)
     make_cami_fig(d, ax)
     cami_fig.suptitle("SAVE ALL THE MONIES", fontsize = fontsize)
-    plt.savefig(pdf, format = 'pdf')
+    pdf.savefig()
+
+def _add_fig_spectrogram(pdf, d, size, fontsize):
+    s_fig = plt.figure(figsize = size)
+    ax_spec   = s_fig.add_subplot(2, 1, 1)
+    ax_rhythm = s_fig.add_subplot(2, 1, 2)
+    make_spectrogram_fig(d, ax_spec, ax_rhythm)
+    s_fig.suptitle("Changes in Rhythm", fontsize = fontsize)
+    pdf.savefig()
+
+def _add_fig_baseload(pdf, d, size, fontsize):
+    b_fig = plt.figure(figsize = size)
+    ax    = b_fig.add_subplot(1, 1, 1)
+    make_baseload_fig(d, ax)
+    b_fig.suptitle("Phantom Load", fontsize = fontsize)
+    pdf.savefig()
 
 def _add_fig_holidays(pdf, d, size, fontsize):
     #Holiday figures
     holidays    = gen_holidays(d)
-    times = d["times"]
+    times = ta.local_datetimes(d)
     for page in range(4):
         fig = plt.figure(figsize = size)
         fig.suptitle("Holidays", fontsize = fontsize)
@@ -1129,7 +1013,7 @@ def _add_fig_holidays(pdf, d, size, fontsize):
         extract_legend(fig)
         plt.subplots_adjust(wspace = .35)
         plt.subplots_adjust(hspace = .25)
-        plt.savefig(pdf, format = 'pdf')
+        pdf.savefig()
 
 def _add_fig_deriv_day(pdf, d, size, fontsize):
     #Delta analysis
@@ -1137,46 +1021,67 @@ def _add_fig_deriv_day(pdf, d, size, fontsize):
     ax         = d_fig.add_subplot(1, 1, 1)
     make_deriv_day_fig(d, ax)
     d_fig.suptitle("Distributions of Load Fluctuations", fontsize = fontsize)
-    plt.savefig(pdf, format = 'pdf')
-
-def add_fig(pdf, d, which, size, fontsize = 36):
-    #Switch statement:
-    {"general"     : _add_fig_general,
-     "avg behavior": _add_fig_avg_behavior,
-     "behavior"    : _add_fig_behavior,
-     "raw"         : _add_fig_raw,
-     "outliers"    : _add_fig_outliers,
-     "outliers2"   : _add_fig_outliers2,
-     "overthresh"  : _add_fig_overthresh,
-     "spikes"      : _add_fig_spikes,
-     "extreme days": _add_fig_extreme_days,
-     "clustering"  : _add_fig_clustering,
-     "cami"        : _add_fig_cami,
-     "holidays"    : _add_fig_holidays,
-     "box plots"   : _add_fig_box_plots,
-     "deriv day"   : _add_fig_deriv_day,}[which](pdf, d, size, fontsize)
+    pdf.savefig()
+
+#The pages of the report, by name
+page_funs = {"general"     : _add_fig_general,
+             "avg behavior": _add_fig_avg_behavior,
+             "behavior"    : _add_fig_behavior,
+             "raw"         : _add_fig_raw,
+             "outliers"    : _add_fig_outliers,
+             "outliers2"   : _add_fig_outliers2,
+             "overthresh"  : _add_fig_overthresh,
+             "spikes"      : _add_fig_spikes,
+             "extreme days": _add_fig_extreme_days,
+             "clustering"  : _add_fig_clustering,
+             "cami"        : _add_fig_cami,
+             "holidays"    : _add_fig_holidays,
+             "box plots"   : _add_fig_box_plots,
+             "deriv day"   : _add_fig_deriv_day,
+             "spectrogram" : _add_fig_spectrogram,
+             "baseload"    : _add_fig_baseload,}
+
+def add_fig(pdf, d, which, size, fontsize = 36, recorder = None):
+    """Add the page named which (see page_funs) to pdf, a PdfPages (or anything with a savefig method)."""
+    fun = page_funs[which]
+    if recorder is None:
+        fun(pdf, d, size, fontsize)
+    else:
+        with recorder.measure("page", which, d["bid"]):
+            fun(pdf, d, size, fontsize)
+
 
+def load_cleaned_state_brecs(year):
+    """The cleaned state building records of a year (from the record store clean_brecs writes, or the old pickle)."""
+    name = "state_b_records_" + str(year) + "_with_temps_cleaned"
+    if os.path.isdir(data_loc + name):
+        store = RecordStore(data_loc + name)
+        return [store.get(bid) for bid in store.bids()], "The cleaned records in " + store.path
+    data, desc = qload(name + ".pkl")
+    return [ta.upgrade(d) for d in data], desc
 
 def test_things():
     '''Used for generating figures for our specific data'''
     global the_year
     font = {'size'   : 6}
     matplotlib.rc('font', **font)
-    from adjust_for_dlst import adjustbrec
     
     arg1 = sys.argv[1]
-    if arg1 == "states":
-        data, desc = qload("state_b_records_" + str(the_year) + "_with_temps_cleaned.pkl")
+    if arg1 == "synthetic": #no private data needed
+        import synthetic
+        data, desc = [synthetic.gen_brec(0, the_year)], "A synthetic building record"
+    elif arg1 == "states":
+        data, desc = load_cleaned_state_brecs(the_year)
     elif arg1 == "state":
         num = int(sys.argv[2])
         if len(sys.argv) > 3:            
             the_year = int(sys.argv[3])
             
-        data, desc = qload("state_b_records_" + str(the_year) + "_with_temps_cleaned.pkl")
+        data, desc = load_cleaned_state_brecs(the_year)
         data = [data[num]]
     else:
         data, desc = qload("agentis_oneyear_" + arg1 + "_updated.pkl")
-        data = [data]
+        data = [ta.upgrade(data)]
                       
     sys.stdout.flush()
     #data = [data[-1]]
@@ -1188,9 +1093,8 @@ def test_things():
     #make_comparison_doc(data);exit()
     
     for ind, d in enumerate(data):
-        #d = adjustbrec(d, the_year)
         print d["bid"]
-        print d["times"][:4]
+        print ta.local_datetimes(d, slice(4)), ta.tz_of(d)
         print d["kwhs"][0][:4]
        
         multi_plot(d)
@@ -1230,7 +1134,7 @@ def make_comparison_doc(ds, foutn = None):
             fun(d, ax)
             ax.set_title(feature_map[d["bid"]]["acronym"])
         extract_legend(fig)
-        plt.savefig(pdf, format = 'pdf')
+        pdf.savefig()
    
     pdf.close() 
 
@@ -0,0 +1,275 @@
+"""A portfolio matrix: the kwhs of many buildings on a common time axis, as memory-mapped (buildings x times) arrays.
+
+A portfolio is a directory with
+    kwhs.npy    -- (buildings x times) float64 kwhs.
+    oriflag.npy -- (buildings x times) bool, True for original readings (False off each building's record).
+    meta.pkl    -- The time axis (start, step and number of times) and, for each row, the bid, time zone
+                   and span (the columns covered by its record).
+The arrays are memory-mapped, so rows are only read from disk as they are used. Portfolio statistics
+(the vectorized counterparts of the main get_report features, see masked_stats and daily_stats)
+are computed a block of rows at a time, each block with a few array operations.
+
+Example:
+    pf    = Portfolio.build("portfolio", RecordStore("records"), start, 365 * 24)
+    stats = pf.stats()
+    print pf.bids[np.nanargmax(stats["avg"])]
+"""
+import  os
+import  cPickle as pickle
+import  numpy as np
+from    numpy.lib.format import open_memmap
+
+import  analytics as an
+import  baseload
+import  impute
+import  timeaxis as ta
+from    ingest import grid_readings
+
+is_midnight = (lambda c: c.hour == 0)
+
+class Portfolio(object):
+    """A portfolio matrix on disk (see build).
+
+    Parameters:
+    path -- The directory of the portfolio.
+    mode -- "r" (read only) or "r+" (rows can be replaced, see put).
+    """
+    def __init__(self, path, mode = "r"):
+        self.path      = path
+        with open(os.path.join(path, "meta.pkl"), "rb") as fin:
+            self.meta = pickle.load(fin)
+        self.kwhs      = np.load(os.path.join(path, "kwhs.npy"), mmap_mode = mode)
+        self.oriflag   = np.load(os.path.join(path, "oriflag.npy"), mmap_mode = mode)
+        self.bids      = np.array(self.meta["bids"], dtype = object)
+        self.tzs       = np.array(self.meta["tzs"], dtype = object)
+        self.spans     = self.meta["spans"]
+        self.index     = dict((bid, i) for i, bid in enumerate(self.bids))
+        self.times     = ta.make_times(self.meta["start"], self.meta["num_obs"], self.meta["step"])
+        self._day_inds = {}
+
+    @classmethod
+    def build(cls, path, brecs, start, num_obs, step = 3600):
+        """Lay out building records on a common time axis, and return the (read only) portfolio.
+
+        Parameters:
+        path -- The directory of the portfolio (created if it does not exist).
+        brecs -- The building records: a sequence with a length (e.g., a list or a RecordStore),
+                 read one record at a time.
+        start -- The first time of the axis (a tz-aware datetime, or seconds since the epoch).
+        num_obs, step -- The number of times of the axis, and the seconds between them.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        num_rows = len(brecs)
+        meta     = {"start": ta.to_epoch(start), "step": step, "num_obs": num_obs,
+                    "bids": [], "tzs": [], "spans": np.zeros((num_rows, 2), dtype = int)}
+        kwhs     = open_memmap(os.path.join(path, "kwhs.npy"), mode = "w+", dtype = np.float64, shape = (num_rows, num_obs))
+        oriflag  = open_memmap(os.path.join(path, "oriflag.npy"), mode = "w+", dtype = bool, shape = (num_rows, num_obs))
+        for i, d in enumerate(brecs):
+            meta["bids"].append(d["bid"])
+            meta["tzs"].append(ta.tz_of(d))
+            meta["spans"][i] = _place(d, kwhs, oriflag, i, meta)
+        if len(meta["bids"]) != num_rows:
+            raise ValueError("Expected %d records, got %d." % (num_rows, len(meta["bids"])))
+        kwhs.flush()
+        oriflag.flush()
+        del kwhs, oriflag
+        _save_meta(path, meta)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.bids)
+
+    def __contains__(self, bid):
+        return bid in self.index
+
+    def row(self, bid):
+        """The (kwhs, oriflag) of a building (memory-mapped rows; KeyError if it is not in the portfolio)."""
+        i = self.index[bid]
+        return self.kwhs[i], self.oriflag[i]
+
+    def put(self, d):
+        """Replace the row of a building with its (new) record (the portfolio must be opened with mode "r+")."""
+        i = self.index[d["bid"]]
+        self.spans[i]       = _place(d, self.kwhs, self.oriflag, i, self.meta)
+        self.tzs[i]         = ta.tz_of(d)
+        self.meta["tzs"][i] = self.tzs[i]
+        self.kwhs.flush()
+        self.oriflag.flush()
+        _save_meta(self.path, self.meta)
+
+    def day_inds(self, tz):
+        """The indices (days x 24, see analytics.period_inds) of the local days of the time axis in time zone tz."""
+        if tz not in self._day_inds:
+            self._day_inds[tz] = an.period_inds({"times": self.times, "tz": tz}, 24, is_midnight)
+        return self._day_inds[tz]
+
+    def _groups(self, rows, block):
+        """Yield (time zone, positions in rows, rows) for blocks of rows sharing a time zone."""
+        tzs = self.tzs[rows]
+        for tz in sorted(set(tzs)):
+            pos = np.flatnonzero(tzs == tz)
+            for s in range(0, len(pos), block):
+                yield tz, pos[s:s + block], rows[pos[s:s + block]]
+
+    def _rows(self, rows):
+        if rows is None:
+            return np.arange(len(self))
+        return np.asarray(rows, dtype = int)
+
+    def stats(self, rows = None, block = 512):
+        """Vectorized Building Report statistics (see masked_stats and daily_stats) of the given rows (all by default),
+        computed a block of rows at a time. Returns a dictionary of arrays, one value per row (plus "bid")."""
+        rows = self._rows(rows)
+        toR  = {"bid": self.bids[rows]}
+        for tz, pos, block_rows in self._groups(rows, block):
+            kwhs, oriflag = self.kwhs[block_rows], self.oriflag[block_rows]
+            stats = masked_stats(kwhs, oriflag)
+            stats.update(daily_stats(kwhs, oriflag, self.day_inds(tz), self._weekdays(tz), self.spans[block_rows])[0])
+            for name, vals in stats.items():
+                if name not in toR:
+                    toR[name] = np.empty(len(rows), dtype = vals.dtype)
+                    toR[name].fill(np.nan if vals.dtype.kind == "f" else 0)
+                toR[name][pos] = vals
+        return toR
+
+    def daily_totals(self, rows = None, block = 512):
+        """The daily kwh totals (from original readings; nan for days without any) of the given rows (all by default).
+        Returns (dates, totals): the local dates (datetime64[D]) of the columns, and the (rows x days) totals."""
+        rows  = self._rows(rows)
+        tzs   = sorted(set(self.tzs[rows]))
+        days  = dict((tz, ta.get_calendar({"times": self.times, "tz": tz}).days[self.day_inds(tz)[:, 0]]) for tz in tzs)
+        first = min(d[0] for d in days.values()) if tzs else 0
+        last  = max(d[-1] for d in days.values()) if tzs else -1
+        toR   = np.empty((len(rows), last - first + 1))
+        toR.fill(np.nan)
+        for tz, pos, block_rows in self._groups(rows, block):
+            totals = daily_stats(self.kwhs[block_rows], self.oriflag[block_rows], self.day_inds(tz),
+                                 self._weekdays(tz), self.spans[block_rows])[1]
+            toR[pos[:, np.newaxis], days[tz] - first] = totals
+        return np.arange(first, last + 1).astype("datetime64[D]"), toR
+
+    def baseload(self, rows = None, window_days = baseload.default_window, q = None, block = 512):
+        """The daily rolling baseload (see baseload.daily_baseload) of the given rows (all by default).
+        Returns (dates, baseloads): the local dates (datetime64[D]) of the columns, and the (rows x days) baseloads."""
+        rows  = self._rows(rows)
+        tzs   = sorted(set(self.tzs[rows]))
+        days  = dict((tz, ta.get_calendar({"times": self.times, "tz": tz}).days[self.day_inds(tz)[:, 0]]) for tz in tzs)
+        first = min(d[0] for d in days.values()) if tzs else 0
+        last  = max(d[-1] for d in days.values()) if tzs else -1
+        toR   = np.empty((len(rows), last - first + 1))
+        toR.fill(np.nan)
+        for tz, pos, block_rows in self._groups(rows, block):
+            day_inds = self.day_inds(tz)
+            cols     = np.maximum(day_inds, 0)
+            spans    = self.spans[block_rows]
+            valid    = np.logical_and(self.oriflag[block_rows][:, cols], day_inds >= 0)
+            valid   &= np.logical_and(day_inds[:, 0] >= spans[:, 0:1], day_inds[:, -1] < spans[:, 1:2])[:, :, np.newaxis]
+            toR[pos[:, np.newaxis], days[tz] - first] = baseload.daily_baseload(self.kwhs[block_rows][:, cols], valid,
+                                                                                  window_days, q)
+        return np.arange(first, last + 1).astype("datetime64[D]"), toR
+
+    def impute(self, rows = None, block = 512):
+        """Fill the missing kwhs of the given rows (all by default) from their hour-of-week profiles
+        (see impute.profile_fill), within each building's span. The portfolio must be opened with mode "r+".
+        Returns the number of values filled."""
+        rows   = self._rows(rows)
+        filled = 0
+        for tz, pos, block_rows in self._groups(rows, block):
+            how     = ta.get_calendar({"times": self.times, "tz": tz}).hour_of_week
+            kwhs    = np.array(self.kwhs[block_rows])
+            oriflag = np.array(self.oriflag[block_rows])
+            cols    = np.arange(kwhs.shape[1])
+            spans   = self.spans[block_rows]
+            in_span = np.logical_and(cols >= spans[:, 0:1], cols < spans[:, 1:2])
+            new     = impute.profile_fill(kwhs, oriflag, how)[0]
+            self.kwhs[block_rows] = np.where(in_span, new, kwhs)
+            filled += int(np.count_nonzero(in_span & ~oriflag))
+        self.kwhs.flush()
+        return filled
+
+    def _weekdays(self, tz):
+        return ta.get_calendar({"times": self.times, "tz": tz}).weekday[self.day_inds(tz)[:, 0]] < 5
+
+def _save_meta(path, meta):
+    tmpn = os.path.join(path, "meta.pkl.tmp")
+    with open(tmpn, "wb") as fout:
+        pickle.dump(meta, fout, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpn, os.path.join(path, "meta.pkl"))
+
+def _place(d, kwhs, oriflag, i, meta):
+    """Put the kwhs of record d on row i of the portfolio. Returns its span (first column, stop column)."""
+    epochs        = ta.utc_epochs(d)
+    vals, ori     = d["kwhs"]
+    ori           = np.asarray(ori, dtype = bool)
+    start, step   = meta["start"], meta["step"]
+    num_obs       = meta["num_obs"]
+    kwhs[i], oriflag[i] = grid_readings(epochs[ori], np.asarray(vals, dtype = float)[ori], start, num_obs, step)
+    if len(epochs) == 0:
+        return 0, 0
+    first = int(np.clip((epochs[0] - start) // step, 0, num_obs))
+    stop  = int(np.clip((epochs[-1] - start) // step + 1, 0, num_obs))
+    return first, stop
+
+def masked_stats(kwhs, oriflag):
+    """The general statistics of many buildings at once, from their original readings
+    (the vectorized avg, var, min, max, med, total and num_missing of get_report).
+
+    Parameters:
+    kwhs, oriflag -- (buildings x times) arrays.
+
+    Returns a dictionary of arrays (one value per building; nan for buildings without original readings).
+    num_missing counts the times without an original reading, over the whole axis.
+    """
+    kwhs    = np.asarray(kwhs, dtype = float)
+    oriflag = np.asarray(oriflag, dtype = bool)
+    num     = np.sum(oriflag, axis = 1)
+    none    = num == 0
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        total = np.sum(np.where(oriflag, kwhs, 0), axis = 1)
+        avg   = total / num
+        var   = np.sum(np.where(oriflag, (kwhs - avg[:, np.newaxis]) ** 2, 0), axis = 1) / num
+    toR = {"avg"  : avg,
+           "var"  : var,
+           "min"  : np.where(none, np.nan, np.min(np.where(oriflag, kwhs, np.inf), axis = 1)),
+           "max"  : np.where(none, np.nan, np.max(np.where(oriflag, kwhs, -np.inf), axis = 1)),
+           "med"  : an.masked_percentile(kwhs, oriflag, 50, axis = 1),
+           "total": np.where(none, np.nan, total),
+           "num_missing": kwhs.shape[1] - num}
+    return toR
+
+def daily_stats(kwhs, oriflag, day_inds, weekdays, spans = None):
+    """The day-based statistics of many buildings at once (the vectorized avg_tod_peak and week_day_vs_end_peaks
+    of get_report, plus daily totals).
+
+    Parameters:
+    kwhs, oriflag -- (buildings x times) arrays.
+    day_inds -- The (days x 24) indices of the local days into the times (-1 for missing hours, see analytics.period_inds).
+    weekdays -- A boolean array, True for the days (rows of day_inds) which are weekdays.
+    spans -- (buildings x 2) first and stop columns of each building's record; only days within it are used.
+
+    Returns (stats, totals): a dictionary of arrays (one value per building), and the (buildings x days) daily totals
+    (nan for days without an original reading).
+    """
+    kwhs    = np.asarray(kwhs, dtype = float)
+    oriflag = np.asarray(oriflag, dtype = bool)
+    cols    = np.maximum(day_inds, 0)
+    vals    = kwhs[:, cols]
+    valid   = np.logical_and(oriflag[:, cols], day_inds >= 0)
+    if spans is None:
+        in_span = np.ones((len(kwhs), len(day_inds)), dtype = bool)
+    else:
+        spans   = np.asarray(spans)
+        in_span = np.logical_and(day_inds[:, 0] >= spans[:, 0:1], day_inds[:, -1] < spans[:, 1:2])
+    valid  &= in_span[:, :, np.newaxis]
+
+    has       = np.any(valid, axis = 2)
+    masked    = np.where(valid, vals, -np.inf)
+    day_max   = np.max(masked, axis = 2)
+    peak_hour = np.argmax(masked, axis = 2) #0 for days without readings (as np.ma.argmax)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        totals  = np.where(has, np.sum(np.where(valid, vals, 0), axis = 2), np.nan)
+        avg_max = (lambda sel: np.sum(np.where(sel, day_max, 0), axis = 1) / np.sum(sel, axis = 1))
+        stats   = {"week_day_vs_end_peaks": avg_max(has & weekdays) - avg_max(has & ~weekdays),
+                   "avg_tod_peak"         : np.sum(np.where(in_span, peak_hour, 0), axis = 1) / np.sum(in_span, axis = 1).astype(float)}
+    return stats, totals
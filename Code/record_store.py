@@ -0,0 +1,100 @@
+"""An on-disk store of building records: a directory with one pickle per building.
+
+Records are read and written one at a time, so going over the whole store
+needs the memory of a single record, no matter how many buildings there are.
+Next to each record is a small file with the hash of its contents (its version, see RecordStore.version).
+"""
+import  os
+import  urllib
+import  hashlib
+import  tempfile
+import  cPickle as pickle
+
+class RecordStore(object):
+    """A directory of building records, indexed by bid.
+
+    Parameters:
+    path -- The directory (created if it does not exist).
+    """
+    ext     = ".pkl" #the extension of the record files
+    ver_ext = ".ver" #and of their version files
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _fname(self, bid):
+        #the type of the bid is kept in the file name, so bids() returns the bids as they were put
+        if isinstance(bid, (int, long)):
+            name = "i_" + str(bid)
+        else:
+            name = "s_" + urllib.quote(str(bid), safe = "")
+        return os.path.join(self.path, name + self.ext)
+
+    def _bid(self, fname):
+        name = fname[:-len(self.ext)]
+        if name.startswith("i_"):
+            return int(name[2:])
+        return urllib.unquote(name[2:])
+
+    def _write(self, fname, data):
+        """Write a file under a temporary name first, so readers never see half of it."""
+        fd, tmpn = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+        os.rename(tmpn, fname)
+
+    def put(self, d):
+        """Save the building record d (replacing any record with the same bid), then its version.
+        (So a reader may briefly see the new record with the old version, but never the other way around.)"""
+        data  = pickle.dumps(d, pickle.HIGHEST_PROTOCOL)
+        fname = self._fname(d["bid"])
+        self._write(fname, data)
+        self._write(fname[:-len(self.ext)] + self.ver_ext, hashlib.sha1(data).hexdigest())
+
+    def get(self, bid):
+        """Load the building record with the given bid (KeyError if there is none)."""
+        try:
+            fin = open(self._fname(bid), "rb")
+        except IOError:
+            raise KeyError(bid)
+        with fin:
+            return pickle.load(fin)
+
+    def delete(self, bid):
+        fname = self._fname(bid)
+        os.remove(fname)
+        if os.path.exists(fname[:-len(self.ext)] + self.ver_ext):
+            os.remove(fname[:-len(self.ext)] + self.ver_ext)
+
+    def version(self, bid):
+        """A value which changes whenever the contents of the record of bid change: the hash of its file, saved
+        by put (or computed from the file, for records saved without one). KeyError if there is no record."""
+        fname = self._fname(bid)
+        try:
+            with open(fname[:-len(self.ext)] + self.ver_ext, "rb") as fin:
+                return fin.read()
+        except IOError:
+            pass
+        try:
+            fin = open(fname, "rb")
+        except IOError:
+            raise KeyError(bid)
+        with fin:
+            return hashlib.sha1(fin.read()).hexdigest()
+
+    def bids(self):
+        """The bids of all the records in the store."""
+        return [self._bid(f) for f in sorted(os.listdir(self.path)) if f.endswith(self.ext)]
+
+    def __contains__(self, bid):
+        return os.path.exists(self._fname(bid))
+
+    def __len__(self):
+        return len(self.bids())
+
+    def __iter__(self):
+        """Yield the records, one at a time."""
+        for bid in self.bids():
+            yield self.get(bid)
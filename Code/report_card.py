@@ -1,186 +1,207 @@
-import matplotlib
-#matplotlib.use('Agg') #used to keep Amazon happy
 from   os import listdir
 from   utils import *
 import numpy as np
 import sys
-import matplotlib.pyplot as plt
 
-import plotter_new as pn
+import analytics as an
+import spectral
+import baseload
+from   agg_table import AggTable
+from   timeaxis import get_calendar
 
 
-def get_report(d):
+#The report-feature registry.
+#A feature has a name, a list of inputs, and a function computing its value from the values of those inputs.
+#An input is an intermediate value shared by several features (e.g., the matrix of days); it is computed
+#at most once per report, and only if a requested feature needs it.
+registry      = {} #name -> (list of input names, function)
+feature_order = [] #the order features are registered in (and reported in)
+inputs        = {} #name -> function taking the building record and the (lazy) inputs
+
+def register_input(name, fun):
+    """Register an intermediate value for report features.
+
+    Parameters:
+    name -- The name of the input.
+    fun -- A function which, given a building record and the inputs of the report being computed,
+           returns the value. Other inputs are computed on demand by indexing, e.g. ins["days"].
+    """
+    inputs[name] = fun
+
+def register_feature(name, input_names, fun):
+    """Register a report feature (replacing any feature with the same name).
+
+    Parameters:
+    name -- The name of the feature (its key in a Building Report).
+    input_names -- The names of the inputs the feature needs.
+    fun -- A function which, given the values of the inputs (in order), returns the value of the feature.
+    """
+    for i in input_names:
+        if i not in inputs:
+            raise ValueError("Unknown report input: %s" % i)
+    if name not in registry:
+        feature_order.append(name)
+    registry[name] = (list(input_names), fun)
+
+class ReportInputs(object):
+    """The inputs of one building report, computed lazily (and only once)."""
+    def __init__(self, d):
+        self.d      = d
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            self.values[name] = inputs[name](self.d, self)
+        return self.values[name]
+
+def get_report(d, features = None):
     """Given a building record d, return a Building Report.
     A Building Report is a dictionary mapping names of features to values.
-    TODO: Say what each feature is.
+
+    Parameters:
+    d -- The building record.
+    features -- A list of feature names (defaults to all registered features).
+                Only the inputs needed by these features are computed.
     """
+    if features is None:
+        features = feature_order
+    ins = ReportInputs(d)
     toR = {}
+    for name in features:
+        if name not in registry:
+            raise ValueError("Unknown report feature: %s" % name)
+        input_names, fun = registry[name]
+        toR[name] = fun(*[ins[i] for i in input_names])
+    return toR
+
+#Report inputs (the predicates take the Calendar of the record, see timeaxis)
+is_midnight   = (lambda c: c.hour == 0)
+skip_weekdays = (lambda c: c.weekday < 5)
+skip_weekends = (lambda c: c.weekday >= 5)
+
+def _schedule_groups(d, ins):
+    """The original kwhs split by schedule (in/out of working hours) and by weekday/weekend."""
+    hr_start = 8
+    hr_stop  = 16
+    cal                  = get_calendar(d)
     kwhs, kwhs_oriflag   = d["kwhs"]
-    temps, temps_oriflag = d["temps"]
-    times = d["times"]
-    toR["naics"] = d["naics"] #Just to see what happens here...
-    
-    #General stats
-    toR["avg"]        = np.average(kwhs[kwhs_oriflag])
-    toR["max"]        = np.max(kwhs[kwhs_oriflag])
-    toR["min"]        = np.min(kwhs[kwhs_oriflag])
-    toR["var"]        = np.var(kwhs[kwhs_oriflag])
-    toR["med"]        = np.median(kwhs[kwhs_oriflag])
-    toR["total"]      = np.sum(kwhs[kwhs_oriflag]) 
-    
-
-    #Difference between weekday and weekend
-    is_midnight     = (lambda x: x.hour == 0)
-    skip_weekdays   = (lambda x: x.weekday() < 5)
-    weekends, _     = pn.get_periods(d, 24, is_midnight, "kwhs", skip_weekdays)
-    
-    skip_weekend    = (lambda x: x.weekday() >= 5)
-    weekdays, _     = pn.get_periods(d, 24, is_midnight, "kwhs", skip_weekend)
-
-    weekday_peaks   = np.ma.max(weekdays, axis = 1)
-    weekend_peaks   = np.ma.max(weekends, axis = 1)
-    
-    avg_weekday_peak = np.ma.average(weekday_peaks)
-    avg_weekend_peak = np.ma.average(weekend_peaks)
-    
-    toR["week_day_vs_end_peaks"] = avg_weekday_peak - avg_weekend_peak
-
-    #avg hour of daily peak:
-
-    days, new_times     = pn.get_periods(d, 24, is_midnight)
-    peak_hours          = np.ma.argmax(days, axis = 1)
-    toR["avg_tod_peak"] = np.ma.average(peak_hours)
-    #TODO: Separate into weekend/day
-
-    #avg distance (in hours) to temp peak 
-    temps, new_times = pn.get_periods(d, 24, is_midnight, which = "temps")
-    peak_temps = np.ma.argmax(temps, axis = 1)
-    dists = np.ma.abs(peak_temps - peak_hours)
-    toR["avg_temp_to_kwhs_peaks"] = np.ma.average(dists)
-
-    
-    #TODO: Add avg distance (in hours) of daily peak to natural noon
-    
-    #Phantom load approximation
-    is_midnight         = (lambda x: x.hour == 0)
-    skip_weekdays       = (lambda x: x.weekday() < 5)
-    weekends, new_times = pn.get_periods(d, 24, is_midnight, skip_fun = skip_weekdays)
-
-    is_midnight         = (lambda x: x.hour == 0)
-    skip_weekends       = (lambda x: x.weekday() >= 5)
-    weekdays, new_times = pn.get_periods(d, 24, is_midnight, skip_fun = skip_weekends)
-    toR["avg_weekday_min"] = np.ma.average(np.ma.min(weekdays, axis = 0))
-    toR["avg_weekend_min"] = np.ma.average(np.ma.min(weekends, axis = 0))
-
-    #Distance correlation between temps and kwhs (agg days)
-    #Note that we use imputed temps, but only original kwhs
-    is_midnight      = (lambda x: x.hour == 0)
-    days, new_times  = pn.get_periods(d, 24, is_midnight)
-    day_totals       = np.ma.sum(days, axis = 1)
-    temps, new_times = pn.get_periods(d, 24, is_midnight, which = "temps")
-    temp_avgs = np.ma.average(temps, axis = 1)
-    toR["dCorr_kwhs_temps"] = dCorr(day_totals, temp_avgs)
-    
-    #Stats regarding first derivative
+
+    in_flag      = np.logical_and(hr_start <= cal.hour, cal.hour <= hr_stop)
+    out_flag     = ~in_flag
+    weekday_flag = cal.weekday < 5
+    weekend_flag = ~weekday_flag
+
+    return {"weekday_in" : kwhs[np.logical_and(kwhs_oriflag, np.logical_and(in_flag, weekday_flag))],
+            "weekday_out": kwhs[np.logical_and(kwhs_oriflag, np.logical_and(out_flag, weekday_flag))],
+            "weekend_in" : kwhs[np.logical_and(kwhs_oriflag, np.logical_and(in_flag, weekend_flag))],
+            "weekend_out": kwhs[np.logical_and(kwhs_oriflag, np.logical_and(out_flag, weekend_flag))]}
+
+def _first_deriv(d, ins):
+    """The hourly changes in kwhs, where both sides of the change are original values."""
+    kwhs, kwhs_oriflag  = d["kwhs"]
     first_deriv         = kwhs[1:] - kwhs[:-1]
     first_deriv_oriflag = np.logical_and(kwhs_oriflag[1:], kwhs_oriflag[:-1])
-    oris                = first_deriv[first_deriv_oriflag]
-    increases           = oris[oris > 0]
-    decreases           = oris[oris < 0]
-
-    toR["avg_increase"] = np.average(increases)
-    toR["avg_decrease"] = np.average(decreases)
-    toR["var_change"]   = np.var(oris)
-    
-    #Stats regarding DFT
-    a         = np.fft.fft(kwhs)
-    num_times = len(kwhs)
-    half      = (num_times + 1) // 2
-    a         = a[0:half +1]
-    a[0]      = 0 #drop constant part of signal
-
-    power     = a**2 #definition of power
-    power     = np.absolute(power) #to make everything real
-    total_power = np.sum(power)
-    toR["spectral_power"] = np.real(total_power)
-    
-    highlighted_periods =  np.array([24, 168])
-    highlighted_freqs   = float(num_times) / highlighted_periods
-    for p, f in zip(highlighted_periods, highlighted_freqs):
-        mykey = "prop_of_" + str(p)
-        toR[mykey] = np.absolute((a[f] ** 2)) / total_power
-
-    #Missing values:
-    toR["num_missing"] = len([x for x in kwhs_oriflag if not x])
-
-    #Relating to boxplots
-    hr_start = 8
-    hr_stop = 16
-    in_schedule = (lambda x: hr_start <= x.hour <= hr_stop)
-    out_schedule = (lambda x: x.hour < hr_start or x.hour > hr_stop)
-    is_weekday = (lambda x: x.weekday() < 5)
-    is_weekend = (lambda x: x.weekday() >= 5)
-
-    out_flag = [out_schedule(t) for t in times]
-    in_flag  = [in_schedule(t) for t in times]
-    weekday_flag = [is_weekday(t) for t in times]
-    weekend_flag = [is_weekend(t) for t in times]
-    
-    weekday_kwhs_in  = kwhs[np.logical_and(kwhs_oriflag, np.logical_and(in_flag, weekday_flag))]
-    weekday_kwhs_out = kwhs[np.logical_and(kwhs_oriflag, np.logical_and(out_flag, weekday_flag))]
-
-    weekend_kwhs_in  = kwhs[np.logical_and(kwhs_oriflag, np.logical_and(in_flag, weekend_flag))]
-    weekend_kwhs_out = kwhs[np.logical_and(kwhs_oriflag, np.logical_and(out_flag, weekend_flag))]
-
-    #width of 50percent block
-    weekday_working_75 = np.percentile(weekday_kwhs_in, 75)
-    weekday_working_25 = np.percentile(weekday_kwhs_in, 25)
-    toR["weekday_working_width"] = weekday_working_75 - weekday_working_25
-    
-    weekday_nonworking_75 = np.percentile(weekday_kwhs_out, 75)
-    weekday_nonworking_25 = np.percentile(weekday_kwhs_out, 25)
-    toR["weekday_nonworking_width"] = weekday_working_75 - weekday_working_25
-    
-    weekend_working_75 = np.percentile(weekend_kwhs_in, 75)
-    weekend_working_25 = np.percentile(weekend_kwhs_in, 25)
-    toR["weekend_working_width"] = weekend_working_75 - weekend_working_25
-    
-    weekend_nonworking_75 = np.percentile(weekend_kwhs_out, 75)
-    weekend_nonworking_25 = np.percentile(weekend_kwhs_out, 25)
-    toR["weekend_nonworking_width"] = weekend_working_75 - weekend_working_25
-    
-    #now comparing medians
-    weekday_working_med    = np.median(weekday_kwhs_in)
-    weekday_nonworking_med = np.median(weekday_kwhs_out)
-
-    weekend_working_med    = np.median(weekend_kwhs_in)
-    weekend_nonworking_med = np.median(weekend_kwhs_out)
-
-    toR["weekday_med_dif"]       = weekday_working_med - weekday_nonworking_med
-    toR["weekend_med_dif"]       = weekend_working_med - weekend_nonworking_med
-    toR["day_vs_end_working"]    = weekday_working_med - weekend_working_med
-    toR["day_vs_end_nonworking"] = weekday_nonworking_med - weekend_nonworking_med
+    return first_deriv[first_deriv_oriflag]
 
-    return toR
+register_input("record",         (lambda d, ins: d))
+register_input("kwhs",           (lambda d, ins: d["kwhs"][0]))
+register_input("kwhs_oriflag",   (lambda d, ins: d["kwhs"][1]))
+register_input("ori_kwhs",       (lambda d, ins: ins["kwhs"][ins["kwhs_oriflag"]]))
+register_input("days",           (lambda d, ins: an.get_periods(d, 24, is_midnight)[0]))
+register_input("weekdays",       (lambda d, ins: an.get_periods(d, 24, is_midnight, skip_fun = skip_weekends)[0]))
+register_input("weekends",       (lambda d, ins: an.get_periods(d, 24, is_midnight, skip_fun = skip_weekdays)[0]))
+register_input("temp_days",      (lambda d, ins: an.get_periods(d, 24, is_midnight, which = "temps")[0]))
+register_input("peak_hours",     (lambda d, ins: np.ma.argmax(ins["days"], axis = 1)))
+register_input("first_deriv",    _first_deriv)
+register_input("spectrum",       (lambda d, ins: spectral.get_spectrum(d)))
+register_input("baseload",       (lambda d, ins: baseload.baseload_features(*baseload.get_baseload(d), avg = np.average(ins["ori_kwhs"]))))
+register_input("schedule_groups", _schedule_groups)
+
+#Report features
+register_feature("naics", ["record"], (lambda d: d["naics"])) #Just to see what happens here...
+
+#General stats
+register_feature("avg",   ["ori_kwhs"], np.average)
+register_feature("max",   ["ori_kwhs"], np.max)
+register_feature("min",   ["ori_kwhs"], np.min)
+register_feature("var",   ["ori_kwhs"], np.var)
+register_feature("med",   ["ori_kwhs"], np.median)
+register_feature("total", ["ori_kwhs"], np.sum)
+
+#Difference between weekday and weekend
+register_feature("week_day_vs_end_peaks", ["weekdays", "weekends"],
+                 (lambda weekdays, weekends: np.ma.average(np.ma.max(weekdays, axis = 1)) -
+                                             np.ma.average(np.ma.max(weekends, axis = 1))))
+
+#avg hour of daily peak:
+#TODO: Separate into weekend/day
+register_feature("avg_tod_peak", ["peak_hours"], np.ma.average)
+
+#avg distance (in hours) to temp peak
+register_feature("avg_temp_to_kwhs_peaks", ["temp_days", "peak_hours"],
+                 (lambda temps, peak_hours: np.ma.average(np.ma.abs(np.ma.argmax(temps, axis = 1) - peak_hours))))
+
+#TODO: Add avg distance (in hours) of daily peak to natural noon
 
-def agg_reports(list_of_brecs):
+#Phantom load approximation
+register_feature("avg_weekday_min", ["weekdays"], (lambda weekdays: np.ma.average(np.ma.min(weekdays, axis = 0))))
+register_feature("avg_weekend_min", ["weekends"], (lambda weekends: np.ma.average(np.ma.min(weekends, axis = 0))))
+#rolling (weekly) baseload, and how it drifts over the record
+for name in ["baseload_mean", "baseload_trend", "baseload_drift", "baseload_frac"]:
+    register_feature(name, ["baseload"], (lambda b, name = name: b[name]))
+
+#Distance correlation between temps and kwhs (agg days)
+#Note that we use imputed temps, but only original kwhs
+register_feature("dCorr_kwhs_temps", ["days", "temp_days"],
+                 (lambda days, temps: dCorr(np.ma.sum(days, axis = 1), np.ma.average(temps, axis = 1))))
+
+#Stats regarding first derivative
+register_feature("avg_increase", ["first_deriv"], (lambda oris: np.average(oris[oris > 0])))
+register_feature("avg_decrease", ["first_deriv"], (lambda oris: np.average(oris[oris < 0])))
+register_feature("var_change",   ["first_deriv"], np.var)
+
+#Stats regarding DFT
+register_feature("spectral_power", ["spectrum"], (lambda spec: spec["total_power"]))
+for p in [24, 168]:
+    register_feature("prop_of_" + str(p), ["spectrum"], (lambda spec, p = p: spectral.prop_of_periods(spec, [p])[0]))
+
+#Missing values:
+register_feature("num_missing", ["kwhs_oriflag"], (lambda oriflag: len(oriflag) - np.count_nonzero(oriflag)))
+
+#Relating to boxplots
+#width of 50percent block
+width = (lambda vals: np.percentile(vals, 75) - np.percentile(vals, 25))
+register_feature("weekday_working_width",    ["schedule_groups"], (lambda g: width(g["weekday_in"])))
+register_feature("weekday_nonworking_width", ["schedule_groups"], (lambda g: width(g["weekday_out"])))
+register_feature("weekend_working_width",    ["schedule_groups"], (lambda g: width(g["weekend_in"])))
+register_feature("weekend_nonworking_width", ["schedule_groups"], (lambda g: width(g["weekend_out"])))
+
+#now comparing medians
+med_dif = (lambda g, a, b: np.median(g[a]) - np.median(g[b]))
+register_feature("weekday_med_dif",       ["schedule_groups"], (lambda g: med_dif(g, "weekday_in",  "weekday_out")))
+register_feature("weekend_med_dif",       ["schedule_groups"], (lambda g: med_dif(g, "weekend_in",  "weekend_out")))
+register_feature("day_vs_end_working",    ["schedule_groups"], (lambda g: med_dif(g, "weekday_in",  "weekend_in")))
+register_feature("day_vs_end_nonworking", ["schedule_groups"], (lambda g: med_dif(g, "weekday_out", "weekend_out")))
+
+def agg_reports(list_of_brecs, features = None):
     """Given a list of building records, return an aggregate report.
-    In an aggregate report, each key in a Building Report is mapped to a list of values (one per building).
+    An aggregate report is an AggTable: one row per building (indexed by bid), one column per
+    feature of the Building Reports, plus the btype and naics of each building as categories.
+    features -- As in get_report.
     """
-    toR         = {}
-    naics_codes = []
-    errs        = open("errs.txt", "w")
+    bids    = []
+    reports = []
+    btypes  = []
+    naicss  = []
+    errs    = open("errs.txt", "w")
 
     for d in list_of_brecs:        
         try:
-            r = get_report(d)
-            for k in r.keys():
-                if k in toR:
-                    toR[k].append(r[k])
-                else:
-                    toR[k] = [r[k]]
-            #naics_codes.append(d["naics"])
-            naics_codes.append(d["btype"])
+            r = get_report(d, features)
+            bids.append(d["bid"])
+            reports.append(r)
+            btypes.append(d["btype"])
+            naicss.append(d["naics"])
             print d["btype"]
         except Exception as inst:
             print "Failed", d["bid"]
@@ -189,26 +210,35 @@ def agg_reports(list_of_brecs):
             print inst           # __str__ allows args to printed directly
             errs.write(str(d["bid"]) + "\n")
             sys.stdout.flush()
-    return toR, naics_codes
+    errs.close()
+    return AggTable.from_reports(bids, reports, {"btype": btypes, "naics": naicss})
 
 def plot_agg_reports(agg, add_str = ""):
-    for k in agg.keys():
+    """Save a histogram of each feature of the aggregate report agg (an AggTable)."""
+    import matplotlib
+    #matplotlib.use('Agg') #used to keep Amazon happy
+    import matplotlib.pyplot as plt
+    for k in agg.features():
+        vals     = agg[k]
+        vals     = vals[np.isfinite(vals)]
         fig      = plt.figure(figsize = (5, 5))
         ax       = fig.add_subplot(1, 1, 1)
         num_bins = 100# int(np.log2(len(agg.keys())) + 1)
-        ax.hist(agg[k], bins = num_bins)
+        ax.hist(vals, bins = num_bins)
         ax.set_title(k)
         plt.savefig(fig_loc + "agg_reports_" + k + add_str +  ".png")
         plt.close()
 
 def process_prison_quarters():
+    """Store the Building Reports of the prison facilities, by quarter, in prison_reps.sqlite (see report_db);
+    only the quarters whose records or feature code changed since the last run are recomputed."""
+    from report_db import ReportDB
     data, desc = qload("state_b_records_" + str(the_year) + "_quarters.pkl")
-    toSave = []
+    db = ReportDB(data_loc + "prison_reps.sqlite")
     for d in data:
-        print d["bid"]
+        print d["bid"], "computed" if db.update(d) else "up to date"
         sys.stdout.flush()
-        toSave.append((d["bid"], get_report(d)))
-    qdump((toSave, "The Building Reports for the prison facilities, by quarter"), "prison_reps.pkl")
+    db.close()
 
 if __name__ == "__main__":
     process_prison_quarters(); exit()
@@ -219,17 +249,16 @@ if __name__ == "__main__":
         d, desc = qload(finn)
         ds.append(d)
         
-    agg, naicss = agg_reports(ds)
-    qdump((agg, "The aggregate reports"), "agg_reps.pkl")
-
-    #naicss = [d["naics"] for d in ds]
-    qdump((naicss, "The NAICS codes in the same order as the agg report"), "naics_codes" + add_str +  ".pkl") 
+    from report_db import ReportDB
+    db = ReportDB(data_loc + "agg_reps.sqlite")
+    print "Computed %d reports, %d were up to date, %d failed" % db.update_all(ds)
+    agg = db.agg_table() #an AggTable, with the btype and naics of each building
     #plt_agg_reports(agg)
     exit()
-    for naics in naicss:
-        new_ds = [d for d in ds if d["naics"] == naics]
-        agg    = agg_reports(new_ds)
-        plot_agg_reports(agg, add_str = "_" + str(naics) + "with_" + str(len(new_ds)))
+    codes, labels = agg.categoricals["btype"]
+    for btype in labels:
+        seg = agg.segment("btype", btype) #a slice of the table, no need to recompute the reports
+        plot_agg_reports(seg, add_str = "_" + str(btype) + "with_" + str(len(seg)))
 
     #agg = agg_reports(ds)
     #plot_agg_reports(agg)
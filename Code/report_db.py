@@ -0,0 +1,240 @@
+"""Building Reports persisted in a SQLite database, recomputed only when their inputs or the feature code change.
+
+Tables:
+    reports -- One row per (bid, period, feature_version): the btype and naics of the building, the hash of
+               the input arrays the report was computed from, and the report (JSON).
+    metrics -- One row per (bid, period, feature_version, feature), with its value, so dashboards can query
+               the metrics directly, e.g.
+               SELECT bid, value FROM metrics WHERE feature = 'avg' AND feature_version = ? ORDER BY value DESC
+
+The period of a report is the range of local dates of its record (e.g., "2012-01-01/2012-03-31"), so quarters
+of the same building are kept apart. The feature_version is a hash of the code of the registered report
+features and inputs, and of the source of every project module they can call (see feature_set_version), so
+changing any of them (e.g., analytics.period_inds) makes the stored reports stale.
+
+Example:
+    db = ReportDB(data_loc + "reports.sqlite")
+    computed, skipped, failed = db.update_all(RecordStore("records"))
+    print db.get(17)["avg"]
+"""
+import  os
+import  sys
+import  json
+import  math
+import  time
+import  types
+import  hashlib
+import  sqlite3
+import  numpy as np
+
+import  report_card
+import  timeaxis as ta
+from    agg_table import AggTable
+
+code_version = 1 #bump to recompute every report for reasons outside the project's code (e.g., a new NumPy)
+
+schema = """
+CREATE TABLE IF NOT EXISTS reports (
+    bid             NOT NULL,
+    period          TEXT NOT NULL,
+    feature_version TEXT NOT NULL,
+    input_hash      TEXT NOT NULL,
+    btype           TEXT,
+    naics,
+    computed        REAL,
+    report          TEXT,
+    PRIMARY KEY (bid, period, feature_version));
+CREATE INDEX IF NOT EXISTS reports_bid   ON reports (bid);
+CREATE INDEX IF NOT EXISTS reports_btype ON reports (btype);
+CREATE INDEX IF NOT EXISTS reports_naics ON reports (naics);
+CREATE TABLE IF NOT EXISTS metrics (
+    bid             NOT NULL,
+    period          TEXT NOT NULL,
+    feature_version TEXT NOT NULL,
+    feature         TEXT NOT NULL,
+    value           REAL,
+    PRIMARY KEY (bid, period, feature_version, feature));
+CREATE INDEX IF NOT EXISTS metrics_feature ON metrics (feature_version, feature, value);
+"""
+
+def _fingerprint(obj):
+    """A string which changes when the code of a function (or code object) changes."""
+    code = getattr(obj, "__code__", obj if isinstance(obj, types.CodeType) else None)
+    if code is None: #a builtin or NumPy function
+        return getattr(obj, "__module__", "") + "." + getattr(obj, "__name__", repr(obj))
+    parts = [code.co_code, repr(code.co_names)]
+    parts.extend(_fingerprint(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts)
+    parts.append(repr(getattr(obj, "__defaults__", None)))
+    return "|".join(parts)
+
+def _project_modules(root = report_card):
+    """The project modules (those in the directory of root) which root uses, directly or through each other:
+    the modules, and the modules of the functions and classes, among their globals. A dictionary name -> module."""
+    where = os.path.dirname(os.path.abspath(root.__file__))
+    found = {root.__name__: root}
+    todo  = [root]
+    while todo:
+        for obj in vars(todo.pop()).values():
+            mod = obj if isinstance(obj, types.ModuleType) else sys.modules.get(getattr(obj, "__module__", None) or "")
+            if mod is None or mod.__name__ in found or not getattr(mod, "__file__", None):
+                continue
+            if os.path.dirname(os.path.abspath(mod.__file__)) == where:
+                found[mod.__name__] = mod
+                todo.append(mod)
+    return found
+
+def _source(mod):
+    """The source of a module (of its .py file, also when it was loaded from a .pyc)."""
+    fname = os.path.splitext(mod.__file__)[0] + ".py"
+    with open(fname, "rb") as fin:
+        return fin.read()
+
+def feature_set_version(features = None):
+    """A hash of the code of the report features (all registered ones by default), of every report input,
+    and of the source of the project modules they can call (see _project_modules)."""
+    if features is None:
+        features = report_card.feature_order
+    h = hashlib.sha1(str(code_version))
+    for name in features:
+        input_names, fun = report_card.registry[name]
+        h.update(name + repr(input_names) + _fingerprint(fun))
+    for name in sorted(report_card.inputs):
+        h.update(name + _fingerprint(report_card.inputs[name]))
+    for name, mod in sorted(_project_modules().items()):
+        h.update(name + _source(mod))
+    return h.hexdigest()[:16]
+
+def input_hash(d):
+    """A hash of the contents of a building record's time axis, time zone, kwhs and temps (and their oriflags)."""
+    h = hashlib.sha1(ta.tz_of(d))
+    h.update(np.ascontiguousarray(ta.utc_epochs(d)).tostring())
+    for which in ("kwhs", "temps"):
+        if which in d:
+            vals, oriflag = d[which]
+            h.update(np.ascontiguousarray(vals, dtype = float).tostring())
+            h.update(np.ascontiguousarray(oriflag, dtype = bool).tostring())
+    return h.hexdigest()
+
+def period_of(d):
+    """The period of a building record: the range of its local dates (e.g., "2012-01-01/2012-12-30")."""
+    date = ta.get_calendar(d).date
+    if len(date) == 0:
+        return ""
+    return str(date[0]) + "/" + str(date[-1])
+
+def _value(v):
+    """A report value as a number for the database (masked values, nans and infinities become NULL)."""
+    if v is np.ma.masked or v is None:
+        return None
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(f) or math.isinf(f) else f
+
+def _key(bid):
+    #NumPy scalars are stored as plain Python values
+    return bid.item() if isinstance(bid, np.generic) else bid
+
+class ReportDB(object):
+    """Building Reports in a SQLite database.
+
+    Parameters:
+    path -- The database file (created if it does not exist; ":memory:" for a temporary one).
+    features -- The report features computed (defaults to all registered features).
+    """
+    def __init__(self, path, features = None):
+        self.path     = path
+        self.features = list(features) if features is not None else list(report_card.feature_order)
+        self.version  = feature_set_version(self.features)
+        self.conn     = sqlite3.connect(path)
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.close()
+
+    def stored_hash(self, bid, period):
+        """The input hash of the stored report of (bid, period) for the current feature version, or None."""
+        row = self.conn.execute("SELECT input_hash FROM reports WHERE bid = ? AND period = ? AND feature_version = ?",
+                                (_key(bid), period, self.version)).fetchone()
+        return None if row is None else row[0]
+
+    def update(self, d, period = None, force = False):
+        """Compute and store the report of record d, unless it is already stored for the same inputs and feature code.
+        Returns True if the report was (re)computed."""
+        period = period_of(d) if period is None else period
+        h      = input_hash(d)
+        if not force and self.stored_hash(d["bid"], period) == h:
+            return False
+        rep  = report_card.get_report(d, self.features)
+        key  = (_key(d["bid"]), period, self.version)
+        vals = dict((k, _value(v)) for k, v in rep.items())
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              key + (h, d.get("btype"), _key(d.get("naics")), time.time(), json.dumps(vals, sort_keys = True)))
+            self.conn.execute("DELETE FROM metrics WHERE bid = ? AND period = ? AND feature_version = ?", key)
+            self.conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?)",
+                                  [key + (k, v) for k, v in sorted(vals.items())])
+        return True
+
+    def update_all(self, brecs, period_fun = None):
+        """Update the reports of an iterable of building records (see update).
+        period_fun -- A function giving the period of a record (defaults to period_of).
+        Records whose report fails are reported (as in report_card.agg_reports) and skipped.
+        Returns (number of reports computed, number up to date, number failed)."""
+        computed = skipped = failed = 0
+        for d in brecs:
+            try:
+                if self.update(d, None if period_fun is None else period_fun(d)):
+                    computed += 1
+                else:
+                    skipped += 1
+            except Exception as inst:
+                print "Failed", d["bid"], type(inst), inst
+                failed += 1
+        return computed, skipped, failed
+
+    def get(self, bid, period = None):
+        """The stored report of bid for the current feature version (of the given period, or of its latest one),
+        or None. Values which could not be stored as numbers are None."""
+        sql  = "SELECT report FROM reports WHERE bid = ? AND feature_version = ?"
+        args = [_key(bid), self.version]
+        if period is not None:
+            sql += " AND period = ?"
+            args.append(period)
+        row = self.conn.execute(sql + " ORDER BY period DESC LIMIT 1", args).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def query(self, feature, btype = None, naics = None):
+        """The values of a feature for the current feature version, as a list of (bid, period, value),
+        optionally only for buildings of a btype and/or naics."""
+        sql  = ("SELECT m.bid, m.period, m.value FROM metrics m JOIN reports r "
+                "ON m.bid = r.bid AND m.period = r.period AND m.feature_version = r.feature_version "
+                "WHERE m.feature_version = ? AND m.feature = ?")
+        args = [self.version, feature]
+        if btype is not None:
+            sql += " AND r.btype = ?"
+            args.append(btype)
+        if naics is not None:
+            sql += " AND r.naics = ?"
+            args.append(_key(naics))
+        return self.conn.execute(sql + " ORDER BY m.bid, m.period", args).fetchall()
+
+    def agg_table(self, period = None):
+        """The stored reports (of the current feature version, and of one period if given) as an AggTable
+        (as made by report_card.agg_reports), one row per report."""
+        sql  = "SELECT bid, btype, naics, report FROM reports WHERE feature_version = ?"
+        args = [self.version]
+        if period is not None:
+            sql += " AND period = ?"
+            args.append(period)
+        rows = self.conn.execute(sql + " ORDER BY bid, period", args).fetchall()
+        return AggTable.from_reports([r[0] for r in rows], [json.loads(r[3]) for r in rows],
+                                     {"btype": [r[1] for r in rows], "naics": [r[2] for r in rows]})
+
+    def prune(self):
+        """Delete the reports of other feature versions. Returns the number of reports deleted."""
+        with self.conn:
+            n = self.conn.execute("DELETE FROM reports WHERE feature_version != ?", (self.version,)).rowcount
+            self.conn.execute("DELETE FROM metrics WHERE feature_version != ?", (self.version,))
+        return n
@@ -0,0 +1,313 @@
+"""A long-running HTTP service for building reports.
+
+Lookup tables (stateDB.pickle, NAICS.pkl, ...) and recently used building records stay in memory,
+and rendered outputs are kept in an LRU cache, so repeat requests cost a file stat and a dictionary lookup.
+Cached records and outputs are keyed by the version of the record in the store (RecordStore.version),
+so they are recomputed as soon as the record changes. Requests are served by a fixed pool of worker threads;
+matplotlib is not thread safe, so figures are rendered one at a time (reports are computed concurrently).
+
+Requests:
+    GET /buildings                    The bids in the store (JSON).
+    GET /report/<bid>                 The Building Report (report_card.get_report), as JSON.
+    GET /report/<bid>.pdf             The full pdf report (as made by plotter_new.multi_plot).
+    GET /page/<bid>/<page>.pdf        One page of the report (see plotter_new.add_fig), e.g. /page/17/box%20plots.pdf
+    GET /page/<bid>/<page>.png[?n=1]  The same page, as a png (n picks a sheet of multi-sheet pages, from 0).
+    GET /stats                        Cache statistics (JSON).
+
+Usage:
+    python report_server.py <store dir> [--port 8000] [--workers 4] [--cache 256] [--records 64]
+"""
+import  matplotlib
+matplotlib.use('Agg')
+import  os
+import  sys
+import  json
+import  math
+import  Queue
+import  urllib
+import  urlparse
+import  tempfile
+import  threading
+import  cStringIO
+import  collections
+import  BaseHTTPServer
+import  numpy as np
+import  matplotlib.pyplot as plt
+from    matplotlib.backends.backend_pdf import PdfPages
+
+import  utils
+import  report_card
+import  plotter_new as pn
+from    record_store import RecordStore
+
+class NotFound(Exception):
+    """A request for a building, page or sheet which does not exist (answered with 404)."""
+
+class BadRequest(Exception):
+    """A request which cannot be understood (answered with 400)."""
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache. Each entry has a version; getting it with another version
+    is a miss (and drops the entry).
+
+    Parameters:
+    max_entries -- The number of entries kept.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries     = collections.OrderedDict()
+        self.lock        = threading.Lock()
+        self.hits        = 0
+        self.misses      = 0
+
+    def get(self, key, version):
+        """The value stored for key and version, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries[key] = entry #now the most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses}
+
+class PngPages(object):
+    """Collects the sheets of a report page as png images (it stands in for a PdfPages in plotter_new.add_fig)."""
+    def __init__(self, dpi = 100):
+        self.dpi    = dpi
+        self.sheets = []
+
+    def savefig(self, figure = None, **kwargs):
+        if figure is None:
+            figure = plt.gcf()
+        buf = cStringIO.StringIO()
+        figure.savefig(buf, format = "png", dpi = self.dpi)
+        self.sheets.append(buf.getvalue())
+
+def _jsonable(v):
+    """A report value as a JSON value (masked values, nans and infinities become null)."""
+    if v is np.ma.masked or v is None:
+        return None
+    if isinstance(v, (bool, np.bool_)):
+        return bool(v)
+    if isinstance(v, (int, long, np.integer)):
+        return int(v)
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return str(v)
+    return None if math.isnan(f) or math.isinf(f) else f
+
+class ReportService(object):
+    """Reports for the buildings of a RecordStore, with cached records and outputs.
+
+    Parameters:
+    store -- The RecordStore.
+    cache_entries -- The number of rendered outputs (reports, pdfs, pngs) kept in memory.
+    record_entries -- The number of building records kept in memory.
+    size, fontsize -- The page size (in inches) and title font size of the rendered pages.
+    """
+    def __init__(self, store, cache_entries = 256, record_entries = 64, size = (8.5, 11), fontsize = 24):
+        self.store       = store
+        self.outputs     = LRUCache(cache_entries)
+        self.records     = LRUCache(record_entries)
+        self.size        = size
+        self.fontsize    = fontsize
+        self.render_lock = threading.Lock()
+
+    def parse_bid(self, s):
+        """The bid named s in a request (bids of the store may be ints or strings). NotFound if there is none."""
+        if s.lstrip("-").isdigit() and int(s) in self.store:
+            return int(s)
+        if s in self.store:
+            return s
+        raise NotFound(s)
+
+    def version(self, bid):
+        try:
+            return self.store.version(bid)
+        except KeyError: #removed since the request was parsed
+            raise NotFound(bid)
+
+    def record(self, bid):
+        """The (cached) building record of bid."""
+        version = self.version(bid) #taken before reading, so a record is never cached under a newer version
+        d = self.records.get(bid, version)
+        if d is None:
+            d = self.store.get(bid)
+            self.records.put(bid, version, d)
+        return d
+
+    def _cached(self, key, bid, make):
+        version = self.version(bid)
+        out = self.outputs.get(key, version)
+        if out is None:
+            out = make(self.record(bid))
+            self.outputs.put(key, version, out)
+        return out
+
+    def report(self, bid):
+        """The Building Report of bid, as JSON."""
+        def make(d):
+            rep = report_card.get_report(d)
+            return json.dumps(dict((k, _jsonable(v)) for k, v in rep.items()), sort_keys = True)
+        return self._cached(("report", bid), bid, make)
+
+    def report_pdf(self, bid):
+        """The full pdf report of bid."""
+        def make(d):
+            return self._render_pdf(lambda foutn: pn.multi_plot(d, foutn))
+        return self._cached(("report.pdf", bid), bid, make)
+
+    def page(self, bid, which, fmt = "pdf", sheet = 0):
+        """One page of the report of bid (fmt is "pdf" or "png"; sheet picks a sheet of multi-sheet png pages)."""
+        if fmt == "pdf":
+            def make(d):
+                def render(foutn):
+                    pdf = PdfPages(foutn)
+                    try:
+                        pn.add_fig(pdf, d, which, self.size, self.fontsize)
+                    finally:
+                        pdf.close()
+                return self._render_pdf(render)
+            return self._cached(("page.pdf", bid, which), bid, make)
+        elif fmt == "png":
+            def make(d):
+                pages = PngPages()
+                with self.render_lock:
+                    try:
+                        pn.add_fig(pages, d, which, self.size, self.fontsize)
+                    finally:
+                        plt.close("all")
+                return pages.sheets
+            sheets = self._cached(("page.png", bid, which), bid, make)
+            if not 0 <= sheet < len(sheets):
+                raise NotFound("sheet %d" % sheet)
+            return sheets[sheet]
+        raise BadRequest("Unknown format: %s" % fmt)
+
+    def _render_pdf(self, render):
+        """Run render(file name) (which writes a pdf) with the render lock held, and return the pdf."""
+        fd, foutn = tempfile.mkstemp(suffix = ".pdf")
+        os.close(fd)
+        try:
+            with self.render_lock:
+                try:
+                    render(foutn)
+                finally:
+                    plt.close("all")
+            with open(foutn, "rb") as fin:
+                return fin.read()
+        finally:
+            os.remove(foutn)
+
+    def stats(self):
+        return json.dumps({"outputs": self.outputs.stats(), "records": self.records.stats()})
+
+    def handle(self, path, query):
+        """Answer a request. Returns (content type, body); raises NotFound or BadRequest (any other exception is
+        an error of the server)."""
+        parts = [urllib.unquote(p) for p in path.strip("/").split("/")]
+        if parts == ["buildings"]:
+            return "application/json", json.dumps(self.store.bids())
+        if parts == ["stats"]:
+            return "application/json", self.stats()
+        if len(parts) == 2 and parts[0] == "report":
+            if parts[1].endswith(".pdf"):
+                return "application/pdf", self.report_pdf(self.parse_bid(parts[1][:-len(".pdf")]))
+            return "application/json", self.report(self.parse_bid(parts[1]))
+        if len(parts) == 3 and parts[0] == "page":
+            which, _, fmt = parts[2].rpartition(".")
+            if which not in pn.page_funs:
+                raise NotFound(which)
+            sheet = urlparse.parse_qs(query).get("n", ["0"])[0]
+            if not sheet.isdigit():
+                raise BadRequest("Bad sheet number: %s" % sheet)
+            sheet = int(sheet)
+            body  = self.page(self.parse_bid(parts[1]), which, fmt, sheet)
+            return ("image/png" if fmt == "png" else "application/pdf"), body
+        raise BadRequest("Unknown request: %s" % path)
+
+class ReportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        try:
+            ctype, body = self.server.service.handle(path, query)
+            status = 200
+        except NotFound as e:
+            status, ctype, body = 404, "text/plain", "Not found: %s\n" % e
+        except BadRequest as e:
+            status, ctype, body = 400, "text/plain", "Bad request: %s\n" % e
+        except Exception as e:
+            status, ctype, body = 500, "text/plain", "Error: %r\n" % e
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+    """An HTTP server whose requests are handled by a fixed pool of worker threads.
+
+    Parameters:
+    address -- The (host, port) to listen on.
+    service -- The ReportService answering the requests.
+    workers -- The number of worker threads.
+    """
+    def __init__(self, address, service, workers = 4):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReportHandler)
+        self.service = service
+        self.pending = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target = self._work)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self.pending.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+def main(args):
+    opts = {"--port": "8000", "--workers": "4", "--cache": "256", "--records": "64"}
+    if len(args) < 1:
+        print __doc__
+        return 2
+    for flag, val in zip(args[1::2], args[2::2]):
+        if flag not in opts:
+            print __doc__
+            return 2
+        opts[flag] = val
+
+    try:
+        pn.states = utils.qload("stateDB.pickle")
+    except IOError:
+        print "No stateDB.pickle; the sunlight figures will not be available."
+    matplotlib.rc('font', size = 6)
+    service = ReportService(RecordStore(args[0]), int(opts["--cache"]), int(opts["--records"]))
+    server  = PooledHTTPServer(("", int(opts["--port"])), service, int(opts["--workers"]))
+    print "Serving reports for", service.store.path, "on port", opts["--port"]
+    server.serve_forever()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,153 @@
+"""Savings estimates: what a building would save if its high-use days came down to its typical use.
+
+For each hour of the day, the threshold is a percentile (the 95th by default) of the building's original
+readings at that hour. The excess at that hour is the average of the readings above the threshold minus the
+average of all the readings. The savings are the excess priced with a tariff, summed over the day.
+This is the number on the "cami" page of the report.
+Thresholds and averages are computed along an axis of (masked) arrays, so a whole portfolio is estimated
+at once, without rendering any figures.
+
+A tariff is a price in dollars per kwh: a number (a flat rate), or an array with one price per hour of the
+day (time of use, see tou_tariff).
+
+Example:
+    table = savings_table(RecordStore("records"), tariff = tou_tariff(0.04, 0.12, 12, 18))
+    for bid, dollars in zip(table["bid"][:10], table["savings"][:10]):
+        print bid, dollars
+"""
+import  numpy as np
+import  analytics as an
+
+default_tariff = 0.05 #dollars per kwh
+num_hours      = 24
+
+is_midnight = (lambda c: c.hour == 0)
+
+def tariff_prices(tariff = default_tariff):
+    """The price (dollars per kwh) at each hour of the day, given a flat rate or a time-of-use array."""
+    prices = np.asarray(tariff, dtype = float)
+    if prices.ndim == 0:
+        return np.repeat(prices, num_hours)
+    if prices.shape != (num_hours,):
+        raise ValueError("A time-of-use tariff needs one price per hour of the day.")
+    return prices
+
+def tou_tariff(off_peak, on_peak, peak_start, peak_end):
+    """A time-of-use tariff: on_peak dollars per kwh from hour peak_start up to (not including) peak_end,
+    off_peak otherwise (e.g., tou_tariff(0.04, 0.12, 12, 18) for a noon to 6pm peak)."""
+    hours = np.arange(num_hours)
+    return np.where((hours >= peak_start) & (hours < peak_end), float(on_peak), float(off_peak))
+
+def daily_matrix(d, which = "kwhs"):
+    """The days (local midnight to midnight) of a building record, as (values, valid):
+    two (days x 24) arrays, valid being True for the original readings."""
+    days, _ = an.get_periods(d, num_hours, is_midnight, which)
+    return np.ma.getdata(days).astype(float), ~np.ma.getmaskarray(days)
+
+def hourly_excess(vals, valid, q = 95, axis = -2):
+    """The thresholds and averages behind the savings, along axis (the days axis).
+
+    Parameters:
+    vals -- An array of kwhs, e.g. (days x hours) for a building or (buildings x days x hours) for many.
+    valid -- A boolean array of the same shape; True for the values to use.
+    q -- The percentile used as the threshold.
+    axis -- The axis of the days.
+
+    Returns (thresh, avg, high_avg), with axis removed: the threshold, the average, and the average of
+    the values above the threshold (which is avg if there are none). They are nan where no value is valid.
+    """
+    vals   = np.asarray(vals, dtype = float)
+    valid  = np.logical_and(valid, np.isfinite(vals))
+    thresh = an.masked_percentile(vals, valid, q, axis)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        above    = np.logical_and(valid, vals > np.expand_dims(thresh, axis))
+        avg      = np.sum(np.where(valid, vals, 0), axis) / np.sum(valid, axis)
+        high_avg = np.sum(np.where(above, vals, 0), axis) / np.sum(above, axis)
+    high_avg = np.where(np.any(above, axis), high_avg, avg)
+    return thresh, avg, high_avg
+
+def batch_savings(vals, valid, tariff = default_tariff, q = 95):
+    """The savings (dollars per day) of many buildings at once.
+
+    Parameters:
+    vals, valid -- (buildings x days x 24) arrays of kwhs and of their validity (see daily_matrix).
+    tariff -- A flat rate or a time-of-use array (see tariff_prices).
+    q -- The percentile used as the threshold.
+
+    Returns (savings, excess): the savings of each building and its excess kwhs at each hour (buildings x 24).
+    """
+    thresh, avg, high_avg = hourly_excess(vals, valid, q, axis = 1)
+    excess  = high_avg - avg
+    savings = np.sum(excess * tariff_prices(tariff), axis = 1) #nan for buildings with an hour never read
+    return savings, excess
+
+def estimate_savings(d, tariff = default_tariff, q = 95):
+    """The savings estimate of a building record.
+    Returns a dictionary with "savings" (dollars per day), and "thresh", "avg", "high_avg" and "excess"
+    (kwh at each hour of the day, see hourly_excess)."""
+    vals, valid = daily_matrix(d)
+    thresh, avg, high_avg = hourly_excess(vals, valid, q)
+    excess = high_avg - avg
+    return {"savings" : float(np.sum(excess * tariff_prices(tariff))),
+            "thresh"  : thresh,
+            "avg"     : avg,
+            "high_avg": high_avg,
+            "excess"  : excess}
+
+def savings_table(brecs, tariff = default_tariff, q = 95, chunk = 256):
+    """The savings of many buildings, ranked (highest savings first; buildings without an estimate last).
+    Records are read one at a time and estimated in batches of chunk buildings, so memory stays bounded.
+
+    Parameters:
+    brecs -- An iterable of building records (e.g., a RecordStore).
+    tariff -- A flat rate or a time-of-use array (see tariff_prices).
+    q -- The percentile used as the threshold.
+    chunk -- The number of buildings estimated at once.
+
+    Returns a dictionary of columns (arrays, in rank order): "bid", "savings" (dollars per day),
+    "excess_kwh" (per day) and "num_days" (the days with at least one original reading).
+    """
+    bids, savings, excess, num_days = [], [], [], []
+    batch = []
+    def flush():
+        length = max(len(v) for v, _ in batch)
+        vals   = np.zeros((len(batch), length, num_hours))
+        valid  = np.zeros((len(batch), length, num_hours), dtype = bool)
+        for i, (v, ok) in enumerate(batch):
+            vals[i, :len(v)]  = v
+            valid[i, :len(v)] = ok
+        s, e = batch_savings(vals, valid, tariff, q)
+        savings.extend(s)
+        excess.extend(np.sum(e, axis = 1))
+        num_days.extend(np.sum(np.any(valid, axis = 2), axis = 1))
+        del batch[:]
+
+    for d in brecs:
+        bids.append(d["bid"])
+        batch.append(daily_matrix(d))
+        if len(batch) == chunk:
+            flush()
+    if batch:
+        flush()
+
+    savings = np.array(savings, dtype = float)
+    order   = np.argsort(np.where(np.isnan(savings), np.inf, -savings), kind = "mergesort")
+    return {"bid"       : np.array(bids, dtype = object)[order],
+            "savings"   : savings[order],
+            "excess_kwh": np.array(excess, dtype = float)[order],
+            "num_days"  : np.array(num_days, dtype = int)[order]}
+
+def print_table(table, num_rows = 20):
+    print "rank".rjust(6), "bid".rjust(12), "dollars/day".rjust(12), "excess kwh".rjust(12), "days".rjust(6)
+    for i in range(min(num_rows, len(table["bid"]))):
+        print str(i + 1).rjust(6), str(table["bid"][i]).rjust(12), ("%.2f" % table["savings"][i]).rjust(12), \
+              ("%.1f" % table["excess_kwh"][i]).rjust(12), str(table["num_days"][i]).rjust(6)
+
+if __name__ == "__main__":
+    import sys
+    from record_store import RecordStore
+    if len(sys.argv) < 2:
+        print "Usage: python savings.py <store dir> [<flat rate>]"
+        exit()
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else default_tariff
+    print_table(savings_table(RecordStore(sys.argv[1]), rate))
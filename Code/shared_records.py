@@ -0,0 +1,175 @@
+"""Zero-copy transport of building records to worker processes.
+
+The arrays of many records (time axis, kwhs, temps and their oriflags) are packed into one shared-memory
+segment: a file in /dev/shm (a memory-backed file system), so nothing is written to disk. Workers are only sent
+small descriptors (the segment name, and the offset, shape and dtype of each array), and rebuild the record as
+read-only NumPy views of the segment (mapped once per worker), instead of unpickling whole building dicts.
+
+Segments are removed when the SharedRecords that made them is closed (it is a context manager), when
+the process exits, and, if the process that made them died without cleaning up, by the next SharedRecords
+made on the machine (see sweep_stale). Workers only read the segments, so a crashing worker leaves nothing behind.
+
+Example:
+    with SharedRecords(RecordStore("records")) as shared:
+        reports = shared.map(report_card.get_report, workers = 8)
+"""
+import  os
+import  atexit
+import  tempfile
+import  multiprocessing
+import  numpy as np
+
+import  timeaxis as ta
+
+prefix    = "energywise_records_"
+alignment = 64 #bytes, so every array starts on a cache line
+
+_open     = set() #the segments made by this process
+_segments = {}    #segment name -> the segment mapped in this process (see attach)
+
+def shm_dir():
+    """The directory of the segments: /dev/shm if there is one, else the temporary directory."""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == 1 #EPERM: alive, but not ours
+    return True
+
+def sweep_stale(directory = None):
+    """Remove the segments of processes which no longer exist. Returns the number removed."""
+    directory = directory or shm_dir()
+    removed   = 0
+    for fname in os.listdir(directory):
+        if not fname.startswith(prefix):
+            continue
+        try:
+            pid = int(fname[len(prefix):].split("_")[0])
+        except ValueError:
+            continue
+        if not _pid_alive(pid):
+            try:
+                os.remove(os.path.join(directory, fname))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def _remove(path):
+    _open.discard(path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+@atexit.register
+def _cleanup():
+    for path in list(_open):
+        _remove(path)
+
+def _record_arrays(d):
+    """The arrays of a record to share (name -> array), and its other (small) fields."""
+    arrays = {"times": ta.utc_epochs(d).astype(ta.time_dtype)}
+    fields = {}
+    for k, v in d.items():
+        if k == "times":
+            continue
+        if k in ("kwhs", "temps"):
+            vals, oriflag = v
+            arrays[k]              = np.asarray(vals, dtype = float)
+            arrays[k + "_oriflag"] = np.asarray(oriflag, dtype = bool)
+        else:
+            fields[k] = v
+    fields["tz"] = ta.tz_of(d)
+    return arrays, fields
+
+class SharedRecords(object):
+    """Building records packed into a shared-memory segment.
+
+    Parameters:
+    brecs -- An iterable of building records (read one at a time, e.g. a RecordStore).
+    directory -- The directory of the segment (defaults to shm_dir()).
+
+    Attributes:
+    descriptors -- One descriptor per record (a small dictionary, cheap to pickle; see attach).
+    """
+    def __init__(self, brecs, directory = None):
+        directory = directory or shm_dir()
+        sweep_stale(directory)
+        fd, self.path = tempfile.mkstemp(prefix = prefix + str(os.getpid()) + "_", dir = directory)
+        _open.add(self.path)
+        self.descriptors = []
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                offset = 0
+                for d in brecs:
+                    arrays, fields = _record_arrays(d)
+                    layout = {}
+                    for name, arr in sorted(arrays.items()):
+                        arr    = np.ascontiguousarray(arr)
+                        pad    = -offset % alignment
+                        fout.write("\0" * pad)
+                        offset += pad
+                        layout[name] = (offset, arr.shape, arr.dtype.str)
+                        fout.write(arr.tostring())
+                        offset += arr.nbytes
+                    self.descriptors.append({"segment": self.path, "arrays": layout, "fields": fields})
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def close(self):
+        """Remove the segment (records attached from it stay valid in processes that mapped it)."""
+        _remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def map(self, fun, workers = None, chunksize = 1):
+        """Apply fun (a module-level function, so it can be pickled) to each record in a pool of worker processes.
+        Returns the results, in the order of the records."""
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_Apply(fun), self.descriptors, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+class _Apply(object):
+    """fun applied to the record of a descriptor (a class, so it can be pickled to the workers)."""
+    def __init__(self, fun):
+        self.fun = fun
+
+    def __call__(self, desc):
+        return self.fun(attach(desc))
+
+def attach(desc):
+    """The building record of a descriptor, with read-only views of the segment as arrays
+    (times are datetime64, UTC; kwhs and temps are (values, oriflag) pairs, as usual)."""
+    path = desc["segment"]
+    if path not in _segments:
+        _segments[path] = np.memmap(path, dtype = np.uint8, mode = "r")
+    segment = _segments[path]
+    views   = {}
+    for name, (offset, shape, dtype) in desc["arrays"].items():
+        dtype = np.dtype(dtype)
+        size  = int(np.prod(shape)) * dtype.itemsize
+        views[name] = segment[offset:offset + size].view(dtype).reshape(shape)
+    d = dict(desc["fields"])
+    d["times"] = views["times"]
+    for k in ("kwhs", "temps"):
+        if k in views:
+            d[k] = (views[k], views[k + "_oriflag"])
+    return d
+
+def detach_all():
+    """Unmap the segments mapped in this process (records attached from them must not be used after)."""
+    _segments.clear()
@@ -0,0 +1,85 @@
+import  numpy as np
+import  weakref
+
+#Spectra are cached per kwhs array, so get_report and make_freqs_fig share one transform.
+#Note: the cache assumes kwhs is not modified in place once its spectrum has been taken
+#(call clear_cache() if it is).
+_cache = {}
+
+def get_spectra(kwhs):
+    """Compute the spectrum of a time series (or of each row of a buildings x hours matrix).
+
+    Parameters:
+    kwhs -- A 1-d array of values, or a 2-d array with one series per row.
+
+    Returns a spectrum, a dictionary with:
+        coefs       -- The real-FFT coefficients (the constant part of the signal is dropped).
+        power       -- The power at each frequency bin.
+        total_power -- The total power (a scalar, or one value per row).
+        num_times   -- The number of observations in each series.
+    """
+    kwhs      = np.asarray(kwhs, dtype = float)
+    coefs     = np.fft.rfft(kwhs, axis = -1)
+    coefs[..., 0] = 0 #drop constant part of signal
+    power     = coefs.real**2 + coefs.imag**2 #definition of power
+    return {"coefs"      : coefs,
+            "power"      : power,
+            "total_power": np.sum(power, axis = -1),
+            "num_times"  : kwhs.shape[-1]}
+
+def get_spectrum(d):
+    """Return the (cached) spectrum of the kwhs of building record d."""
+    kwhs, kwhs_oriflag = d["kwhs"]
+    key = id(kwhs)
+    if key in _cache:
+        ref, spec = _cache[key]
+        if ref() is kwhs:
+            return spec
+    spec = get_spectra(kwhs)
+    try:
+        ref = weakref.ref(kwhs, (lambda r, key = key: _forget(key, r)))
+    except TypeError: #not an ndarray (e.g., a list), so it can't be cached safely
+        return spec
+    _cache[key] = (ref, spec)
+    return spec
+
+def _forget(key, ref):
+    if key in _cache and _cache[key][0] is ref:
+        del _cache[key]
+
+def clear_cache():
+    """Forget all cached spectra."""
+    _cache.clear()
+
+def period_bins(num_times, periods):
+    """Return the (fractional) frequency bins of the given periods (in observations)."""
+    return float(num_times) / np.asarray(periods, dtype = float)
+
+def power_at_periods(spec, periods, how = "nearest"):
+    """Return the power at the given periods.
+
+    Parameters:
+    spec -- A spectrum, as returned by get_spectra or get_spectrum.
+    periods -- A list of periods, in number of observations (e.g., [24, 168] for hourly data).
+    how -- Either "nearest" (power of the closest bin) or "interp" (linear interpolation between the two
+           bins around the exact frequency).
+
+    Returns an array with one entry per period (per row, if spec holds several series).
+    """
+    power = spec["power"]
+    nbins = power.shape[-1]
+    bins  = np.clip(period_bins(spec["num_times"], periods), 0, nbins - 1)
+    if how == "nearest":
+        return power[..., np.round(bins).astype(int)]
+    elif how == "interp":
+        left  = np.floor(bins).astype(int)
+        right = np.minimum(left + 1, nbins - 1)
+        alpha = bins - left
+        return (1 - alpha) * power[..., left] + alpha * power[..., right]
+    else:
+        raise ValueError("how must be 'nearest' or 'interp'.")
+
+def prop_of_periods(spec, periods, how = "nearest"):
+    """Return the proportion of the total power found at each of the given periods."""
+    total = np.asarray(spec["total_power"], dtype = float)
+    return power_at_periods(spec, periods, how) / total[..., np.newaxis]
@@ -0,0 +1,114 @@
+"""Short-time Fourier transforms of kwhs: how the daily and weekly rhythms of a building change over the year.
+
+The series is cut into overlapping windows (by default four weeks long, one week apart). The windows are
+strided views of the series (no copies), and all of them (of one building, or of every building of a
+buildings x hours matrix) are transformed by a single rfft. The result is a compact
+(windows x periods) matrix of the power at the periods of interest (24h and 168h by default).
+The windows start at local Sunday midnight, so they line up with calendar weeks.
+
+Example:
+    st = record_stft(d)
+    print st["times"][np.argmax(st["prop"][:, 0])] #the week with the strongest daily rhythm
+"""
+import  numpy as np
+from    numpy.lib.stride_tricks import as_strided
+
+import  spectral
+import  timeaxis as ta
+
+default_periods = (24, 168)
+default_window  = 4 * 168 #4 weeks of hourly data, so both periods fall on exact frequency bins
+default_hop     = 168
+
+def window_view(vals, window, hop):
+    """The windows of a series (or of each row of a matrix), as a strided view: shape (..., windows, window)."""
+    vals = np.ascontiguousarray(vals)
+    num  = (vals.shape[-1] - window) // hop + 1
+    if num < 1:
+        return np.zeros(vals.shape[:-1] + (0, window), dtype = vals.dtype)
+    step = vals.strides[-1]
+    return as_strided(vals, shape = vals.shape[:-1] + (num, window), strides = vals.strides[:-1] + (hop * step, step))
+
+def get_stft(kwhs, oriflag = None, periods = default_periods, window = default_window, hop = default_hop,
+             min_coverage = 0.5):
+    """The short-time Fourier transform of a series, or of each row of a buildings x hours matrix.
+
+    Parameters:
+    kwhs -- A 1-d array of values, or a 2-d array with one series per row.
+    oriflag -- An array of the same shape, True for original values (windows with a smaller fraction of
+               original values than min_coverage get nan power). All values are used if None.
+    periods -- The periods of interest, in observations.
+    window, hop -- The length of the windows and the number of observations between their starts.
+    min_coverage -- See oriflag.
+
+    Returns a dictionary with:
+        starts      -- The index of the first observation of each window.
+        periods     -- The periods.
+        power       -- The power at each period, in each window: (..., windows, periods).
+        prop        -- The proportion of the total power (of the window) at each period.
+        total_power -- The total power of each window: (..., windows).
+        spectra     -- The power at every frequency bin of each window: (..., windows, window // 2 + 1).
+    """
+    kwhs    = np.asarray(kwhs, dtype = float)
+    views   = window_view(kwhs, window, hop)
+    spec    = spectral.get_spectra(views) #one rfft over all the windows (constant part dropped)
+    power   = spectral.power_at_periods(spec, periods)
+    total   = spec["total_power"]
+    if oriflag is not None:
+        num_ori  = np.cumsum(np.concatenate([np.zeros(kwhs.shape[:-1] + (1,)), np.asarray(oriflag, dtype = float)], axis = -1), axis = -1)
+        starts   = np.arange(views.shape[-2]) * hop
+        coverage = (num_ori[..., starts + window] - num_ori[..., starts]) / float(window)
+        bad      = coverage < min_coverage
+        power    = np.where(bad[..., np.newaxis], np.nan, power)
+        total    = np.where(bad, np.nan, total)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        prop = power / total[..., np.newaxis]
+    return {"starts"     : np.arange(views.shape[-2]) * hop,
+            "periods"    : np.asarray(periods),
+            "power"      : power,
+            "prop"       : prop,
+            "total_power": total,
+            "spectra"    : spec["power"]}
+
+def week_start(d):
+    """The index of the first local Sunday midnight of a building record (0 if there is none)."""
+    cal    = ta.get_calendar(d)
+    starts = np.flatnonzero((cal.weekday == 6) & (cal.hour == 0) & (cal.minute == 0))
+    return starts[0] if len(starts) > 0 else 0
+
+def record_stft(d, periods = default_periods, window = default_window, hop = default_hop, min_coverage = 0.5):
+    """The short-time Fourier transform (see get_stft) of the kwhs of building record d, with windows starting
+    at local Sunday midnight. The result also has "times": the time (datetime64, UTC) each window starts at."""
+    kwhs, kwhs_oriflag = d["kwhs"]
+    first = week_start(d)
+    st    = get_stft(np.asarray(kwhs)[first:], np.asarray(kwhs_oriflag)[first:], periods, window, hop, min_coverage)
+    st["starts"] = st["starts"] + first
+    st["times"]  = ta.utc_epochs(d)[st["starts"]].astype(ta.time_dtype)
+    return st
+
+def largest_shift(series, min_windows = 4):
+    """Where a series (e.g., the proportion of power at 24h, window by window) changed the most:
+    the split maximizing the difference between the means before and after it (nan values are ignored).
+    Works along the last axis, so a (buildings x windows) matrix is handled at once.
+
+    Returns (index, shift): the first window after the split, and the mean after minus the mean before
+    (index is -1 and shift nan where no split leaves min_windows valid windows on each side).
+    """
+    series = np.asarray(series, dtype = float)
+    ok     = np.isfinite(series)
+    zero   = np.zeros(series.shape[:-1] + (1,))
+    sums   = np.concatenate([zero, np.cumsum(np.where(ok, series, 0), axis = -1)], axis = -1)
+    counts = np.concatenate([zero, np.cumsum(ok, axis = -1)], axis = -1)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        before = sums[..., 1:-1] / counts[..., 1:-1]
+        after  = (sums[..., -1:] - sums[..., 1:-1]) / (counts[..., -1:] - counts[..., 1:-1])
+    valid  = np.logical_and(counts[..., 1:-1] >= min_windows, counts[..., -1:] - counts[..., 1:-1] >= min_windows)
+    shift  = np.where(valid, after - before, np.nan)
+    if shift.shape[-1] == 0:
+        return np.zeros(series.shape[:-1], dtype = int) - 1, np.zeros(series.shape[:-1]) * np.nan
+    score  = np.where(valid, np.abs(shift), -1)
+    best   = np.argmax(score, axis = -1)
+    found  = np.max(score, axis = -1) >= 0
+    flat   = shift.reshape(-1, shift.shape[-1])
+    picked = flat[np.arange(len(flat)), best.reshape(-1)].reshape(best.shape)
+    return np.where(found, best + 1, -1), np.where(found, picked, np.nan)
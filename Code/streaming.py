@@ -0,0 +1,317 @@
+"""Streaming mode: follow hourly meter readings as they arrive, and raise alerts as soon as a reading is unusual.
+
+A StreamProcessor keeps a fixed amount of state per building, updated in O(1) per reading:
+    profile   -- Exponentially weighted hour-of-week profiles (mean and variance of the kwhs at each local hour
+                 of the week), the streaming counterpart of the average day and average week figures.
+    thresh    -- A rolling estimate of the 99th percentile of the kwhs (the threshold of the "Times in the top 1%"
+                 page), tracked by stochastic approximation: it moves up a little when a reading is above it and
+                 down a little (99 times less) when a reading is below it, in steps proportional to the spread
+                 of the readings.
+    over      -- Whether the building is above its threshold, since when, and the highest reading since then.
+Each reading is compared with the threshold before the reading updates it, so an excursion is reported at the
+reading that starts it ("over"), and its end at the first reading back under the threshold ("back").
+Readings of many buildings (e.g., everything read since the last poll) are processed in one vectorized step.
+
+Readings are lines "<bid>,<time>,<kwh>" (the time in seconds since the epoch, or ISO in UTC, e.g.
+"2012-07-01 13:00:00"), read from a growing file (tail_lines) or from clients of a local socket (socket_lines).
+
+Usage:
+    python streaming.py tail <file> [--state <state file>]
+    python streaming.py listen <port> [--state <state file>]
+"""
+import  os
+import  sys
+import  time
+import  select
+import  socket
+import  numpy as np
+
+import  timeaxis as ta
+from    ingest import parse_times, _to_float, _bad_time
+
+class StreamProcessor(object):
+    """Hour-of-week profiles, rolling thresholds and over-threshold state of many buildings, updated reading by reading.
+
+    Parameters:
+    alpha -- The weight of a new reading in the profiles (each hour of the week gets one reading a week, so the
+             profiles follow about the last 1 / alpha weeks). The first readings of an hour are simply averaged.
+    quantile -- The quantile of the readings used as the threshold.
+    rate -- The size of the steps of the threshold, relative to the spread of the readings.
+    warmup -- The number of readings of a building before it can raise alerts.
+    tz -- The time zone of new buildings (for the local hour of the week).
+    """
+    state_fields = ["tzs", "num_seen", "last", "profile", "profile_var", "profile_num",
+                    "mean", "spread", "thresh", "over", "over_since", "over_peak"]
+
+    def __init__(self, alpha = 0.1, quantile = 0.99, rate = 0.05, warmup = 2 * 168, tz = ta.default_tz):
+        self.params      = {"alpha": alpha, "quantile": quantile, "rate": rate, "warmup": warmup, "tz": tz}
+        self.bids        = np.array([], dtype = object)
+        self.index       = {}
+        self.tzs         = np.array([], dtype = object)
+        self.num_seen    = np.zeros(0, dtype = int)
+        self.last        = np.zeros(0, dtype = np.int64)    #time of the last reading (seconds since the epoch)
+        self.profile     = np.zeros((0, 168))               #mean kwhs at each hour of the week (Monday midnight first)
+        self.profile_var = np.zeros((0, 168))
+        self.profile_num = np.zeros((0, 168), dtype = int)
+        self.mean        = np.zeros(0)                      #exponentially weighted mean of the readings
+        self.spread      = np.zeros(0)                      #and of their absolute deviation from it
+        self.thresh      = np.zeros(0)
+        self.over        = np.zeros(0, dtype = bool)
+        self.over_since  = np.zeros(0, dtype = np.int64)
+        self.over_peak   = np.zeros(0)
+
+    def __len__(self):
+        return len(self.bids)
+
+    def add_buildings(self, bids, tz = None):
+        """Add state for new buildings (in time zone tz, the processor's by default)."""
+        bids = [b for b in bids if b not in self.index]
+        n    = len(bids)
+        tz   = ta.get_tz(tz or self.params["tz"]).zone
+        self.bids        = np.concatenate([self.bids, np.array(bids, dtype = object)])
+        self.index.update((b, i) for i, b in enumerate(bids, len(self.index)))
+        self.tzs         = np.concatenate([self.tzs, np.array([tz] * n, dtype = object)])
+        self.num_seen    = np.concatenate([self.num_seen, np.zeros(n, dtype = int)])
+        self.last        = np.concatenate([self.last, np.zeros(n, dtype = np.int64) + np.iinfo(np.int64).min])
+        self.profile     = np.vstack([self.profile, np.zeros((n, 168))])
+        self.profile_var = np.vstack([self.profile_var, np.zeros((n, 168))])
+        self.profile_num = np.vstack([self.profile_num, np.zeros((n, 168), dtype = int)])
+        self.mean        = np.concatenate([self.mean, np.zeros(n)])
+        self.spread      = np.concatenate([self.spread, np.zeros(n)])
+        self.thresh      = np.concatenate([self.thresh, np.zeros(n)])
+        self.over        = np.concatenate([self.over, np.zeros(n, dtype = bool)])
+        self.over_since  = np.concatenate([self.over_since, np.zeros(n, dtype = np.int64)])
+        self.over_peak   = np.concatenate([self.over_peak, np.zeros(n)])
+
+    def save(self, path):
+        """Save the state (a .npz file)."""
+        with open(path, "wb") as fout: #(np.savez would add .npz to the name)
+            np.savez(fout, bids = self.bids, params = np.array([self.params], dtype = object),
+                     **dict((f, getattr(self, f)) for f in self.state_fields))
+
+    @classmethod
+    def load(cls, path):
+        """Load a state saved with save."""
+        saved = np.load(path, allow_pickle = True) #the bids, tzs and params are object arrays
+        proc  = cls(**saved["params"][0])
+        proc.bids  = saved["bids"]
+        proc.index = dict((b, i) for i, b in enumerate(proc.bids))
+        for f in cls.state_fields:
+            setattr(proc, f, saved[f])
+        return proc
+
+    def update(self, bids, epochs, kwhs):
+        """Process a batch of readings (in the order they arrived; a building may have several).
+        Readings which are not later than the last reading of their building, or are not finite, are skipped.
+
+        Parameters:
+        bids -- The building of each reading (new buildings are added).
+        epochs -- The times of the readings (seconds since the epoch, or datetime64).
+        kwhs -- The readings.
+
+        Returns the alerts, a list of dictionaries with:
+            bid, kind -- The building, and "over" (a reading above the threshold) or "back" (the first reading
+                         under the threshold after an excursion).
+            time, kwh -- The time (datetime64, UTC) and value of the reading.
+            thresh    -- The threshold the reading was compared with.
+            expected  -- The profile value at the hour of the week of the reading.
+            since, peak -- For "back" alerts, the start of the excursion and its highest reading.
+        """
+        bids   = list(bids)
+        self.add_buildings([b for b in set(bids) if b not in self.index])
+        epochs = np.asarray(epochs)
+        epochs = epochs.astype("datetime64[s]").astype(np.int64) if epochs.dtype.kind == "M" else epochs.astype(np.int64)
+        kwhs   = np.asarray(kwhs, dtype = float)
+        rows   = np.array([self.index[b] for b in bids], dtype = int)
+
+        #the readings of a building are processed in rounds (its first reading of the batch, then its second, ...)
+        order  = np.argsort(rows, kind = "mergesort")
+        ranks  = np.empty(len(rows), dtype = int)
+        if len(rows):
+            srows = rows[order]
+            first = np.concatenate([[True], srows[1:] != srows[:-1]])
+            start = np.maximum.accumulate(np.where(first, np.arange(len(srows)), 0))
+            ranks[order] = np.arange(len(srows)) - start
+        alerts = []
+        for r in range(ranks.max() + 1 if len(rows) else 0):
+            sel = np.flatnonzero(ranks == r)
+            alerts.extend(self._update_round(rows[sel], epochs[sel], kwhs[sel]))
+        return alerts
+
+    def _update_round(self, rows, epochs, kwhs):
+        """Process readings of distinct buildings."""
+        p     = self.params
+        ok    = np.isfinite(kwhs) & (epochs > self.last[rows])
+        rows, epochs, kwhs = rows[ok], epochs[ok], kwhs[ok]
+        how   = np.zeros(len(rows), dtype = int)
+        tzs   = self.tzs[rows]
+        for tz in set(tzs):
+            sel      = tzs == tz
+            how[sel] = ta.Calendar(epochs[sel], tz).hour_of_week
+
+        #compare with the threshold (as it was before this reading)
+        thresh   = self.thresh[rows]
+        over_now = (self.num_seen[rows] >= p["warmup"]) & (kwhs > thresh)
+        was_over = self.over[rows]
+        alerts   = []
+        for i in np.flatnonzero(over_now != was_over):
+            row   = rows[i]
+            alert = {"bid": self.bids[row], "kind": "over" if over_now[i] else "back",
+                     "time": np.datetime64(int(epochs[i]), "s"), "kwh": kwhs[i], "thresh": thresh[i],
+                     "expected": self.profile[row, how[i]]}
+            if not over_now[i]:
+                alert["since"] = np.datetime64(int(self.over_since[row]), "s")
+                alert["peak"]  = self.over_peak[row]
+            alerts.append(alert)
+        starts = over_now & ~was_over
+        self.over_since[rows[starts]] = epochs[starts]
+        self.over_peak[rows] = np.where(starts, kwhs, np.where(over_now, np.maximum(self.over_peak[rows], kwhs), 0))
+        self.over[rows]      = over_now
+
+        #hour-of-week profiles: a running mean of the first 1 / alpha readings of each hour, then exponential weights
+        num     = self.profile_num[rows, how]
+        w       = np.maximum(1.0 / (num + 1), p["alpha"])
+        delta   = kwhs - self.profile[rows, how]
+        self.profile[rows, how]     += w * delta
+        self.profile_var[rows, how]  = (1 - w) * (self.profile_var[rows, how] + w * delta ** 2)
+        self.profile_num[rows, how]  = num + 1
+
+        #the threshold: steps up by rate * spread * quantile above it, down by rate * spread * (1 - quantile) below
+        seen    = self.num_seen[rows]
+        w       = np.maximum(1.0 / np.maximum(seen, 1), p["alpha"] / 168.0)
+        self.spread[rows] += np.where(seen > 0, w * (np.abs(kwhs - self.mean[rows]) - self.spread[rows]), 0)
+        w       = np.maximum(1.0 / (seen + 1), p["alpha"] / 168.0)
+        self.mean[rows]   += w * (kwhs - self.mean[rows])
+        step    = p["rate"] * self.spread[rows]
+        thresh  = np.where(seen == 0, kwhs, thresh + step * np.where(kwhs > thresh, p["quantile"], p["quantile"] - 1))
+        self.thresh[rows]   = thresh
+        self.num_seen[rows] = seen + 1
+        self.last[rows]     = epochs
+        return alerts
+
+    def avg_week(self, bid):
+        """The profile of a building: (mean, standard deviation) of its kwhs at each hour of the week,
+        Sunday midnight first (as in the average week figure)."""
+        row = self.index[bid]
+        roll = lambda a: np.roll(a, 24)
+        return roll(self.profile[row]), roll(np.sqrt(self.profile_var[row]))
+
+    def avg_day(self, bid):
+        """The average weekday and weekend day of a building (24 values each, as in the average day figure)."""
+        week = self.profile[self.index[bid]].reshape(7, 24) #Monday first
+        return week[:5].mean(axis = 0), week[5:].mean(axis = 0)
+
+def parse_lines(lines):
+    """Parse readings "<bid>,<time>,<kwh>" (malformed lines are skipped). Returns (bids, epochs, kwhs)."""
+    fields = [l.strip().split(",") for l in lines]
+    fields = [f for f in fields if len(f) == 3 and f[0]]
+    if not fields:
+        return [], np.zeros(0, dtype = np.int64), np.zeros(0)
+    epochs = np.array([_parse_time(f[1]) for f in fields], dtype = np.int64)
+    fields = [f for f, e in zip(fields, epochs) if e != _bad_time]
+    epochs = epochs[epochs != _bad_time]
+    return [f[0].strip() for f in fields], epochs, np.array([_to_float(f[2]) for f in fields])
+
+def _parse_time(t):
+    return parse_times([t], "epoch" if t.strip().replace(".", "", 1).isdigit() else "iso")[0]
+
+def tail_lines(fname, poll = 1.0, from_start = False):
+    """Follow a growing file (as tail -f does, also across truncation and rotation): yields the list of the
+    complete lines added since the last poll, every poll seconds while there are none."""
+    fin = open(fname, "rb")
+    if not from_start:
+        fin.seek(0, os.SEEK_END)
+    partial = ""
+    while True:
+        fin.seek(0, os.SEEK_CUR) #clears the end-of-file state, so new data is seen
+        data = fin.read()
+        if data:
+            lines   = (partial + data).split("\n")
+            partial = lines.pop()
+            if lines:
+                yield lines
+            continue
+        try:
+            st = os.stat(fname)
+        except OSError:
+            st = None
+        if st is not None and (st.st_ino != os.fstat(fin.fileno()).st_ino or st.st_size < fin.tell()):
+            fin.close() #rotated or truncated: start over with the new file
+            fin = open(fname, "rb")
+            partial = ""
+            continue
+        time.sleep(poll)
+
+def socket_lines(port, host = "127.0.0.1", poll = 1.0):
+    """Listen on a local TCP port, and yield the list of the complete lines received from all clients
+    (any number of them) in each round."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(16)
+    partial = {}
+    try:
+        while True:
+            ready, _, _ = select.select([server] + list(partial), [], [], poll)
+            lines = []
+            for s in ready:
+                if s is server:
+                    conn, _ = server.accept()
+                    partial[conn] = ""
+                    continue
+                data = s.recv(65536)
+                if not data: #the client is done
+                    lines.append(partial.pop(s))
+                    s.close()
+                    continue
+                got        = (partial[s] + data).split("\n")
+                partial[s] = got.pop()
+                lines.extend(got)
+            if lines:
+                yield lines
+    finally:
+        for s in partial:
+            s.close()
+        server.close()
+
+def format_alert(alert):
+    text = "%s %s %s: %.2f kwh (threshold %.2f, expected %.2f)" % (alert["time"], alert["bid"], alert["kind"],
+                                                                   alert["kwh"], alert["thresh"], alert["expected"])
+    if alert["kind"] == "back":
+        text += ", over since %s (peak %.2f)" % (alert["since"], alert["peak"])
+    return text
+
+def run(proc, batches, on_alert = None, state = None, save_every = 3600):
+    """Feed batches of lines (e.g., from tail_lines or socket_lines) to a StreamProcessor.
+
+    Parameters:
+    proc -- The StreamProcessor.
+    batches -- An iterable of lists of lines.
+    on_alert -- Called with each alert (prints it by default).
+    state -- A file to save the state to, every save_every seconds and at the end.
+    """
+    on_alert = on_alert or (lambda a: sys.stdout.write(format_alert(a) + "\n"))
+    saved    = time.time()
+    try:
+        for lines in batches:
+            for alert in proc.update(*parse_lines(lines)):
+                on_alert(alert)
+            if state is not None and time.time() - saved > save_every:
+                proc.save(state)
+                saved = time.time()
+    finally:
+        if state is not None:
+            proc.save(state)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) not in (2, 4) or args[0] not in ("tail", "listen") or (len(args) == 4 and args[2] != "--state"):
+        print __doc__
+        exit()
+    state = args[3] if len(args) == 4 else None
+    proc  = StreamProcessor.load(state) if state is not None and os.path.exists(state) else StreamProcessor()
+    lines = tail_lines(args[1]) if args[0] == "tail" else socket_lines(int(args[1]))
+    try:
+        run(proc, lines, state = state)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,121 @@
+import  numpy as np
+import  datetime
+from    holiday import yfhol
+import  analytics as an
+import  timeaxis as ta
+
+
+def gen_temps(num_obs, obs_per_hour, start_day, rng):
+    """Return a realistic year of outdoor temperatures (in F): a seasonal cycle, a daily cycle and noise."""
+    hours      = np.arange(num_obs) / float(obs_per_hour)
+    days       = start_day + hours / 24.0
+    seasonal   = 52 - 25 * np.cos(2 * np.pi * (days - 15) / 365.0)
+    daily      = -8 * np.cos(2 * np.pi * (hours - 3) / 24.0)
+    #weather fronts: smoothed noise, a few days long
+    fronts     = np.cumsum(rng.normal(0, 1, num_obs))
+    width      = 72 * obs_per_hour
+    fronts     = fronts - np.convolve(fronts, np.ones(width) / width, mode = "same")
+    return seasonal + daily + 0.5 * fronts + rng.normal(0, 1, num_obs)
+
+def gen_gaps(num_obs, rng, num_gaps, max_len):
+    """Return an oriflag (True where the value is original) with num_gaps runs of missing values."""
+    oriflag = np.ones(num_obs, dtype = bool)
+    for start, length in zip(rng.randint(0, num_obs, num_gaps), rng.randint(1, max_len + 1, num_gaps)):
+        oriflag[start:start + length] = False
+    return oriflag
+
+def gen_brec(bid = 0,
+             the_year = 2012,
+             num_days = 365,
+             obs_per_hour = 1,
+             naics = 611110,
+             btype = "School",
+             base_load = None,
+             open_hour = 7,
+             close_hour = 18,
+             weekend_frac = 0.3,
+             cooling_slope = None,
+             heating_slope = None,
+             num_gaps = 8,
+             max_gap = 48,
+             tz = ta.default_tz,
+             seed = None):
+    """Generate a synthetic building record.
+
+    Parameters:
+    bid -- The building id.
+    the_year -- The year the record starts in (on January first, at midnight).
+    num_days -- The length of the record, in days.
+    obs_per_hour -- The resolution (1 for hourly data, 4 for 15-minute data, ...).
+    naics, btype -- The NAICS code and business type stored in the record.
+    base_load -- The load (kwh per hour) when the building is closed (random if None).
+    open_hour, close_hour -- The daily schedule (the building is open between these hours on weekdays).
+    weekend_frac -- The fraction of the weekday occupancy load used on weekends and holidays.
+    cooling_slope -- Additional kwh per hour per degree above 65F (random if None).
+    heating_slope -- Additional kwh per hour per degree below 50F (random if None).
+    num_gaps -- The number of runs of missing values (oriflag = False) in kwhs and in temps.
+    max_gap -- The maximum length (in hours) of a run of missing values.
+    tz -- The time zone of the building (or its name); the record starts at local midnight,
+          and the schedule follows the local clock (so it shifts with daylight saving time).
+    seed -- Seed for the random number generator (defaults to bid, so records are reproducible).
+
+    Returns a building record, i.e. a dictionary with "bid", "naics", "btype",
+    "times", "tz", "kwhs" and "temps" (the last two are (values, oriflag) pairs).
+    """
+    rng = np.random.RandomState(bid if seed is None else seed)
+    if base_load is None:
+        base_load = rng.uniform(20, 200)
+    if cooling_slope is None:
+        cooling_slope = rng.uniform(0, 0.04) * base_load
+    if heating_slope is None:
+        heating_slope = rng.uniform(0, 0.01) * base_load
+
+    tz       = ta.get_tz(tz)
+    start    = tz.localize(datetime.datetime(the_year, 1, 1))
+    num_obs  = num_days * 24 * obs_per_hour
+    times    = ta.make_times(start, num_obs, 3600 // obs_per_hour)
+    cal      = ta.Calendar(ta.epochs_of(times), tz)
+
+    hod      = cal.hour + cal.minute / 60.0 #local time, so schedules follow daylight saving time
+    holidays = []
+    for year in range(the_year, the_year + num_days // 365 + 2):
+        holidays.extend(yfhol(year).values())
+    day_off  = np.in1d(cal.date, np.array(holidays, dtype = "datetime64[D]"))
+    is_off   = np.logical_or(cal.weekday >= 5, day_off)
+
+    #occupancy: a smooth ramp up before opening and down after closing
+    ramp      = 1.5
+    occupancy = (1 / (1 + np.exp(-(hod - open_hour) * ramp))) * (1 / (1 + np.exp((hod - close_hour) * ramp)))
+    occupancy = np.where(is_off, weekend_frac * occupancy, occupancy)
+
+    temps     = gen_temps(num_obs, obs_per_hour, 0, rng)
+    cooling   = cooling_slope * np.maximum(temps - 65, 0) * (0.5 + occupancy)
+    heating   = heating_slope * np.maximum(50 - temps, 0)
+    kwhs      = base_load * (1 + 1.5 * occupancy) + cooling + heating
+    kwhs      = (kwhs + rng.normal(0, 0.03 * base_load, num_obs)) / obs_per_hour
+    kwhs      = np.maximum(kwhs, 0)
+
+    kwhs_oriflag  = gen_gaps(num_obs, rng, num_gaps, max_gap * obs_per_hour)
+    temps_oriflag = gen_gaps(num_obs, rng, num_gaps, max_gap * obs_per_hour)
+    kwhs  = an.forward_fill(kwhs, kwhs_oriflag)
+    temps = an.forward_fill(temps, temps_oriflag)
+
+    return {"bid"  : bid,
+            "naics": naics,
+            "btype": btype,
+            "times": times,
+            "tz"   : tz.zone,
+            "kwhs" : (kwhs, kwhs_oriflag),
+            "temps": (temps, temps_oriflag)}
+
+def gen_brecs(num_brecs, **kwargs):
+    """A generator that yields num_brecs synthetic building records (with bids 0, 1, ...).
+    Records are generated one at a time, so memory use does not grow with num_brecs.
+    Keyword arguments are passed on to gen_brec.
+    """
+    btypes = [("School", 611110), ("Office", 531120), ("Retail", 452910), ("Prison", 922140)]
+    for bid in range(num_brecs):
+        btype, naics = btypes[bid % len(btypes)]
+        kw = {"btype": btype, "naics": naics}
+        kw.update(kwargs)
+        yield gen_brec(bid, **kw)
@@ -0,0 +1,201 @@
+"""The time axis of building records: UTC instants plus a per-record time zone.
+
+d["times"] is a datetime64[s] array of UTC instants (8 bytes per observation), and d["tz"] is the
+name of the building's time zone (e.g., "US/Central"). Local calendar fields (hour, weekday, date, ...)
+are derived for the whole axis at once: the UTC offset of every instant is looked up in the transition
+table of the time zone (from the tz database, via pytz) with one searchsorted.
+Python datetimes are only made at the matplotlib boundary (see local_datetimes).
+
+Records from before this change (object arrays of datetimes) still work: their wall-clock times are
+taken to be local times of the record's time zone (see utc_epochs and upgrade).
+
+Example:
+    cal = get_calendar(d)
+    midnights = np.flatnonzero(cal.hour == 0)
+"""
+import  calendar
+import  datetime
+import  weakref
+import  numpy as np
+import  pytz
+
+default_tz = "US/Central"
+time_dtype = "datetime64[s]"
+
+_tables    = {} #time zone name -> (transition instants, UTC offsets), both in seconds
+_calendars = {} #(id of a times array, time zone name) -> (weak reference to the array, Calendar)
+
+def get_tz(tz):
+    """A pytz time zone, given one or its name."""
+    if isinstance(tz, basestring):
+        return pytz.timezone(tz)
+    return tz
+
+def tz_name(tz):
+    return tz if isinstance(tz, basestring) else tz.zone
+
+def tz_of(d):
+    """The name of the time zone of building record d."""
+    if d.get("tz") is not None:
+        return tz_name(d["tz"])
+    times = d["times"]
+    if np.asarray(times).dtype == object and len(times) > 0 and getattr(times[0].tzinfo, "zone", None):
+        return times[0].tzinfo.zone
+    return default_tz
+
+def transitions(tz):
+    """The (cached) transition table of a time zone: (instants, offsets), where offsets[i] is the
+    UTC offset (in seconds) from instants[i] (seconds since the epoch) on."""
+    name = tz_name(tz)
+    if name not in _tables:
+        tzinfo = get_tz(tz)
+        if hasattr(tzinfo, "_utc_transition_times"):
+            instants = np.array(tzinfo._utc_transition_times, dtype = time_dtype).astype(np.int64)
+            offsets  = np.array([int(info[0].total_seconds()) for info in tzinfo._transition_info], dtype = np.int64)
+        else: #a fixed offset (e.g., UTC)
+            instants = np.array([np.iinfo(np.int64).min], dtype = np.int64)
+            offsets  = np.array([int(tzinfo.utcoffset(datetime.datetime(2000, 1, 1)).total_seconds())], dtype = np.int64)
+        _tables[name] = (instants, offsets)
+    return _tables[name]
+
+def utc_offsets(epochs, tz):
+    """The UTC offsets (in seconds) of a time zone at the given instants (seconds since the epoch)."""
+    instants, offsets = transitions(tz)
+    inds = np.searchsorted(instants, epochs, side = "right") - 1
+    return offsets[np.maximum(inds, 0)]
+
+def from_local(local, tz):
+    """The instants (seconds since the epoch) of local wall-clock times (as seconds since the local epoch).
+    Wall-clock times which occur twice (when clocks go back) map to the later instant, and times
+    which never occur (when clocks go forward) are shifted forward."""
+    local = np.asarray(local, dtype = np.int64)
+    guess = local - utc_offsets(local, tz)
+    return local - utc_offsets(guess, tz)
+
+def to_epoch(t):
+    """Seconds since the epoch (UTC) of a datetime (naive datetimes are taken to be UTC)."""
+    if hasattr(t, "utctimetuple"):
+        return calendar.timegm(t.utctimetuple())
+    if isinstance(t, np.datetime64):
+        return int(t.astype(time_dtype).astype(np.int64))
+    return int(t)
+
+def epochs_of(times):
+    """The seconds since the epoch of an array of times (datetimes, datetime64 or numbers)."""
+    times = np.asarray(times)
+    if times.dtype == object:
+        return np.array([to_epoch(t) for t in times], dtype = np.int64)
+    if times.dtype.kind == "M":
+        return times.astype(time_dtype).astype(np.int64)
+    return times.astype(np.int64)
+
+def make_times(start, num_obs, step = 3600):
+    """A regular time axis (datetime64[s], UTC) of num_obs times, step seconds apart, from start
+    (a tz-aware datetime, or seconds since the epoch)."""
+    return (to_epoch(start) + step * np.arange(num_obs, dtype = np.int64)).astype(time_dtype)
+
+def _wall_clock(times):
+    """The wall-clock fields of an array of datetimes, as seconds since the local epoch."""
+    epoch0 = datetime.datetime(1970, 1, 1)
+    return np.array([int((t.replace(tzinfo = None) - epoch0).total_seconds()) for t in times], dtype = np.int64)
+
+def utc_epochs(d):
+    """The times of building record d, in seconds since the epoch."""
+    times = np.asarray(d["times"])
+    if times.dtype != object:
+        return epochs_of(times)
+    #old records: datetimes whose wall-clock fields are local times
+    return from_local(_wall_clock(times), tz_of(d))
+
+def upgrade(d, tz = None):
+    """Convert (in place) the times of an old building record (an object array of datetimes)
+    to a datetime64[s] UTC axis, and set its time zone. Returns d.
+    This replaces the old adjust_for_dlst.adjustbrec step: once a record has a UTC axis and a time zone,
+    every calendar computation (see Calendar and analytics.get_periods) accounts for daylight saving time.
+
+    Parameters:
+    d -- The building record.
+    tz -- The time zone of the building (defaults to the one of the record, see tz_of).
+          The wall-clock times of old records are taken to be local times of this zone.
+    """
+    if tz is not None:
+        d["tz"] = tz_name(tz)
+    tz = tz_of(d)
+    if np.asarray(d["times"]).dtype == object:
+        d["times"] = utc_epochs(d).astype(time_dtype)
+    d["tz"] = tz
+    return d
+
+class Calendar(object):
+    """The local calendar fields of a time axis, as arrays (each computed the first time it is used).
+
+    Fields: epochs (UTC), local (seconds since the local epoch), days (days since the local epoch),
+            date (datetime64[D]), year, month, day, hour, minute, weekday (Monday is 0) and hour_of_week
+            (hours since Monday midnight).
+
+    Parameters:
+    epochs -- The times, in seconds since the epoch.
+    tz -- The time zone (or its name).
+    local -- The local times (as seconds since the local epoch), if they are already known.
+    """
+    def __init__(self, epochs, tz, local = None):
+        self.epochs  = np.asarray(epochs, dtype = np.int64)
+        self.tz      = tz_name(tz)
+        self._fields = {} if local is None else {"local": np.asarray(local, dtype = np.int64)}
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def _get(self, name, fun):
+        if name not in self._fields:
+            self._fields[name] = fun()
+        return self._fields[name]
+
+    local        = property(lambda self: self._get("local",   lambda: self.epochs + utc_offsets(self.epochs, self.tz)))
+    days         = property(lambda self: self._get("days",    lambda: self.local // 86400))
+    date         = property(lambda self: self._get("date",    lambda: self.days.astype("datetime64[D]")))
+    year         = property(lambda self: self._get("year",    lambda: (self.date.astype("datetime64[Y]").astype(np.int64) + 1970).astype(np.int16)))
+    month        = property(lambda self: self._get("month",   lambda: (self.date.astype("datetime64[M]").astype(np.int64) % 12 + 1).astype(np.int16)))
+    day          = property(lambda self: self._get("day",     lambda: ((self.date - self.date.astype("datetime64[M]")).astype(np.int64) + 1).astype(np.int16)))
+    hour         = property(lambda self: self._get("hour",    lambda: ((self.local % 86400) // 3600).astype(np.int16)))
+    minute       = property(lambda self: self._get("minute",  lambda: ((self.local % 3600) // 60).astype(np.int16)))
+    weekday      = property(lambda self: self._get("weekday", lambda: ((self.days + 3) % 7).astype(np.int16))) #1970-01-01 was a Thursday
+    hour_of_week = property(lambda self: self._get("hour_of_week", lambda: self.weekday * 24 + self.hour))
+
+def get_calendar(d):
+    """Return the (cached) Calendar of building record d.
+    Note: the cache assumes d["times"] is not modified in place (call clear_cache() if it is)."""
+    times = d["times"]
+    tz    = tz_of(d)
+    key   = (id(times), tz)
+    if key in _calendars:
+        ref, cal = _calendars[key]
+        if ref() is times:
+            return cal
+    if np.asarray(times).dtype == object: #old records: the wall clock is kept as it was recorded
+        local = _wall_clock(times)
+        cal   = Calendar(from_local(local, tz), tz, local)
+    else:
+        cal   = Calendar(epochs_of(times), tz)
+    try:
+        ref = weakref.ref(times, (lambda r, key = key: _forget(key, r)))
+    except TypeError: #not an ndarray (e.g., a list), so it can't be cached safely
+        return cal
+    _calendars[key] = (ref, cal)
+    return cal
+
+def _forget(key, ref):
+    if key in _calendars and _calendars[key][0] is ref:
+        del _calendars[key]
+
+def clear_cache():
+    """Forget all cached calendars."""
+    _calendars.clear()
+
+def local_datetimes(d, inds = slice(None)):
+    """The local times of building record d (or of d["times"][inds]) as naive datetimes, for plotting and labels."""
+    return get_calendar(d).local[inds].astype(time_dtype).astype(object)
+
+def utc_datetimes(d, inds = slice(None)):
+    """The times of building record d (or of d["times"][inds]) as naive UTC datetimes."""
+    return get_calendar(d).epochs[inds].astype(time_dtype).astype(object)
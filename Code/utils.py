@@ -1,7 +1,6 @@
 import  numpy as np
 import  sys
 import  cPickle as pickle
-from    scipy.spatial import distance
 data_loc = "../Data/"
 fig_loc  = "../Figs/"
 the_year = 2012
@@ -52,6 +51,21 @@ def progress_bar(done, bmax = 100):
         sys.stdout.write("\n")
     sys.stdout.flush()
 
+def peak_rss():
+    """Returns the peak resident set size of this process, in MB"""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": #bytes on OS X, kilobytes elsewhere
+        rss /= 1024.0
+    return rss / 1024.0
+
+def pairwise_dists(x):
+    """Returns the matrix of euclidean distances between the n entries (or rows) of x"""
+    x = np.array(x, dtype = float)
+    x = x.reshape(len(x), -1)
+    diffs = x[:, np.newaxis, :] - x[np.newaxis, :, :]
+    return np.sqrt(np.sum(diffs**2, axis = 2))
+
 def dCorr(x, y):
     """Returns the distance-correlation between x and y"""
     n = len(x)
@@ -62,8 +76,8 @@ def dCorr(x, y):
         return (1.0 / n**2) * np.sum(xM * yM) #sum of all entries in component-wise product
         
 
-    A = distance.squareform(distance.pdist(np.array(x).reshape(n, -1)))
-    B = distance.squareform(distance.pdist(np.array(y).reshape(n, -1)))
+    A = pairwise_dists(x)
+    B = pairwise_dists(y)
 
     #Center along both axes:
     A -= A.mean(axis = 0)
@@ -95,6 +109,15 @@ def qload(finn, loc = ""):
     sys.stdout.flush()
     return toR
 
+_loaded = {}
+
+def qload_cached(finn, loc = ""):
+    """Like qload, but each file is unpickled only once per process (for lookup tables, e.g. NAICS.pkl)"""
+    key = (finn, loc)
+    if key not in _loaded:
+        _loaded[key] = qload(finn, loc)
+    return _loaded[key]
+
 def qdump(var, foutn, loc = ""):
     """ Pickles var a file with name foutn"""
     if loc == "":
@@ -102,7 +125,7 @@ def qdump(var, foutn, loc = ""):
     foutn = loc + foutn
     print "Saving", foutn +"...."
     fout = open(foutn, "wb")
-    pickle.dump(var, fout)
+    pickle.dump(var, fout, pickle.HIGHEST_PROTOCOL) #binary; qload reads any protocol
     fout.close()
     sys.stdout.flush()
     print "\tSaved"
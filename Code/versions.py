@@ -34,6 +34,23 @@ import  collections
 import  random
 import  scipy
 
+#the oldest versions the code works with (e.g., np.matmul, np.broadcast_to and np.load(allow_pickle = ...) are new
+#in numpy 1.10)
+min_versions = {"numpy": "1.10"}
+
+def _version_tuple(ver):
+    return tuple(int(p) for p in ver.split(".")[:2])
+
+def check_versions():
+    """Warn about modules older than their entry of min_versions. Returns the names of those modules."""
+    old = []
+    for name, least in sorted(min_versions.items()):
+        ver = __import__(name).__version__
+        if _version_tuple(ver) < _version_tuple(least):
+            print "Warning: %s %s is older than %s, which the code needs" % (name, ver, least)
+            old.append(name)
+    return old
+
 def print_versions():
     import types
     import sys
@@ -51,5 +68,7 @@ def print_versions():
     print "\nModules with no __version__:"
     for mod in unversioned:
         print "\t%s" % mod
+    print
+    check_versions()
 
 print_versions()